@@ -0,0 +1,458 @@
+import os
+import json
+import shutil
+import hashlib
+import logging
+from decimal import Decimal
+
+import numpy
+import pandas
+import pyarrow
+import pyarrow.parquet
+
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+
+# Under the user's cache directory, rather than wherever the script is run
+DEFAULT_CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"),
+    "process_report",
+    "checkpoints",
+)
+DEFAULT_MAX_BYTES = 2 * 1024**3
+
+# Bump whenever processing changes in a way that makes old checkpoints invalid
+CHECKPOINT_VERSION = "6"
+
+ARROW_COLUMNS_METADATA_KEY = b"process_report.arrow_columns"
+OBJECT_COLUMNS_METADATA_KEY = b"process_report.object_columns"
+COLUMNS_METADATA_KEY = b"process_report.columns"
+
+# How object columns are stored, see `_encode_object_column`
+STRING_KIND = "string"
+AMOUNT_KIND = "amount"
+NONE_MISSING = "None"
+NAN_MISSING = "nan"
+MIXED_MISSING = "mixed"
+LINK_SUFFIX = ".link"
+
+# How each stage of a run was handled, as reported by `CheckpointRunner`
+SKIPPED = "reused (skipped)"
+LOADED = "reused (loaded)"
+RECOMPUTED = "recomputed"
+
+
+def file_digest(filepath) -> str:
+    """Returns the sha256 digest of a file's contents"""
+    sha256 = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def frame_digest(dataframe: pandas.DataFrame) -> str:
+    """Returns the sha256 digest of a dataframe written as CSV, i.e of a
+    small file loaded in memory"""
+    return hashlib.sha256(dataframe.to_csv(index=False).encode()).hexdigest()
+
+
+def _encode_object_column(name, column: pandas.Series) -> tuple[pyarrow.Array, dict]:
+    """Converts an object column to a typed Arrow array, along with how to
+    convert it back to the exact same values
+
+    Strings become a string array. Amounts, Decimals and ints mixed with
+    missing values, become a struct of their value as a decimal, their
+    scale and whether they were ints, since Decimal("1.50"), Decimal("1.5")
+    and 1.5 are exported differently. Missing values are None or NaN, which
+    some processors also tell apart, so the column records which one it
+    holds, or a per row `is_nan` flag if it holds both.
+    """
+    is_missing = column.isna().to_numpy()
+    is_none = numpy.zeros(len(column), dtype=bool)
+    is_none[is_missing] = [value is None for value in column[is_missing]]
+    if is_none[is_missing].all():
+        missing = NONE_MISSING
+    elif not is_none.any():
+        missing = NAN_MISSING
+    else:
+        missing = MIXED_MISSING
+
+    try:
+        array = pyarrow.array(column, type=pyarrow.string(), from_pandas=True)
+        kind = STRING_KIND
+    except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError):
+        values = column[~is_missing].tolist()
+        if not all(
+            (isinstance(value, Decimal) and value.is_finite())
+            or (isinstance(value, int) and not isinstance(value, bool))
+            for value in values
+        ):
+            raise TypeError(
+                f"Column {name} holds {sorted({type(value).__name__ for value in values})} values, which cannot be checkpointed"
+            )
+        kind = AMOUNT_KIND
+        scales = [
+            0 if isinstance(value, int) else -value.as_tuple().exponent
+            for value in values
+        ]
+        amounts = numpy.full(len(column), None, dtype=object)
+        amounts[~is_missing] = [Decimal(value) for value in values]
+        full_scales = numpy.zeros(len(column), dtype=numpy.int8)
+        full_scales[~is_missing] = scales
+        is_int = numpy.zeros(len(column), dtype=bool)
+        is_int[~is_missing] = [isinstance(value, int) for value in values]
+        array = pyarrow.StructArray.from_arrays(
+            [
+                pyarrow.array(amounts, type=pyarrow.decimal128(38, max([0, *scales]))),
+                pyarrow.array(full_scales),
+                pyarrow.array(is_int),
+            ],
+            names=["amount", "scale", "is_int"],
+            mask=pyarrow.array(is_missing),
+        )
+
+    if missing == MIXED_MISSING:
+        array = pyarrow.StructArray.from_arrays(
+            [array, pyarrow.array(is_missing & ~is_none)], names=["value", "is_nan"]
+        )
+    return array, {"kind": kind, "missing": missing}
+
+
+def _decode_object_column(
+    array: pyarrow.ChunkedArray, encoding, index
+) -> pandas.Series:
+    array = array.combine_chunks()
+    is_nan = None
+    if encoding["missing"] == MIXED_MISSING:
+        is_nan = array.field("is_nan").to_numpy(zero_copy_only=False)
+        array = array.field("value")
+    is_missing = array.is_null().to_numpy(zero_copy_only=False)
+
+    if encoding["kind"] == STRING_KIND:
+        values = array.to_numpy(zero_copy_only=False).astype(object)
+    else:
+        values = numpy.full(len(array), None, dtype=object)
+        present = ~is_missing
+        amounts = array.field("amount").filter(pyarrow.array(present)).to_pylist()
+        scales = array.field("scale").filter(pyarrow.array(present)).to_pylist()
+        is_int = array.field("is_int").filter(pyarrow.array(present)).to_pylist()
+        values[present] = [
+            int(amount) if value_is_int else amount.quantize(Decimal(1).scaleb(-scale))
+            for amount, scale, value_is_int in zip(amounts, scales, is_int)
+        ]
+
+    if encoding["missing"] == NAN_MISSING:
+        values[is_missing] = numpy.nan
+    else:
+        values[is_missing] = None
+        if is_nan is not None:
+            values[is_nan] = numpy.nan
+    return pandas.Series(values, index=index, dtype=object)
+
+
+def _to_table(dataframe: pandas.DataFrame) -> pyarrow.Table:
+    """Converts a dataframe to an Arrow table that converts back to the exact
+    same dataframe
+
+    Object columns would otherwise be coerced to a single Arrow type, which
+    changes how they are later exported, so they are stored as typed columns
+    by `_encode_object_column`.
+    """
+    arrow_columns = list()
+    object_columns = dict()
+    for name, column in dataframe.items():
+        if isinstance(column.dtype, pandas.ArrowDtype):
+            arrow_columns.append(name)
+        elif column.dtype == object:
+            object_columns[name] = _encode_object_column(name, column)
+
+    table = pyarrow.Table.from_pandas(dataframe.drop(columns=list(object_columns)))
+    for name, (array, _) in object_columns.items():
+        table = table.append_column(name, array)
+    return table.replace_schema_metadata(
+        {
+            **table.schema.metadata,
+            ARROW_COLUMNS_METADATA_KEY: json.dumps(arrow_columns),
+            OBJECT_COLUMNS_METADATA_KEY: json.dumps(
+                {name: encoding for name, (_, encoding) in object_columns.items()}
+            ),
+            COLUMNS_METADATA_KEY: json.dumps(list(dataframe.columns)),
+        }
+    )
+
+
+def _from_table(table: pyarrow.Table) -> pandas.DataFrame:
+    object_columns = json.loads(table.schema.metadata[OBJECT_COLUMNS_METADATA_KEY])
+    dataframe = table.drop_columns(list(object_columns)).to_pandas()
+    for name in json.loads(table.schema.metadata[ARROW_COLUMNS_METADATA_KEY]):
+        dataframe[name] = pandas.Series(
+            pandas.arrays.ArrowExtensionArray(table.column(name)),
+            index=dataframe.index,
+        )
+    for name, encoding in object_columns.items():
+        dataframe[name] = _decode_object_column(
+            table.column(name), encoding, dataframe.index
+        )
+    return dataframe[json.loads(table.schema.metadata[COLUMNS_METADATA_KEY])]
+
+
+class CheckpointCache:
+    """On-disk cache of dataframes produced by each processing stage
+
+    Every checkpoint is a directory holding one Parquet file per saved
+    dataframe, named after a hash of those files, its content key. A stage
+    is looked up by its input key, a hash of everything the stage depends
+    on, which is linked to the content key of its output. Other keys can
+    also be linked to a key that is known to produce the same result. Once
+    the cache grows beyond `max_bytes`, the least recently used checkpoints
+    are evicted.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(stage, *inputs) -> str:
+        """Hashes the stage name and its inputs into a checkpoint key"""
+        sha256 = hashlib.sha256(f"{CHECKPOINT_VERSION}:{stage}".encode())
+        for stage_input in inputs:
+            sha256.update(json.dumps(stage_input, sort_keys=True, default=str).encode())
+        return sha256.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def resolve(self, key) -> str:
+        """Returns the key that `key` is, possibly indirectly, linked to, or
+        `key` itself"""
+        seen_keys = set()
+        while key not in seen_keys:
+            seen_keys.add(key)
+            try:
+                with open(self._path(key) + LINK_SUFFIX) as f:
+                    key = f.read().strip()
+            except FileNotFoundError:
+                break
+        return key
+
+    def link(self, alias_key, key):
+        """Records that the stage keyed by `alias_key` produces the same
+        result as the stage keyed by `key`"""
+        if alias_key != key:
+            with open(self._path(alias_key) + LINK_SUFFIX, "w") as f:
+                f.write(key)
+
+    def has(self, key) -> bool:
+        return os.path.isdir(self._path(self.resolve(key)))
+
+    def load(self, key, names=None) -> dict[str, pandas.DataFrame] | None:
+        """Loads the frames saved under `key`, or only those in `names`"""
+        checkpoint_path = self._path(self.resolve(key))
+        if not os.path.isdir(checkpoint_path):
+            return None
+
+        frames = dict()
+        for filename in sorted(os.listdir(checkpoint_path)):
+            name = os.path.splitext(filename)[0]
+            if names is None or name in names:
+                frames[name] = _from_table(
+                    pyarrow.parquet.read_table(os.path.join(checkpoint_path, filename))
+                )
+
+        # Mark as recently used for eviction
+        os.utime(checkpoint_path)
+        return frames
+
+    def save(self, key, frames: dict[str, pandas.DataFrame]) -> str:
+        """Saves the frames, links `key` to them and returns their content
+        key. Frames identical to an existing checkpoint are not stored
+        twice"""
+        tmp_path = f"{self._path(key)}.tmp-{os.getpid()}"
+        os.makedirs(tmp_path, exist_ok=True)
+        sha256 = hashlib.sha256(CHECKPOINT_VERSION.encode())
+        try:
+            for name, frame in sorted(frames.items()):
+                frame_path = os.path.join(tmp_path, f"{name}.parquet")
+                pyarrow.parquet.write_table(_to_table(frame), frame_path)
+                sha256.update(f"{name}:{file_digest(frame_path)}".encode())
+        except Exception:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+
+        content_key = sha256.hexdigest()
+        checkpoint_path = self._path(content_key)
+        if os.path.isdir(checkpoint_path):
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            os.utime(checkpoint_path)
+        else:
+            os.replace(tmp_path, checkpoint_path)
+        self.link(key, content_key)
+        self.evict()
+        return content_key
+
+    def _checkpoints(self):
+        """Returns (last used time, size, path) of every checkpoint"""
+        checkpoints = list()
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_dir() and ".tmp-" not in entry.name:
+                size = sum(
+                    os.path.getsize(os.path.join(entry.path, filename))
+                    for filename in os.listdir(entry.path)
+                )
+                checkpoints.append((entry.stat().st_mtime, size, entry.path))
+        return sorted(checkpoints)
+
+    def size(self) -> int:
+        return sum(size for _, size, _ in self._checkpoints())
+
+    def evict(self):
+        """Removes least recently used checkpoints until the cache fits in
+        `max_bytes`"""
+        checkpoints = self._checkpoints()
+        total_size = sum(size for _, size, _ in checkpoints)
+        for _, size, path in checkpoints:
+            if total_size <= self.max_bytes:
+                break
+            logger.info(f"Evicting checkpoint {os.path.basename(path)}")
+            shutil.rmtree(path, ignore_errors=True)
+            total_size -= size
+
+        # Links to evicted checkpoints are no longer useful
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(LINK_SUFFIX) and not os.path.isdir(
+                self._path(self.resolve(entry.name[: -len(LINK_SUFFIX)]))
+            ):
+                os.remove(entry.path)
+
+    def purge(self):
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+
+class CheckpointRunner:
+    """Runs a chain of processing stages, reusing the checkpoints of the
+    stages whose inputs did not change
+
+    `stage_inputs` maps every stage, in processing order, to everything it
+    depends on besides the output of the stage before it. The input key of
+    a stage hashes those inputs along with the content key of the previous
+    stage's output, so changing an input invalidates its stage and every
+    stage after it. A stage that is recomputed but produces the same output
+    as before, i.e after adding an alias of a PI without usage this month,
+    leaves the input keys of later stages unchanged, and they are reused.
+
+    Of the stages that can be reused in a row, only the last one is loaded,
+    and the ones before it are skipped entirely. Frames that later steps
+    still need from a skipped stage can be requested, and are then loaded
+    on their own.
+    """
+
+    def __init__(self, checkpoint_cache: CheckpointCache | None, stage_inputs: dict):
+        self.checkpoint_cache = checkpoint_cache
+        self.stage_inputs = stage_inputs
+        self.stages = list(stage_inputs)
+        self.input_keys = dict()
+        self.output_keys = dict()
+        # How each stage run so far was handled
+        self.statuses = dict()
+        self._last_reused = self._find_last_reused(0)
+        if self._last_reused is not None:
+            logger.info(
+                f"Resuming processing from {self.stages[self._last_reused]} checkpoint"
+            )
+
+    def _key(self, stage, previous_output_key, stage_inputs=None):
+        stage_inputs = stage_inputs or self.stage_inputs
+        return self.checkpoint_cache.key(
+            stage, previous_output_key, *stage_inputs[stage]
+        )
+
+    def _previous_output_key(self, index):
+        return self.output_keys[self.stages[index - 1]] if index else None
+
+    def _find_last_reused(self, start):
+        """Returns the index of the last of the stages from `start` on that
+        can be reused in a row, if any, and looks up their keys"""
+        if self.checkpoint_cache is None:
+            return None
+
+        last_reused = None
+        previous_key = self._previous_output_key(start)
+        for index in range(start, len(self.stages)):
+            stage = self.stages[index]
+            key = self._key(stage, previous_key)
+            if not self.checkpoint_cache.has(key):
+                break
+            self.input_keys[stage] = key
+            previous_key = self.output_keys[stage] = self.checkpoint_cache.resolve(key)
+            last_reused = index
+        return last_reused
+
+    def is_loaded(self, stage) -> bool:
+        return self.statuses.get(stage) == LOADED
+
+    def run_stage(self, stage, process, needed_if_skipped=()):
+        """Returns the frames produced by `stage`
+
+        `process` is called to compute the frames, as a dict of dataframes,
+        unless the stage is skipped or loaded from its checkpoint.
+        """
+        index = self.stages.index(stage)
+        if self._last_reused is not None and index <= self._last_reused:
+            key = self.input_keys[stage]
+            if index < self._last_reused:
+                self.statuses[stage] = SKIPPED
+                if needed_if_skipped:
+                    return self.checkpoint_cache.load(key, needed_if_skipped)
+                return dict()
+            self.statuses[stage] = LOADED
+            return self.checkpoint_cache.load(key)
+
+        frames = process()
+        self.statuses[stage] = RECOMPUTED
+        if self.checkpoint_cache is not None:
+            key = self.input_keys[stage] = self._key(
+                stage, self._previous_output_key(index)
+            )
+            self.output_keys[stage] = self.checkpoint_cache.save(key, frames)
+            # Later stages may still be reused if the output did not change
+            self._last_reused = self._find_last_reused(index + 1)
+            if self._last_reused is not None:
+                logger.info(
+                    f"{stage} output is unchanged, resuming processing from {self.stages[self._last_reused]} checkpoint"
+                )
+        return frames
+
+    def run_processor(self, stage, processor, saved_attributes=()):
+        """Runs `processor` as `stage`. `data` and `saved_attributes` are
+        checkpointed, and restored onto the processor when the stage is
+        loaded. Only `saved_attributes` are restored for a skipped stage."""
+
+        def process():
+            processor.process()
+            return {
+                name: getattr(processor, name) for name in ["data", *saved_attributes]
+            }
+
+        frames = self.run_stage(stage, process, saved_attributes)
+        for name, frame in frames.items():
+            setattr(processor, name, frame)
+
+    def link_inputs(self, stage_inputs: dict):
+        """Links the input keys the stages would have with `stage_inputs`
+        to the checkpoints of this run, once every stage has run. Used when
+        those inputs are known to produce the same results"""
+        for index, stage in enumerate(self.stages):
+            self.checkpoint_cache.link(
+                self._key(stage, self._previous_output_key(index), stage_inputs),
+                self.output_keys[stage],
+            )
+
+    def log_summary(self):
+        for stage in self.stages:
+            logger.info(f"{stage}: {self.statuses.get(stage, 'not run')}")
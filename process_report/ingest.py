@@ -0,0 +1,180 @@
+import concurrent.futures
+import logging
+
+import numpy
+import pandas
+import pyarrow
+from pyarrow import csv as pyarrow_csv
+
+from process_report.invoices import invoice
+
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+
+PANDAS_ENGINE = "pandas"
+ARROW_ENGINE = "arrow"
+INGEST_ENGINES = [PANDAS_ENGINE, ARROW_ENGINE]
+
+COST_TYPE = pyarrow.decimal128(12, 2)
+IDENTIFIER_TYPE = pyarrow.dictionary(pyarrow.int32(), pyarrow.string())
+
+# Declared types of the columns of the service invoices. Identifiers repeat
+# on almost every row, so they are dictionary-encoded while parsing and
+# concatenating, and money is kept as a decimal so no precision is lost. SU
+# hours are inferred, as by the pandas engine, so whole hours stay integers
+INVOICE_SCHEMA = {
+    invoice.INVOICE_DATE_FIELD: IDENTIFIER_TYPE,
+    invoice.PROJECT_FIELD: IDENTIFIER_TYPE,
+    invoice.PROJECT_ID_FIELD: IDENTIFIER_TYPE,
+    invoice.PI_FIELD: IDENTIFIER_TYPE,
+    invoice.INVOICE_EMAIL_FIELD: IDENTIFIER_TYPE,
+    invoice.INVOICE_ADDRESS_FIELD: IDENTIFIER_TYPE,
+    invoice.INSTITUTION_FIELD: IDENTIFIER_TYPE,
+    invoice.INSTITUTION_ID_FIELD: IDENTIFIER_TYPE,
+    invoice.SU_TYPE_FIELD: IDENTIFIER_TYPE,
+    invoice.RATE_FIELD: pyarrow.string(),
+    invoice.COST_FIELD: COST_TYPE,
+}
+
+# Identifiers repeated on almost every row. When ingested as categoricals,
+# they stay dictionary-encoded through processing, so filters, comparisons
+# and group-bys work on integer codes, and each distinct value is only
+# stored, hashed and transformed once. Identifier columns derived from them
+# during processing (the institution, project and prepay group name) are
+# encoded too. The ingested institution is not, since it is replaced by the
+# PI's institution, and is only kept as is for projects without a PI
+CATEGORICAL_FIELDS = [
+    invoice.INVOICE_DATE_FIELD,
+    invoice.PROJECT_FIELD,
+    invoice.PI_FIELD,
+    invoice.SU_TYPE_FIELD,
+]
+
+
+def is_encoded(dataframe: pandas.DataFrame) -> bool:
+    """Whether the identifiers of the dataframe are categoricals, in which
+    case identifier columns added during processing are encoded too"""
+    return any(
+        isinstance(dataframe[field].dtype, pandas.CategoricalDtype)
+        for field in CATEGORICAL_FIELDS
+        if field in dataframe
+    )
+
+
+def encode_identifiers(dataframe: pandas.DataFrame) -> pandas.DataFrame:
+    return dataframe.astype(
+        {field: "category" for field in CATEGORICAL_FIELDS if field in dataframe}
+    )
+
+
+def decode_identifiers(dataframe: pandas.DataFrame) -> pandas.DataFrame:
+    """Returns the dataframe with its categorical columns as object columns,
+    which are faster to write out in many small pieces"""
+    return dataframe.astype(
+        {
+            field: object
+            for field, dtype in dataframe.dtypes.items()
+            if isinstance(dtype, pandas.CategoricalDtype)
+        }
+    )
+
+
+def _read_invoice_csv_pandas(file):
+    return pandas.read_csv(
+        file,
+        dtype={
+            invoice.COST_FIELD: pandas.ArrowDtype(COST_TYPE),
+            invoice.RATE_FIELD: str,
+        },
+    )
+
+
+def _read_invoice_csv_arrow(file, use_threads=True):
+    return pyarrow_csv.read_csv(
+        file,
+        read_options=pyarrow_csv.ReadOptions(use_threads=use_threads),
+        convert_options=pyarrow_csv.ConvertOptions(
+            column_types=INVOICE_SCHEMA,
+            strings_can_be_null=True,
+        ),
+    )
+
+
+def _arrow_types_mapper(arrow_type):
+    """Keeps decimals as pyarrow-backed columns, like the pandas engine does"""
+    if pyarrow.types.is_decimal(arrow_type):
+        return pandas.ArrowDtype(arrow_type)
+    return None
+
+
+def _missing_as_nan(dataframe: pandas.DataFrame) -> pandas.DataFrame:
+    """Arrow's null strings become None, where pandas reads missing values
+    as NaN. They are replaced so both engines give the same dataframe, and
+    processors converting them to strings see the same values"""
+    for field, dtype in dataframe.dtypes.items():
+        if dtype == object and (is_missing := dataframe[field].isna()).any():
+            dataframe[field] = dataframe[field].mask(is_missing, numpy.nan)
+    return dataframe
+
+
+def _decode_dictionaries(table: pyarrow.Table, keep_fields=()) -> pyarrow.Table:
+    """Decodes dictionary columns into plain strings, so the resulting
+    dataframe has the same object columns the processors expect. Columns in
+    `keep_fields` stay encoded, and become categoricals"""
+    for i, field in enumerate(table.schema):
+        if pyarrow.types.is_dictionary(field.type) and field.name not in keep_fields:
+            table = table.set_column(
+                i, field.name, table.column(i).cast(field.type.value_type)
+            )
+    return table
+
+
+def read_invoice_table(files, max_workers=None) -> pyarrow.Table:
+    """Reads all invoice CSVs in parallel into a single Arrow table
+
+    Each file is parsed by pyarrow's multithreaded CSV reader with the
+    declared `INVOICE_SCHEMA`. The tables are then concatenated without
+    copying their buffers. Columns missing from some files are filled with
+    nulls, and columns inferred with different types are promoted.
+    """
+    if not files:
+        raise ValueError("No invoice files to merge")
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        tables = list(executor.map(_read_invoice_csv_arrow, files))
+
+    return pyarrow.concat_tables(tables, promote_options="permissive")
+
+
+def merge_invoices(
+    files, engine=PANDAS_ENGINE, max_workers=None, categorical_identifiers=False
+):
+    """Merge multiple invoice CSV files and return a single pandas dataframe
+
+    With `categorical_identifiers`, the `CATEGORICAL_FIELDS` are returned as
+    categoricals instead of object columns"""
+    if engine == PANDAS_ENGINE:
+        dataframes = [_read_invoice_csv_pandas(file) for file in files]
+        merged_dataframe = pandas.concat(dataframes, ignore_index=True)
+        merged_dataframe.reset_index(drop=True, inplace=True)
+        if categorical_identifiers:
+            merged_dataframe = encode_identifiers(merged_dataframe)
+        return merged_dataframe
+    elif engine == ARROW_ENGINE:
+        table = read_invoice_table(files, max_workers)
+        logger.info(f"Read {table.num_rows} invoice rows from {len(files)} files")
+        # The files' dictionaries are unified when converted to categoricals
+        merged_dataframe = _decode_dictionaries(
+            table, CATEGORICAL_FIELDS if categorical_identifiers else ()
+        ).to_pandas(types_mapper=_arrow_types_mapper, split_blocks=True)
+        merged_dataframe = _missing_as_nan(merged_dataframe)
+        if categorical_identifiers:
+            # Identifier columns missing from every file are not dictionaries
+            merged_dataframe = encode_identifiers(merged_dataframe)
+        return merged_dataframe
+    else:
+        raise ValueError(
+            f"Unknown ingest engine {engine}, must be one of {INGEST_ENGINES}"
+        )
@@ -0,0 +1,163 @@
+import os
+import sys
+import json
+import time
+import cProfile
+import datetime
+import resource
+import threading
+import contextlib
+import tracemalloc
+from dataclasses import dataclass, asdict, field
+
+
+@dataclass
+class StageMetrics:
+    """Metrics of one stage, i.e `_prepare`, of a processor or invoice
+
+    `peak_memory_delta_bytes` is how much the stage raised the peak memory
+    above the memory in use when it started. It is measured by tracemalloc
+    if tracing (i.e with `python -X tracemalloc`), which only counts Python
+    and numpy allocations. Otherwise it is how much the stage raised the
+    process's peak RSS, which is 0 for stages staying below an earlier peak.
+
+    `cpu_seconds` is the user and system CPU time used by the process while
+    the stage ran, including the threads it started, i.e pyarrow's reader
+    threads, and the child processes that finished and were waited for, i.e
+    forked invoices. Stages running concurrently count each other's CPU time.
+
+    `invoice_month` is the month the stage ran for, if any, which tells the
+    stages of each month apart when processing a range of months.
+    """
+
+    component: str
+    stage: str
+    rows_in: int | None = None
+    rows_out: int | None = None
+    wall_seconds: float = 0.0
+    cpu_seconds: float = 0.0
+    peak_memory_delta_bytes: int = 0
+    memory_source: str = ""
+    invoice_month: str | None = None
+
+
+@dataclass
+class RunReport:
+    """Metrics of every stage run by this process, in the order they
+    finished"""
+
+    started_at: str = field(
+        default_factory=lambda: datetime.datetime.now().isoformat(timespec="seconds")
+    )
+    stages: list[StageMetrics] = field(default_factory=list)
+    # Whether each processing stage was reused from its checkpoint
+    stage_reuse: dict[str, str] = field(default_factory=dict)
+    profile_dir: str | None = None
+
+    def __post_init__(self):
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+
+    def add(self, metrics: StageMetrics):
+        with self._lock:
+            self.stages.append(metrics)
+
+    def to_dict(self) -> dict:
+        return {
+            "started_at": self.started_at,
+            "elapsed_seconds": time.perf_counter() - self._start,
+            "stages": [asdict(metrics) for metrics in self.stages],
+            "stage_reuse": self.stage_reuse,
+        }
+
+    def write(self, report_path):
+        with open(report_path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+            f.write("\n")
+
+
+_run_report = RunReport()
+
+# cProfile allows one profiler at a time, and tracemalloc's peak is process
+# wide, so stages running concurrently on threads are run one at a time
+# while profiling or tracing. Stages are not nested
+_exclusive_stage_lock = threading.Lock()
+
+
+def get_run_report() -> RunReport:
+    return _run_report
+
+
+def enable_profiling(profile_dir):
+    """Dumps a cProfile of every stage to `profile_dir`, named
+    `<component>.<stage>.<invoice_month>.prof`, which `snakeviz` or
+    `flameprof` turn into flame graphs. Stages running concurrently on
+    threads then run one at a time"""
+    os.makedirs(profile_dir, exist_ok=True)
+    _run_report.profile_dir = profile_dir
+
+
+def _get_max_rss_bytes() -> int:
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in kilobytes everywhere but on macOS
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+def _get_cpu_seconds() -> float:
+    """Returns the CPU time used by this process and its waited for
+    children"""
+    cpu_seconds = 0.0
+    for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+        usage = resource.getrusage(who)
+        cpu_seconds += usage.ru_utime + usage.ru_stime
+    return cpu_seconds
+
+
+def count_rows(dataframe) -> int | None:
+    return None if dataframe is None else len(dataframe)
+
+
+def _get_profile_path(metrics: StageMetrics) -> str:
+    name_parts = [metrics.component, metrics.stage]
+    if metrics.invoice_month is not None:
+        name_parts.append(metrics.invoice_month)
+    return os.path.join(_run_report.profile_dir, ".".join(name_parts) + ".prof")
+
+
+@contextlib.contextmanager
+def measure(component, stage, rows_in=None, invoice_month=None):
+    """Records the metrics of the code run in this context as `stage` of
+    `component`. The caller may set `rows_out` on the yielded metrics"""
+    metrics = StageMetrics(component, stage, rows_in, invoice_month=invoice_month)
+    profiler = None
+    if _run_report.profile_dir is not None:
+        profiler = cProfile.Profile()
+
+    is_exclusive = profiler is not None or tracemalloc.is_tracing()
+    with _exclusive_stage_lock if is_exclusive else contextlib.nullcontext():
+        if tracemalloc.is_tracing():
+            metrics.memory_source = "tracemalloc"
+            tracemalloc.reset_peak()
+            start_memory = tracemalloc.get_traced_memory()[0]
+        else:
+            metrics.memory_source = "max_rss"
+            start_memory = _get_max_rss_bytes()
+        start_cpu = _get_cpu_seconds()
+        start = time.perf_counter()
+        try:
+            if profiler is not None:
+                with profiler:
+                    yield metrics
+            else:
+                yield metrics
+        finally:
+            metrics.wall_seconds = time.perf_counter() - start
+            metrics.cpu_seconds = _get_cpu_seconds() - start_cpu
+            if tracemalloc.is_tracing():
+                end_memory = tracemalloc.get_traced_memory()[1]
+            else:
+                end_memory = _get_max_rss_bytes()
+            metrics.peak_memory_delta_bytes = max(0, end_memory - start_memory)
+            if profiler is not None:
+                profiler.dump_stats(_get_profile_path(metrics))
+            _run_report.add(metrics)
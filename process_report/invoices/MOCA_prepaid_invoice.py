@@ -27,15 +27,19 @@ class MOCAPrepaidInvoice(invoice.Invoice):
 
     @property
     def output_path(self) -> str:
-        return f"MOCA-A_Prepaid_Groups-{self.invoice_month}-Invoice.csv"
+        return (
+            f"MOCA-A_Prepaid_Groups-{self.invoice_month}-Invoice{self.output_extension}"
+        )
 
     @property
     def output_s3_key(self) -> str:
-        return f"Invoices/{self.invoice_month}/MOCA-A_Prepaid_Groups-{self.invoice_month}-Invoice.csv"
+        return f"Invoices/{self.invoice_month}/MOCA-A_Prepaid_Groups-{self.invoice_month}-Invoice{self.output_extension}"
 
     @property
     def output_s3_archive_key(self):
-        return f"Invoices/{self.invoice_month}/Archive/MOCA-A_Prepaid_Groups-{self.invoice_month}-Invoice {util.get_iso8601_time()}.csv"
+        return f"Invoices/{self.invoice_month}/Archive/MOCA-A_Prepaid_Groups-{self.invoice_month}-Invoice {util.get_iso8601_time()}{self.output_extension}"
 
     def _prepare_export(self):
-        self.data = self.data[self.data[invoice.GROUP_MANAGED_FIELD] == False]  # noqa: E712
+        self.export_data = self._select_export_data(
+            self.data[invoice.GROUP_MANAGED_FIELD] == False  # noqa: E712
+        )
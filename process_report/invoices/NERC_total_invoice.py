@@ -42,26 +42,25 @@ class NERCTotalInvoice(invoice.Invoice):
 
     @property
     def output_path(self) -> str:
-        return f"NERC-{self.invoice_month}-Total-Invoice.csv"
+        return f"NERC-{self.invoice_month}-Total-Invoice{self.output_extension}"
 
     @property
     def output_s3_key(self) -> str:
-        return (
-            f"Invoices/{self.invoice_month}/NERC-{self.invoice_month}-Total-Invoice.csv"
-        )
+        return f"Invoices/{self.invoice_month}/NERC-{self.invoice_month}-Total-Invoice{self.output_extension}"
 
     @property
     def output_s3_archive_key(self):
-        return f"Invoices/{self.invoice_month}/Archive/NERC-{self.invoice_month}-Total-Invoice {util.get_iso8601_time()}.csv"
+        return f"Invoices/{self.invoice_month}/Archive/NERC-{self.invoice_month}-Total-Invoice {util.get_iso8601_time()}{self.output_extension}"
 
     def _prepare_export(self):
         def _lower_col(data):
             if data:
                 return str.lower(data)
 
-        self.export_data = self.data[
-            self.data[invoice.IS_BILLABLE_FIELD] & ~self.data[invoice.MISSING_PI_FIELD]
-        ]
+        self.export_data = self._select_export_data(
+            self.data[invoice.IS_BILLABLE_FIELD] & ~self.data[invoice.MISSING_PI_FIELD],
+            [invoice.GROUP_MANAGED_FIELD],
+        )
         self.export_data = self.export_data[
             self.export_data[invoice.INSTITUTION_FIELD].isin(self.INCLUDED_INSTITUTIONS)
             | (self.export_data[invoice.GROUP_MANAGED_FIELD].apply(_lower_col) == "yes")
@@ -3,6 +3,7 @@ from dataclasses import dataclass
 import pandas
 import pyarrow
 
+from process_report import s3_transfer
 from process_report.invoices import invoice
 
 
@@ -16,7 +17,9 @@ class BillableInvoice(invoice.Invoice):
 
     PI_S3_FILEPATH = "PIs/PI.csv"
 
-    old_pi_filepath: str
+    # The updated old PI file is not exported if None, i.e when processing a
+    # range of months, where it is persisted once all months are processed
+    old_pi_filepath: str | None
     updated_old_pi_df: pandas.DataFrame
 
     export_columns_list = [
@@ -42,10 +45,16 @@ class BillableInvoice(invoice.Invoice):
     ]
 
     def _prepare_export(self):
-        self.export_data = self.data[
+        self.export_data = self._select_export_data(
             self.data[invoice.IS_BILLABLE_FIELD] & ~self.data[invoice.MISSING_PI_FIELD]
-        ]
-        self.updated_old_pi_df = self.updated_old_pi_df.astype(
+        )
+        self.updated_old_pi_df = self.get_old_pi_ledger(self.updated_old_pi_df)
+
+    @staticmethod
+    def get_old_pi_ledger(updated_old_pi_df: pandas.DataFrame) -> pandas.DataFrame:
+        """Returns the updated old PI file with its credits as decimals,
+        exactly as they are exported and loaded again"""
+        return updated_old_pi_df.astype(
             {
                 invoice.PI_INITIAL_CREDITS: pandas.ArrowDtype(
                     pyarrow.decimal128(21, 2)
@@ -57,8 +66,12 @@ class BillableInvoice(invoice.Invoice):
 
     def export(self):
         super().export()
-        self.updated_old_pi_df.to_csv(self.old_pi_filepath, index=False)
+        if self.old_pi_filepath is not None:
+            self.updated_old_pi_df.to_csv(self.old_pi_filepath, index=False)
 
-    def export_s3(self, s3_bucket):
-        super().export_s3(s3_bucket)
-        s3_bucket.upload_file(self.old_pi_filepath, self.PI_S3_FILEPATH)
+    def s3_uploads(self):
+        if self.old_pi_filepath is None:
+            return super().s3_uploads()
+        return super().s3_uploads() + [
+            s3_transfer.S3Upload(self.old_pi_filepath, self.PI_S3_FILEPATH)
+        ]
@@ -1,7 +1,14 @@
+import dataclasses
 from dataclasses import dataclass
+from decimal import Decimal
+import numpy
 import pandas
+import pyarrow
+import pyarrow.ipc
+import pyarrow.parquet
 
 import process_report.util as util
+from process_report import s3_transfer, instrumentation
 
 
 ### PI file field names
@@ -52,38 +59,198 @@ BALANCE_FIELD = "Balance"
 ### Internally used field names
 IS_BILLABLE_FIELD = "Is Billable"
 MISSING_PI_FIELD = "Missing PI"
+NONBILLABLE_RULE_FIELD = "Nonbillable Rule"
 PI_BALANCE_FIELD = "PI Balance"
 PROJECT_NAME_FIELD = "Project"
 GROUP_MANAGED_FIELD = "MGHPCC Managed"
 ###
 
+### Output formats
+CSV_FORMAT = "csv"
+PARQUET_FORMAT = "parquet"
+ARROW_FORMAT = "arrow"
+OUTPUT_EXTENSIONS = {
+    CSV_FORMAT: ".csv",
+    PARQUET_FORMAT: ".parquet",
+    ARROW_FORMAT: ".arrow",
+}
+OUTPUT_FORMATS = list(OUTPUT_EXTENSIONS)
+PARQUET_COMPRESSION = "zstd"
+###
+
+### Arrow types of the exported columns
+MONEY_TYPE = pyarrow.decimal128(12, 2)
+EXPORT_SCHEMA = {
+    INVOICE_DATE_FIELD: pyarrow.string(),
+    PROJECT_FIELD: pyarrow.string(),
+    PROJECT_ID_FIELD: pyarrow.string(),
+    PI_FIELD: pyarrow.string(),
+    INVOICE_EMAIL_FIELD: pyarrow.string(),
+    INVOICE_ADDRESS_FIELD: pyarrow.string(),
+    INSTITUTION_FIELD: pyarrow.string(),
+    INSTITUTION_ID_FIELD: pyarrow.string(),
+    GROUP_NAME_FIELD: pyarrow.string(),
+    GROUP_INSTITUTION_FIELD: pyarrow.string(),
+    GROUP_BALANCE_FIELD: MONEY_TYPE,
+    GROUP_BALANCE_USED_FIELD: MONEY_TYPE,
+    SU_HOURS_FIELD: pyarrow.int64(),
+    SU_TYPE_FIELD: pyarrow.string(),
+    SU_CHARGE_FIELD: pyarrow.int64(),
+    LENOVO_CHARGE_FIELD: MONEY_TYPE,
+    RATE_FIELD: pyarrow.string(),
+    COST_FIELD: MONEY_TYPE,
+    CREDIT_FIELD: MONEY_TYPE,
+    CREDIT_CODE_FIELD: pyarrow.string(),
+    SUBSIDY_FIELD: MONEY_TYPE,
+    BALANCE_FIELD: MONEY_TYPE,
+    NONBILLABLE_RULE_FIELD: pyarrow.string(),
+    PI_BALANCE_FIELD: MONEY_TYPE,
+    PROJECT_NAME_FIELD: pyarrow.string(),
+}
+###
+
+
+def _to_arrow_array(column: pandas.Series, arrow_type=None) -> pyarrow.Array:
+    """Converts a column to Arrow as `arrow_type`, keeping amounts exact
+
+    Object columns of Decimals and ints, i.e credits and balances, become
+    decimals instead of failing to convert or being rounded to floats.
+    Without `arrow_type`, their type has as many decimal places as their
+    most precise amount, and other columns are inferred.
+    """
+    if isinstance(column.dtype, pandas.CategoricalDtype):
+        column = column.astype(object)
+    is_money = arrow_type is not None and pyarrow.types.is_decimal(arrow_type)
+    if (
+        is_money
+        and (column.dtype == object or pandas.api.types.is_integer_dtype(column))
+    ) or (
+        column.dtype == object
+        and pandas.api.types.infer_dtype(column) in ("decimal", "mixed-integer")
+    ):
+        values = [None if pandas.isna(value) else value for value in column.tolist()]
+        if all(
+            value is None
+            or isinstance(value, Decimal)
+            or (isinstance(value, int) and not isinstance(value, bool))
+            for value in values
+        ):
+            if arrow_type is None:
+                scale = max(
+                    [0]
+                    + [
+                        -value.as_tuple().exponent
+                        for value in values
+                        if isinstance(value, Decimal)
+                    ]
+                )
+                arrow_type = pyarrow.decimal128(38, scale)
+            return pyarrow.array(
+                [None if value is None else Decimal(value) for value in values],
+                type=arrow_type,
+            )
+
+    if isinstance(column.dtype, pandas.ArrowDtype):
+        array = pyarrow.array(column.array)
+    else:
+        array = pyarrow.Array.from_pandas(column)
+    if arrow_type is not None and array.type != arrow_type:
+        # Raises rather than losing precision, i.e for fractional hours
+        array = array.cast(arrow_type)
+    return array
+
+
+def write_dataframe(
+    dataframe: pandas.DataFrame,
+    path,
+    output_format=CSV_FORMAT,
+    index=False,
+    schema: dict | None = None,
+):
+    """Writes the dataframe to `path` in `output_format`. With `index`, the
+    index is written as the first column, like `to_csv` does
+
+    Parquet and Arrow files give columns named in `schema` the Arrow type
+    they are mapped to, so every file exported has the same schema whatever
+    its content. Other columns are inferred."""
+    if output_format == CSV_FORMAT:
+        dataframe.to_csv(path, index=index)
+        return
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(
+            f"Unknown output format {output_format}, must be one of {OUTPUT_FORMATS}"
+        )
+
+    if index:
+        dataframe = dataframe.reset_index()
+    table = pyarrow.Table.from_arrays(
+        [
+            _to_arrow_array(column, schema.get(name) if schema else None)
+            for name, column in dataframe.items()
+        ],
+        names=[str(name) for name in dataframe.columns],
+    )
+    if output_format == PARQUET_FORMAT:
+        pyarrow.parquet.write_table(table, path, compression=PARQUET_COMPRESSION)
+    else:
+        with pyarrow.ipc.new_file(path, table.schema) as writer:
+            writer.write_table(table)
+
 
 @dataclass
 class Invoice:
     export_columns_list = list()
     exported_columns_map = dict()
 
+    # Rows sharing the same `aggregation_fields` can be rolled up into a
+    # single row by `_aggregate`, summing `aggregation_sum_fields`
+    aggregation_fields = list()
+    aggregation_sum_fields = list()
+
+    # Names of the invoices that must be processed and exported before this
+    # one, when invoices are run as a pipeline. Invoices only read the
+    # processed data, so they are independent by default
+    depends_on = list()
+
     name: str
     invoice_month: str
     data: pandas.DataFrame
+    output_format: str = dataclasses.field(default=CSV_FORMAT, kw_only=True)
     export_data = None
 
     def process(self):
-        self._prepare()
-        self._process()
-        self._prepare_export()
+        for stage in [self._prepare, self._process, self._prepare_export]:
+            self.run_stage(stage)
+
+    def run_stage(self, stage, *args):
+        """Runs one stage of the invoice, recording its metrics in the run
+        report. Rows out are counted from `export_data` once it is set"""
+        with instrumentation.measure(
+            type(self).__name__,
+            stage.__name__,
+            instrumentation.count_rows(self.data),
+            self.invoice_month,
+        ) as metrics:
+            stage(*args)
+            metrics.rows_out = instrumentation.count_rows(
+                self.data if self.export_data is None else self.export_data
+            )
+
+    @property
+    def output_extension(self) -> str:
+        return OUTPUT_EXTENSIONS[self.output_format]
 
     @property
     def output_path(self) -> str:
-        return f"{self.name} {self.invoice_month}.csv"
+        return f"{self.name} {self.invoice_month}{self.output_extension}"
 
     @property
     def output_s3_key(self) -> str:
-        return f"Invoices/{self.invoice_month}/{self.name} {self.invoice_month}.csv"
+        return f"Invoices/{self.invoice_month}/{self.name} {self.invoice_month}{self.output_extension}"
 
     @property
     def output_s3_archive_key(self):
-        return f"Invoices/{self.invoice_month}/Archive/{self.name} {self.invoice_month} {util.get_iso8601_time()}.csv"
+        return f"Invoices/{self.invoice_month}/Archive/{self.name} {self.invoice_month} {util.get_iso8601_time()}{self.output_extension}"
 
     def _prepare(self):
         """Prepares the data for processing.
@@ -109,16 +276,103 @@ class Invoice:
         that should or should not be exported after processing."""
         pass
 
+    def _aggregate(self, dataframe: pandas.DataFrame) -> pandas.DataFrame:
+        """Rolls up rows sharing the same `aggregation_fields` into one row.
+
+        Each rolled up row keeps the other fields of the first row it
+        replaces, like `drop_duplicates`, while `aggregation_sum_fields` are
+        summed over all of its rows. Sums are computed in a single grouped
+        aggregation."""
+        first_rows = dataframe.drop_duplicates(self.aggregation_fields)
+        if first_rows.empty or not self.aggregation_sum_fields:
+            return first_rows
+
+        # Arrow-backed columns are grouped as Python objects, since pandas
+        # would otherwise sum them one group at a time
+        sum_data = dataframe[self.aggregation_sum_fields].astype(
+            {
+                field: object
+                for field in self.aggregation_sum_fields
+                if isinstance(dataframe[field].dtype, pandas.ArrowDtype)
+            }
+        )
+        sums = sum_data.groupby(
+            [dataframe[field] for field in self.aggregation_fields],
+            sort=False,
+            dropna=False,
+            observed=True,
+        ).sum()
+        if len(self.aggregation_fields) > 1:
+            group_keys = pandas.MultiIndex.from_frame(
+                first_rows[self.aggregation_fields]
+            )
+        else:
+            group_keys = pandas.Index(first_rows[self.aggregation_fields[0]])
+        sums = sums.reindex(group_keys)
+
+        first_rows = first_rows.copy()
+        for field in self.aggregation_sum_fields:
+            # Assign into the existing column to keep its dtype
+            first_rows.loc[:, field] = sums[field].to_numpy()
+        return first_rows
+
+    def _select_export_data(self, row_mask, extra_columns=()) -> pandas.DataFrame:
+        """Returns the rows selected by `row_mask`, keeping only the columns
+        needed for export. Columns only used to prepare the export are passed
+        in `extra_columns`
+
+        Each needed column is taken on its own, so neither the other columns
+        nor the other columns sharing a block with it are copied.
+        """
+        needed_columns = set(
+            self.export_columns_list + self.aggregation_fields + list(extra_columns)
+        )
+        row_positions = numpy.flatnonzero(numpy.asarray(row_mask))
+        return pandas.DataFrame(
+            {
+                column: self.data[column].array.take(row_positions)
+                for column in self.data.columns
+                if column in needed_columns
+            },
+            index=self.data.index.take(row_positions),
+            copy=False,
+        )
+
     def _filter_columns(self):
         """Filters and renames columns before exporting"""
         self.export_data = self.export_data[self.export_columns_list].rename(
             columns=self.exported_columns_map
         )
 
+    @property
+    def export_schema(self) -> dict:
+        """Arrow types of the exported columns, under their exported names"""
+        return {
+            self.exported_columns_map.get(field, field): EXPORT_SCHEMA[field]
+            for field in self.export_columns_list
+            if field in EXPORT_SCHEMA
+        }
+
     def export(self):
         self._filter_columns()
-        self.export_data.to_csv(self.output_path, index=False)
+        write_dataframe(
+            self.export_data,
+            self.output_path,
+            self.output_format,
+            schema=self.export_schema,
+        )
+
+    def s3_uploads(self) -> list[s3_transfer.S3Upload]:
+        """Returns the exported files to upload to S3, along with their
+        archive keys"""
+        return [
+            s3_transfer.S3Upload(
+                self.output_path, self.output_s3_key, self.output_s3_archive_key
+            )
+        ]
 
     def export_s3(self, s3_bucket):
-        s3_bucket.upload_file(self.output_path, self.output_s3_key)
-        s3_bucket.upload_file(self.output_path, self.output_s3_archive_key)
+        self.run_stage(self._upload_to_s3, s3_bucket)
+
+    def _upload_to_s3(self, s3_bucket):
+        util.upload_to_s3_bucket(self.s3_uploads(), s3_bucket)
@@ -1,8 +1,13 @@
+import logging
 from dataclasses import dataclass
 
 import process_report.invoices.invoice as invoice
 
 
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+
 @dataclass
 class NonbillableInvoice(invoice.Invoice):
     nonbillable_pis: list[str]
@@ -24,4 +29,13 @@ class NonbillableInvoice(invoice.Invoice):
     ]
 
     def _prepare_export(self):
-        self.export_data = self.data[~self.data[invoice.IS_BILLABLE_FIELD]]
+        self.export_data = self._select_export_data(
+            ~self.data[invoice.IS_BILLABLE_FIELD],
+            extra_columns=[invoice.NONBILLABLE_RULE_FIELD],
+        )
+        if invoice.NONBILLABLE_RULE_FIELD in self.export_data:
+            rule_counts = self.export_data[
+                invoice.NONBILLABLE_RULE_FIELD
+            ].value_counts()
+            for rule, count in rule_counts.items():
+                logger.info(f"{rule}: excluded {count} rows")
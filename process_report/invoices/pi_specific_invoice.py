@@ -1,10 +1,16 @@
 import os
+import time
+import logging
+import concurrent.futures
 from dataclasses import dataclass
 
-import pandas
-
 import process_report.invoices.invoice as invoice
 import process_report.util as util
+from process_report import s3_transfer, ingest
+
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
 
 
 @dataclass
@@ -37,39 +43,84 @@ class PIInvoice(invoice.Invoice):
         invoice.BALANCE_FIELD,
     ]
 
+    # Maximum number of PI invoices written concurrently
+    export_max_workers = 8
+
+    # Filenames of the PI invoices written by `export`, in the folder
+    exported_files = None
+
     def _prepare(self):
-        self.export_data = self.data[
+        self.export_data = self._select_export_data(
             self.data[invoice.IS_BILLABLE_FIELD] & ~self.data[invoice.MISSING_PI_FIELD]
-        ]
+        )
         self.pi_list = self.export_data[invoice.PI_FIELD].unique()
 
     def export(self):
-        def _export_pi_invoice(pi):
-            if pandas.isna(pi):
-                return
-            pi_projects = self.export_data[self.export_data[invoice.PI_FIELD] == pi]
+        schema = self.export_schema
+
+        def _export_pi_invoice(pi, pi_projects):
             pi_instituition = pi_projects[invoice.INSTITUTION_FIELD].iat[0]
-            pi_projects.to_csv(
-                f"{self.name}/{pi_instituition}_{pi} {self.invoice_month}.csv"
+            filename = (
+                f"{pi_instituition}_{pi} {self.invoice_month}{self.output_extension}"
+            )
+            invoice.write_dataframe(
+                pi_projects,
+                f"{self.name}/{filename}",
+                self.output_format,
+                index=True,
+                schema=schema,
             )
+            return filename
 
         self._filter_columns()
+        # Encoded identifiers are decoded once, instead of for every PI
+        self.export_data = ingest.decode_identifiers(self.export_data)
         if not os.path.exists(
             self.name
         ):  # self.name is name of folder storing invoices
             os.mkdir(self.name)
 
-        for pi in self.pi_list:
-            _export_pi_invoice(pi)
+        # Split the invoice by PI in a single pass. PIs that are missing are
+        # not exported
+        start = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(self.export_max_workers) as executor:
+            futures = [
+                executor.submit(_export_pi_invoice, pi, pi_projects)
+                for pi, pi_projects in self.export_data.groupby(
+                    invoice.PI_FIELD, sort=False
+                )
+            ]
+            self.exported_files = [future.result() for future in futures]
+
+        export_time = time.perf_counter() - start
+        logger.info(
+            f"Exported {len(futures)} PI invoices in {export_time:.2f}s ({len(futures) / max(export_time, 1e-9):.0f} files/sec)"
+        )
 
-    def export_s3(self, s3_bucket):
-        def _export_s3_pi_invoice(pi_invoice):
+    def s3_uploads(self):
+        def _pi_invoice_upload(pi_invoice):
             pi_invoice_path = os.path.join(self.name, pi_invoice)
             striped_invoice_path = os.path.splitext(pi_invoice_path)[0]
-            output_s3_path = f"Invoices/{self.invoice_month}/{striped_invoice_path}.csv"
-            output_s3_archive_path = f"Invoices/{self.invoice_month}/Archive/{striped_invoice_path} {util.get_iso8601_time()}.csv"
-            s3_bucket.upload_file(pi_invoice_path, output_s3_path)
-            s3_bucket.upload_file(pi_invoice_path, output_s3_archive_path)
+            output_s3_path = f"Invoices/{self.invoice_month}/{striped_invoice_path}{self.output_extension}"
+            output_s3_archive_path = f"Invoices/{self.invoice_month}/Archive/{striped_invoice_path} {util.get_iso8601_time()}{self.output_extension}"
+            return s3_transfer.S3Upload(
+                pi_invoice_path, output_s3_path, output_s3_archive_path
+            )
+
+        return [
+            _pi_invoice_upload(pi_invoice) for pi_invoice in self._get_exported_files()
+        ]
 
-        for pi_invoice in os.listdir(self.name):
-            _export_s3_pi_invoice(pi_invoice)
+    def _get_exported_files(self) -> list[str]:
+        """Returns the PI invoices of this month and output format in the
+        folder, which may also hold those of other months, i.e when
+        processing a range of months, or of other formats from earlier
+        runs. When exported in a forked process, this object does not know
+        which files were written, so they are found by their name"""
+        if self.exported_files is not None:
+            return self.exported_files
+        return sorted(
+            filename
+            for filename in os.listdir(self.name)
+            if filename.endswith(f" {self.invoice_month}{self.output_extension}")
+        )
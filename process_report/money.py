@@ -0,0 +1,144 @@
+from decimal import Decimal
+
+import numpy
+import pandas
+import pyarrow
+
+
+CENTS_PER_UNIT = 100
+MAX_SCALE = 2
+
+# Amounts are kept small enough that sums and differences of all the amounts
+# of a column never overflow an int64
+MAX_TOTAL_CENTS = 2**62
+
+ARROW_CENTS_TYPE = pyarrow.decimal128(38, MAX_SCALE)
+
+
+def _arrow_to_cents(values: pyarrow.Array) -> numpy.ndarray:
+    if isinstance(values, pyarrow.ChunkedArray):
+        values = values.combine_chunks()
+    if values.null_count:
+        raise ValueError("Missing amounts cannot be converted to cents")
+    # Raises if an amount has fractions of cents
+    values = values.cast(ARROW_CENTS_TYPE)
+
+    # A decimal128 is stored as a little-endian 128 bit integer of cents.
+    # It fits an int64 if its high word only extends the low word's sign
+    words = numpy.frombuffer(values.buffers()[1], dtype=numpy.int64).reshape(-1, 2)
+    words = words[values.offset : values.offset + len(values)]
+    if (words[:, 1] != words[:, 0] >> 63).any():
+        raise ValueError("Amounts do not fit in int64 cents")
+    return words[:, 0].copy()
+
+
+def _object_to_cents(values) -> tuple[numpy.ndarray, numpy.ndarray]:
+    cents = numpy.empty(len(values), dtype=numpy.int64)
+    scales = numpy.zeros(len(values), dtype=numpy.int8)
+    try:
+        for i, value in enumerate(values):
+            if isinstance(value, Decimal):
+                exponent = value.as_tuple().exponent
+                if not (value.is_finite() and -MAX_SCALE <= exponent <= 0):
+                    raise ValueError(f"Amount {value} is not a whole number of cents")
+                cents[i] = int(value.scaleb(MAX_SCALE))
+                scales[i] = -exponent
+            elif isinstance(value, (int, numpy.integer)) and not isinstance(
+                value, bool
+            ):
+                cents[i] = int(value) * CENTS_PER_UNIT
+            else:
+                raise ValueError(f"Amount {value!r} is not exact")
+    except OverflowError:
+        raise ValueError("Amounts do not fit in int64 cents")
+    return cents, scales
+
+
+def _cents_to_arrow(cents: numpy.ndarray) -> pyarrow.Array:
+    words = numpy.empty((len(cents), 2), dtype=numpy.int64)
+    words[:, 0] = cents
+    words[:, 1] = cents >> 63
+    return pyarrow.Array.from_buffers(
+        ARROW_CENTS_TYPE, len(cents), [None, pyarrow.py_buffer(words)]
+    )
+
+
+def to_cents(values) -> tuple[numpy.ndarray, numpy.ndarray]:
+    """Converts exact amounts (ints, Decimals or Arrow decimals) to int64
+    cents, without any rounding
+
+    Also returns the scale of each amount, the number of decimal places it is
+    written with, since Decimal arithmetic keeps them: `Decimal("1.50") - 1`
+    is written `0.50`. Raises ValueError for missing or inexact (i.e float)
+    amounts, and for amounts with fractions of cents.
+    """
+    if not isinstance(values, (pandas.Series, pandas.Index, numpy.ndarray)):
+        values = numpy.asarray(values, dtype=object)
+    dtype = values.dtype
+
+    if isinstance(dtype, pandas.ArrowDtype):
+        arrow_type = dtype.pyarrow_dtype
+        if pyarrow.types.is_integer(arrow_type):
+            arrow_type = pyarrow.decimal128(38, 0)
+        elif not pyarrow.types.is_decimal(arrow_type):
+            raise ValueError(f"Amounts of type {arrow_type} are not exact")
+        if arrow_type.scale > MAX_SCALE:
+            raise ValueError(f"Amounts with {arrow_type.scale} decimals are not cents")
+        cents = _arrow_to_cents(pyarrow.array(values).cast(arrow_type))
+        scales = numpy.full(len(cents), arrow_type.scale, dtype=numpy.int8)
+    elif pandas.api.types.is_integer_dtype(dtype):
+        integers = numpy.asarray(values, dtype=numpy.int64)
+        if len(integers) and numpy.abs(integers).max() >= MAX_TOTAL_CENTS // 100:
+            raise ValueError("Amounts do not fit in int64 cents")
+        cents = integers * CENTS_PER_UNIT
+        scales = numpy.zeros(len(cents), dtype=numpy.int8)
+    elif dtype == object:
+        if pandas.api.types.infer_dtype(values, skipna=False) == "integer":
+            try:
+                return to_cents(numpy.asarray(values, dtype=numpy.int64))
+            except OverflowError:
+                raise ValueError("Amounts do not fit in int64 cents")
+        cents, scales = _object_to_cents(values)
+    else:
+        raise ValueError(f"Amounts of dtype {dtype} are not exact")
+
+    # Summed as floats, which cannot overflow
+    if numpy.abs(cents).sum(dtype=float) >= MAX_TOTAL_CENTS:
+        raise ValueError("Sums of amounts do not fit in int64 cents")
+    return cents, scales
+
+
+def from_cents(cents: numpy.ndarray, scales: numpy.ndarray, dtype):
+    """Converts int64 cents back to amounts stored like a column of `dtype`
+
+    Arrow decimal columns get an Arrow array, and integer columns get
+    integers if every amount is a whole number. Otherwise amounts are
+    Decimals written with their `scales`, or ints where their scale is 0,
+    exactly like the amounts Decimal arithmetic would have produced.
+    """
+    if isinstance(dtype, pandas.ArrowDtype) and pyarrow.types.is_decimal(
+        dtype.pyarrow_dtype
+    ):
+        return pandas.arrays.ArrowExtensionArray(
+            _cents_to_arrow(cents).cast(dtype.pyarrow_dtype)
+        )
+
+    units, remainders = numpy.divmod(cents, CENTS_PER_UNIT)
+    if pandas.api.types.is_integer_dtype(dtype) and not (
+        scales.any() or remainders.any()
+    ):
+        return units
+
+    amounts = units.astype(object)
+    # Arrow converts two decimal amounts to Decimals much faster than Python
+    is_decimal = scales == MAX_SCALE
+    amounts[is_decimal] = _cents_to_arrow(cents[is_decimal]).to_numpy(
+        zero_copy_only=False
+    )
+    for i in numpy.flatnonzero((scales > 0) & ~is_decimal):
+        amounts[i] = (
+            Decimal(int(cents[i]))
+            .scaleb(-MAX_SCALE)
+            .quantize(Decimal(1).scaleb(-int(scales[i])))
+        )
+    return amounts
@@ -0,0 +1,100 @@
+import re
+import fnmatch
+
+import numpy
+import pandas
+
+from process_report.invoices import invoice
+
+
+PI_RULE = "PI"
+PROJECT_RULE = "Project"
+TIMED_PROJECT_RULE = "Timed project"
+# Entries are only glob patterns with this prefix, since PI and project
+# names may themselves contain glob characters
+GLOB_PREFIX = "glob:"
+
+
+class _RuleSet:
+    """Entries of the nonbillable files matched against one column
+
+    Plain entries are looked up in a dict, and entries starting with
+    `GLOB_PREFIX` are compiled into a single regex, with one named group per
+    entry to tell which one matched. With `casefold`, entries and values are
+    casefolded first.
+    """
+
+    def __init__(self, entries: list[tuple[str, str]], casefold: bool):
+        self.casefold = casefold
+        self.exact_rules = dict()
+        self.glob_rules = list()
+        glob_patterns = list()
+        for entry, rule_type in entries:
+            rule = f"{rule_type} {entry}"
+            key = entry.casefold() if casefold else entry
+            if entry.startswith(GLOB_PREFIX):
+                pattern = fnmatch.translate(key[len(GLOB_PREFIX) :])
+                glob_patterns.append(f"(?P<g{len(self.glob_rules)}>{pattern})")
+                self.glob_rules.append(rule)
+            else:
+                # The first entry of a name is the rule reported for it
+                self.exact_rules.setdefault(key, rule)
+
+        self.glob_regex = re.compile("|".join(glob_patterns)) if glob_patterns else None
+
+    def _match_value(self, value) -> str | None:
+        if not isinstance(value, str):
+            return None
+        key = value.casefold() if self.casefold else value
+        if (rule := self.exact_rules.get(key)) is not None:
+            return rule
+        if self.glob_regex is not None and (match := self.glob_regex.match(key)):
+            return self.glob_rules[int(match.lastgroup[1:])]
+        return None
+
+    def match(self, values: pandas.Series) -> numpy.ndarray:
+        """Returns the rule matching each value, or None. Each distinct
+        value is only matched once"""
+        codes, uniques = pandas.factorize(values)
+        unique_rules = numpy.array(
+            [self._match_value(value) for value in uniques] + [None], dtype=object
+        )
+        # Missing values have code -1, the trailing None
+        return unique_rules[codes]
+
+
+class NonbillableMatcher:
+    """Finds the nonbillable rows of an invoice, and the rule excluding each
+
+    Built once from the nonbillable PIs, nonbillable projects and the month's
+    timed projects. PIs are matched exactly, and projects by their casefolded
+    name. Entries prefixed with `GLOB_PREFIX`, i.e `glob:test-*`, match every
+    PI or project matching the glob pattern, while other entries are always
+    matched literally, even if they contain glob characters.
+
+    A row matched by several entries reports a PI rule over any project
+    rule, and an exact entry over any glob entry. Otherwise the first
+    matching entry is reported, in file order with the nonbillable projects
+    before the timed projects. Rules read like "PI alice@example.com" or
+    "Timed project foo".
+    """
+
+    def __init__(self, nonbillable_pis, nonbillable_projects, timed_projects=()):
+        self.pi_rules = _RuleSet(
+            [(pi, PI_RULE) for pi in nonbillable_pis], casefold=False
+        )
+        self.project_rules = _RuleSet(
+            [(project, PROJECT_RULE) for project in nonbillable_projects]
+            + [(project, TIMED_PROJECT_RULE) for project in timed_projects],
+            casefold=True,
+        )
+
+    def match(self, data: pandas.DataFrame) -> pandas.Series:
+        """Returns the rule excluding each row of `data`, or None for
+        billable rows"""
+        rules = self.pi_rules.match(data[invoice.PI_FIELD])
+        is_unmatched = pandas.isna(rules)
+        rules[is_unmatched] = self.project_rules.match(data[invoice.PROJECT_FIELD])[
+            is_unmatched
+        ]
+        return pandas.Series(rules, index=data.index, dtype=object)
@@ -0,0 +1,211 @@
+import time
+import logging
+import multiprocessing
+import concurrent.futures
+from dataclasses import dataclass, field
+from typing import Callable
+
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+
+DEFAULT_MAX_WORKERS = 4
+
+# Nodes of the pipeline being run, inherited by forked worker processes
+_forked_nodes = dict()
+
+
+def can_fork() -> bool:
+    return "fork" in multiprocessing.get_all_start_methods()
+
+
+def _run_node(nodes, name):
+    node_start = time.perf_counter()
+    result = nodes[name].run()
+    return node_start, time.perf_counter(), result
+
+
+def _run_forked_node(name):
+    return _run_node(_forked_nodes, name)
+
+
+@dataclass
+class Node:
+    name: str
+    run: Callable[[], object]
+    depends_on: list[str] = field(default_factory=list)
+
+
+@dataclass
+class NodeTiming:
+    start: float
+    end: float
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.start
+
+
+@dataclass
+class PipelineReport:
+    timings: dict[str, NodeTiming]
+    critical_path: list[str]
+    elapsed_seconds: float
+    # Values returned by the nodes
+    results: dict[str, object] = field(default_factory=dict)
+
+    @property
+    def critical_path_seconds(self) -> float:
+        return sum(self.timings[name].duration for name in self.critical_path)
+
+    def __str__(self):
+        summary = f"ran {len(self.timings)} nodes in {self.elapsed_seconds:.2f}s"
+        for name, timing in self.timings.items():
+            summary += f"\n  {name}: {timing.duration:.2f}s"
+        summary += (
+            f"\n  critical path: {' -> '.join(self.critical_path)} "
+            f"({self.critical_path_seconds:.2f}s)"
+        )
+        return summary
+
+
+class Pipeline:
+    """Runs a DAG of nodes on a thread or process pool
+
+    A node starts as soon as all the nodes it depends on have finished, so
+    independent nodes run concurrently, using at most `max_workers` workers.
+    Nodes sharing data must only read it. If a node fails, no further nodes
+    are started, and its exception is raised once the running nodes finish.
+
+    Processing invoices mostly holds the GIL, so it only runs concurrently
+    in separate processes. With `use_processes`, nodes run in forked worker
+    processes, which inherit the nodes and their data without pickling them.
+    Nodes must then pass on their results through files, or by returning
+    them, since changes to their objects stay in the worker process.
+    """
+
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS, use_processes=False):
+        self.max_workers = max_workers
+        self.use_processes = use_processes
+        self.nodes: dict[str, Node] = dict()
+
+    def add_node(self, name, run, depends_on=()):
+        if name in self.nodes:
+            raise ValueError(f"Pipeline node {name} is already defined")
+        self.nodes[name] = Node(name, run, list(depends_on))
+
+    def _topological_order(self) -> list[str]:
+        order = list()
+        visit_state = dict()  # False while visiting, True once visited
+
+        def visit(name, path):
+            if visit_state.get(name) is False:
+                raise ValueError(
+                    f"Pipeline has a dependency cycle: {' -> '.join(path + [name])}"
+                )
+            if name in visit_state:
+                return
+            if name not in self.nodes:
+                raise ValueError(
+                    f"Pipeline node {path[-1]} depends on unknown node {name}"
+                )
+            visit_state[name] = False
+            for dependency in self.nodes[name].depends_on:
+                visit(dependency, path + [name])
+            visit_state[name] = True
+            order.append(name)
+
+        for name in self.nodes:
+            visit(name, [])
+        return order
+
+    def _get_critical_path(self, order, timings) -> list[str]:
+        """Returns the chain of dependent nodes with the longest total
+        duration, which bounds the pipeline's run time"""
+        path_durations = dict()
+        previous_nodes = dict()
+        for name in order:
+            previous_nodes[name] = max(
+                self.nodes[name].depends_on,
+                key=path_durations.get,
+                default=None,
+            )
+            path_durations[name] = timings[name].duration + path_durations.get(
+                previous_nodes[name], 0
+            )
+
+        critical_path = list()
+        name = max(order, key=path_durations.get, default=None)
+        while name is not None:
+            critical_path.append(name)
+            name = previous_nodes[name]
+        return critical_path[::-1]
+
+    def run(self) -> PipelineReport:
+        order = self._topological_order()
+        remaining_dependencies = {
+            name: set(self.nodes[name].depends_on) for name in order
+        }
+        timings = dict()
+        results = dict()
+        start = time.perf_counter()
+
+        if self.use_processes:
+            global _forked_nodes
+            _forked_nodes = self.nodes
+            executor = concurrent.futures.ProcessPoolExecutor(
+                self.max_workers, mp_context=multiprocessing.get_context("fork")
+            )
+
+            def submit_node(name):
+                return executor.submit(_run_forked_node, name)
+        else:
+            executor = concurrent.futures.ThreadPoolExecutor(self.max_workers)
+
+            def submit_node(name):
+                return executor.submit(_run_node, self.nodes, name)
+
+        with executor:
+            running = dict()
+            error = None
+            while remaining_dependencies or running:
+                if error is None:
+                    ready = [
+                        name
+                        for name, dependencies in remaining_dependencies.items()
+                        if not dependencies
+                    ]
+                    for name in ready:
+                        del remaining_dependencies[name]
+                        running[submit_node(name)] = name
+                elif not running:
+                    break
+
+                done, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    name = running.pop(future)
+                    if future.exception() is not None:
+                        error = error or future.exception()
+                        continue
+                    # The monotonic clock is shared by all processes
+                    node_start, node_end, results[name] = future.result()
+                    timings[name] = NodeTiming(node_start - start, node_end - start)
+                    for dependencies in remaining_dependencies.values():
+                        dependencies.discard(name)
+
+        if error is not None:
+            raise error
+
+        # Report nodes in the order they started
+        timings = dict(sorted(timings.items(), key=lambda item: item[1].start))
+        report = PipelineReport(
+            timings,
+            self._get_critical_path(order, timings),
+            time.perf_counter() - start,
+            results,
+        )
+        logger.info(f"Pipeline: {report}")
+        return report
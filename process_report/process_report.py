@@ -1,31 +1,22 @@
+from __future__ import annotations
+
 import argparse
 import sys
+import typing
 import datetime
 import logging
+import functools
+from dataclasses import dataclass
+
+from process_report import instrumentation, rates
+
+# pandas, pyarrow and the modules using them, boto3 and nerc_rates are only
+# imported once a run needs them, so that i.e `--help` or argument errors
+# return quickly
+if typing.TYPE_CHECKING:
+    import pandas
 
-import pandas
-import pyarrow
-from nerc_rates import load_from_url
-
-from process_report import util
-from process_report.invoices import (
-    lenovo_invoice,
-    nonbillable_invoice,
-    billable_invoice,
-    NERC_total_invoice,
-    bu_internal_invoice,
-    pi_specific_invoice,
-    MOCA_prepaid_invoice,
-)
-from process_report.processors import (
-    validate_pi_alias_processor,
-    add_institution_processor,
-    lenovo_processor,
-    validate_billable_pi_processor,
-    new_pi_credit_processor,
-    bu_subsidy_processor,
-    prepayment_processor,
-)
+    from process_report import checkpoint
 
 ### PI file field names
 PI_PI_FIELD = "PI"
@@ -55,6 +46,24 @@ SUBSIDY_FIELD = "Subsidy"
 BALANCE_FIELD = "Balance"
 ###
 
+# Same as `ingest.INGEST_ENGINES` and `invoice.OUTPUT_FORMATS`, which are
+# not imported to parse the arguments
+PANDAS_ENGINE = "pandas"
+INGEST_ENGINES = [PANDAS_ENGINE, "arrow"]
+CSV_FORMAT = "csv"
+OUTPUT_FORMATS = [CSV_FORMAT, "parquet", "arrow"]
+
+PROCESSING_STAGES = [
+    "merge",
+    "validate_pi_alias",
+    "add_institution",
+    "lenovo",
+    "validate_billable_pi",
+    "new_pi_credit",
+    "bu_subsidy",
+    "prepayment",
+]
+
 PI_S3_FILEPATH = "PIs/PI.csv"
 ALIAS_S3_FILEPATH = "PIs/alias.csv"
 PREPAY_DEBITS_S3_FILEPATH = "Prepay/prepay_debits.csv"
@@ -80,6 +89,8 @@ def load_alias(alias_file):
 
 
 def load_prepay_csv(prepay_credits_path, prepay_projects_path, prepay_contacts_path):
+    import pandas
+
     return (
         pandas.read_csv(prepay_credits_path),
         pandas.read_csv(prepay_projects_path),
@@ -111,11 +122,23 @@ def main():
         action="store_true",
         help="If set, uploads all processed invoices and old PI file to S3",
     )
-    parser.add_argument(
+    invoice_month_group = parser.add_mutually_exclusive_group(required=True)
+    invoice_month_group.add_argument(
         "--invoice-month",
-        required=True,
         help="Invoice month to process",
     )
+    invoice_month_group.add_argument(
+        "--invoice-month-range",
+        nargs=2,
+        metavar=("FIRST_MONTH", "LAST_MONTH"),
+        help="Processes every month from FIRST_MONTH to LAST_MONTH in one run, i.e to backfill a quarter. The old PI file and prepay debits are carried from month to month in memory, and only written back after the last month. Invoice CSVs given as arguments may cover all the months",
+    )
+    parser.add_argument(
+        "--persist-ledgers-every",
+        type=int,
+        required=False,
+        help="With --invoice-month-range, also writes back (and uploads) the old PI file and prepay debits after every this many months",
+    )
     parser.add_argument(
         "--pi-file",
         required=True,
@@ -207,14 +230,105 @@ def main():
         type=int,
         help="Amount of subsidy given to BU PIs",
     )
+    parser.add_argument(
+        "--ingest-engine",
+        required=False,
+        choices=INGEST_ENGINES,
+        default=PANDAS_ENGINE,
+        help="Engine used to read and merge the invoice CSVs. 'arrow' reads all files in parallel with pyarrow. Defaults to 'pandas'",
+    )
+    parser.add_argument(
+        "--output-format",
+        required=False,
+        choices=OUTPUT_FORMATS,
+        default=CSV_FORMAT,
+        help="Format of the exported invoices. 'parquet' is compressed with zstd and 'arrow' is an Arrow IPC file, both keeping amounts as exact decimals. Defaults to 'csv'",
+    )
+    parser.add_argument(
+        "--invoice-processes",
+        action="store_true",
+        help="If set, invoices are processed and exported in forked processes instead of threads, which is faster for large invoices",
+    )
+    parser.add_argument(
+        "--categorical-identifiers",
+        action="store_true",
+        help="If set, PIs, projects, institutions, SU types and invoice months are kept dictionary-encoded as categoricals through processing",
+    )
+    parser.add_argument(
+        "--copy-on-write",
+        action="store_true",
+        help="If set, processors and invoices share the processed data, and only copy the columns they modify",
+    )
+    parser.add_argument(
+        "--checkpoint-dir",
+        required=False,
+        help="Directory caching the merged and processed data between runs. Defaults to 'process_report/checkpoints' in the user's cache directory",
+    )
+    parser.add_argument(
+        "--checkpoint-max-bytes",
+        required=False,
+        type=int,
+        help="Size above which the least recently used checkpoints are evicted. Defaults to 2 GiB",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="If set, reads and writes checkpoints, to resume processing from the latest valid one. Off by default",
+    )
+    parser.add_argument(
+        "--purge-checkpoints",
+        action="store_true",
+        help="If set, removes all checkpoints before processing",
+    )
+    parser.add_argument(
+        "--rates-file",
+        required=False,
+        help="Reads the NERC rates from this local file instead of fetching them, i.e to run offline with pinned rates",
+    )
+    parser.add_argument(
+        "--rates-cache-dir",
+        required=False,
+        default=rates.DEFAULT_CACHE_DIR,
+        help=f"Directory caching the fetched NERC rates between runs. Defaults to '{rates.DEFAULT_CACHE_DIR}'",
+    )
+    parser.add_argument(
+        "--rates-cache-ttl",
+        type=int,
+        required=False,
+        default=rates.DEFAULT_TTL,
+        help="Seconds during which cached NERC rates are used without fetching them again",
+    )
+    parser.add_argument(
+        "--run-report",
+        required=False,
+        help="If set, writes the wall time, CPU time, row counts and peak memory of every processing and invoice stage to this JSON file",
+    )
+    parser.add_argument(
+        "--profile-dir",
+        required=False,
+        help="If set, dumps a cProfile of every stage of every month to this directory. Invoice stages then run one at a time",
+    )
     args = parser.parse_args()
 
-    invoice_month = args.invoice_month
+    import pandas
 
-    if args.fetch_from_s3:
-        csv_files = fetch_s3_invoices(invoice_month)
+    from process_report import util, checkpoint
+
+    if args.profile_dir:
+        instrumentation.enable_profiling(args.profile_dir)
+
+    if args.copy_on_write:
+        pandas.set_option("mode.copy_on_write", True)
+
+    if args.invoice_month_range:
+        invoice_months = util.get_month_range(*args.invoice_month_range)
+        if not invoice_months:
+            parser.error("--invoice-month-range must not end before it starts")
     else:
-        csv_files = args.csv_files
+        invoice_months = [args.invoice_month]
+
+    ### Reference data, loaded once for every month
 
     if args.old_pi_file:
         old_pi_file = args.old_pi_file
@@ -226,6 +340,11 @@ def main():
     else:
         alias_file = util.fetch_s3(ALIAS_S3_FILEPATH)
     alias_dict = load_alias(alias_file)
+    try:
+        alias_index = util.get_alias_index(alias_dict)
+    except ValueError as e:
+        logger.error(f"Validating PI aliases failed. {e}")
+        sys.exit(1)
 
     if args.prepay_debits:
         prepay_debits_filepath = args.prepay_debits
@@ -236,8 +355,6 @@ def main():
         args.prepay_credits, args.prepay_projects, args.prepay_contacts
     )
 
-    merged_dataframe = merge_csv(csv_files)
-
     pi = []
     projects = []
     with open(args.pi_file) as file:
@@ -245,69 +362,311 @@ def main():
     with open(args.projects_file) as file:
         projects = [line.rstrip() for line in file]
 
+    reference_data = ReferenceData(
+        old_pi_file=old_pi_file,
+        alias_dict=alias_dict,
+        alias_index=alias_index,
+        prepay_credits=prepay_credits,
+        prepay_projects=prepay_projects,
+        prepay_info=prepay_info,
+        prepay_debits_filepath=prepay_debits_filepath,
+        nonbillable_pis=pi,
+        nonbillable_projects=projects,
+        timed_projects=load_timed_projects(args.timed_projects_file),
+        rates_info=rates.load_rates(
+            args.rates_file, args.rates_cache_dir, args.rates_cache_ttl
+        ),
+        institute_list=util.load_institute_list(),
+    )
+
+    checkpoint_cache = None
+    if args.checkpoint or args.purge_checkpoints:
+        checkpoint_cache = checkpoint.CheckpointCache(
+            args.checkpoint_dir or checkpoint.DEFAULT_CACHE_DIR,
+            checkpoint.DEFAULT_MAX_BYTES
+            if args.checkpoint_max_bytes is None
+            else args.checkpoint_max_bytes,
+        )
+        if args.purge_checkpoints:
+            checkpoint_cache.purge()
+        if not args.checkpoint:
+            checkpoint_cache = None
+
+    # A range of months carries the old PI file and prepay debits forward in
+    # memory, and only writes them back after its last month, or every
+    # `--persist-ledgers-every` months
+    ledgers = None
+    if args.invoice_month_range:
+        from process_report.processors import (
+            new_pi_credit_processor,
+            prepayment_processor,
+        )
+
+        ledgers = Ledgers(
+            new_pi_credit_processor.NewPICreditProcessor._load_old_pis(old_pi_file),
+            prepayment_processor.PrepaymentProcessor._load_prepay_debits(
+                prepay_debits_filepath
+            ),
+        )
+        if args.upload_to_s3:
+            backup_to_s3_old_pi_file(old_pi_file)
+            backup_to_s3_prepay_debits(prepay_debits_filepath)
+
+    # Local invoices of a range of months are merged once, then split by month
+    merge_all_months = functools.cache(
+        functools.partial(
+            merge_csv,
+            args.csv_files,
+            args.ingest_engine,
+            args.categorical_identifiers,
+        )
+    )
+
+    for month_count, invoice_month in enumerate(invoice_months, start=1):
+        if args.fetch_from_s3:
+            csv_files = fetch_s3_invoices(invoice_month)
+            load_invoices = functools.partial(
+                merge_csv, csv_files, args.ingest_engine, args.categorical_identifiers
+            )
+        else:
+            csv_files = args.csv_files
+            if ledgers is None:
+                load_invoices = merge_all_months
+            else:
+                load_invoices = functools.partial(
+                    select_invoice_month, merge_all_months, invoice_month
+                )
+
+        ledgers = process_month(
+            args,
+            invoice_month,
+            csv_files,
+            load_invoices,
+            reference_data,
+            checkpoint_cache,
+            ledgers,
+        )
+        if ledgers is not None and (
+            month_count == len(invoice_months)
+            or (
+                args.persist_ledgers_every
+                and month_count % args.persist_ledgers_every == 0
+            )
+        ):
+            persist_ledgers(
+                ledgers, old_pi_file, prepay_debits_filepath, args.upload_to_s3
+            )
+
+    if args.run_report:
+        instrumentation.get_run_report().write(args.run_report)
+        logger.info(f"Wrote run report to {args.run_report}")
+
+
+@dataclass
+class ReferenceData:
+    """Inputs shared by every processed month"""
+
+    old_pi_file: str
+    alias_dict: dict
+    alias_index: dict
+    prepay_credits: pandas.DataFrame
+    prepay_projects: pandas.DataFrame
+    prepay_info: pandas.DataFrame
+    prepay_debits_filepath: str
+    nonbillable_pis: list[str]
+    nonbillable_projects: list[str]
+    timed_projects: pandas.DataFrame
+    rates_info: object
+    institute_list: list
+
+
+@dataclass
+class Ledgers:
+    """The old PI file and prepay debits, as updated by the months processed
+    so far"""
+
+    old_pi: pandas.DataFrame
+    prepay_debits: pandas.DataFrame
+
+
+def process_month(
+    args,
+    invoice_month,
+    csv_files,
+    load_invoices,
+    reference_data: ReferenceData,
+    checkpoint_cache: checkpoint.CheckpointCache | None,
+    ledgers: Ledgers | None = None,
+) -> Ledgers | None:
+    """Processes and exports the invoices of one month
+
+    `load_invoices` returns the month's merged invoice CSVs. Without
+    `ledgers`, the old PI file and prepay debits are read from their files
+    and written back, as for a single month. Otherwise they are read from
+    `ledgers`, and the updated ledgers are returned instead.
+    """
+    from process_report import util, checkpoint, nonbillable
+    from process_report.invoices import (
+        lenovo_invoice,
+        nonbillable_invoice,
+        billable_invoice,
+        NERC_total_invoice,
+        bu_internal_invoice,
+        pi_specific_invoice,
+        MOCA_prepaid_invoice,
+    )
+    from process_report.processors import (
+        validate_pi_alias_processor,
+        add_institution_processor,
+        lenovo_processor,
+        validate_billable_pi_processor,
+        new_pi_credit_processor,
+        bu_subsidy_processor,
+        prepayment_processor,
+    )
+
+    pi = reference_data.nonbillable_pis
+    alias_dict = reference_data.alias_dict
+    old_pi_file = reference_data.old_pi_file
+    prepay_debits_filepath = reference_data.prepay_debits_filepath
+
     logger.info("Invoice date: " + str(invoice_month))
 
-    timed_projects_list = timed_projects(args.timed_projects_file, invoice_month)
+    timed_projects_list = get_timed_projects(
+        reference_data.timed_projects, invoice_month
+    )
     logger.info("The following timed-projects will not be billed for this period: ")
     logger.info(timed_projects_list)
 
-    projects = list(set(projects + timed_projects_list))
+    projects = reference_data.nonbillable_projects + timed_projects_list
+    nonbillable_matcher = nonbillable.NonbillableMatcher(
+        pi, reference_data.nonbillable_projects, timed_projects_list
+    )
+
+    limit_new_pi_credit_to_partners = get_limit_new_pi_credit_to_partners(
+        reference_data.rates_info, invoice_month
+    )
+
+    ### Checkpoints
+
+    def get_month_stage_inputs():
+        if ledgers is None:
+            old_pi_digest = checkpoint.file_digest(old_pi_file)
+            prepay_debits_digest = checkpoint.file_digest(prepay_debits_filepath)
+        else:
+            old_pi_digest = checkpoint.frame_digest(ledgers.old_pi)
+            prepay_debits_digest = checkpoint.frame_digest(ledgers.prepay_debits)
+        return get_stage_inputs(
+            invoice_month=invoice_month,
+            csv_files=csv_files,
+            ingest_engine=args.ingest_engine,
+            categorical_identifiers=args.categorical_identifiers,
+            alias_dict=alias_dict,
+            institute_list=reference_data.institute_list,
+            nonbillable_pis=pi,
+            nonbillable_projects=reference_data.nonbillable_projects,
+            timed_projects=timed_projects_list,
+            old_pi_digest=old_pi_digest,
+            limit_new_pi_credit_to_partners=limit_new_pi_credit_to_partners,
+            bu_subsidy_amount=args.BU_subsidy_amount,
+            prepay_digests=[
+                checkpoint.file_digest(args.prepay_credits),
+                checkpoint.file_digest(args.prepay_projects),
+                checkpoint.file_digest(args.prepay_contacts),
+                prepay_debits_digest,
+            ],
+        )
+
+    checkpoint_runner = checkpoint.CheckpointRunner(
+        checkpoint_cache, get_month_stage_inputs()
+    )
+
+    def merge():
+        with instrumentation.measure(
+            "merge", "merge_csv", invoice_month=invoice_month
+        ) as metrics:
+            merged_dataframe = load_invoices()
+            metrics.rows_out = len(merged_dataframe)
+        return {"data": merged_dataframe}
+
+    merged_dataframe = checkpoint_runner.run_stage("merge", merge).get("data")
 
     ### Preliminary processing
 
     validate_pi_alias_proc = validate_pi_alias_processor.ValidatePIAliasProcessor(
-        "", invoice_month, merged_dataframe, alias_dict
+        "",
+        invoice_month,
+        merged_dataframe,
+        alias_dict,
+        alias_index=reference_data.alias_index,
     )
-    validate_pi_alias_proc.process()
+    checkpoint_runner.run_processor("validate_pi_alias", validate_pi_alias_proc)
 
     add_institute_proc = add_institution_processor.AddInstitutionProcessor(
         "", invoice_month, validate_pi_alias_proc.data
     )
-    add_institute_proc.process()
+    checkpoint_runner.run_processor("add_institution", add_institute_proc)
 
     lenovo_proc = lenovo_processor.LenovoProcessor(
         "", invoice_month, add_institute_proc.data
     )
-    lenovo_proc.process()
+    checkpoint_runner.run_processor("lenovo", lenovo_proc)
 
     validate_billable_pi_proc = (
         validate_billable_pi_processor.ValidateBillablePIsProcessor(
-            "", invoice_month, lenovo_proc.data, pi, projects
+            "",
+            invoice_month,
+            lenovo_proc.data,
+            pi,
+            projects,
+            nonbillable_matcher=nonbillable_matcher,
         )
     )
-    validate_billable_pi_proc.process()
+    checkpoint_runner.run_processor("validate_billable_pi", validate_billable_pi_proc)
 
-    rates_info = load_from_url()
     new_pi_credit_proc = new_pi_credit_processor.NewPICreditProcessor(
         "",
         invoice_month,
         data=validate_billable_pi_proc.data,
         old_pi_filepath=old_pi_file,
-        limit_new_pi_credit_to_partners=(
-            rates_info.get_value_at(
-                "Limit New PI Credit to MGHPCC Partners", invoice_month
-            )
-            == "True",
-        ),
+        limit_new_pi_credit_to_partners=limit_new_pi_credit_to_partners,
+        old_pi_df=None if ledgers is None else ledgers.old_pi,
+    )
+    checkpoint_runner.run_processor(
+        "new_pi_credit", new_pi_credit_proc, saved_attributes=["updated_old_pi_df"]
     )
-    new_pi_credit_proc.process()
 
     bu_subsidy_proc = bu_subsidy_processor.BUSubsidyProcessor(
-        "", invoice_month, new_pi_credit_proc.data.copy(), args.BU_subsidy_amount
+        "",
+        invoice_month,
+        util.copy_dataframe(new_pi_credit_proc.data)
+        if new_pi_credit_proc.data is not None
+        else None,
+        args.BU_subsidy_amount,
     )
-    bu_subsidy_proc.process()
+    checkpoint_runner.run_processor("bu_subsidy", bu_subsidy_proc)
 
     prepayment_proc = prepayment_processor.PrepaymentProcessor(
         "",
         invoice_month,
         bu_subsidy_proc.data,
-        prepay_credits,
-        prepay_projects,
-        prepay_info,
+        reference_data.prepay_credits,
+        reference_data.prepay_projects,
+        reference_data.prepay_info,
         prepay_debits_filepath,
         args.upload_to_s3,
+        prepay_debits=None if ledgers is None else ledgers.prepay_debits,
+    )
+    checkpoint_runner.run_processor(
+        "prepayment", prepayment_proc, saved_attributes=["prepay_debits"]
     )
-    prepayment_proc.process()
+    if checkpoint_runner.is_loaded("prepayment") and ledgers is None:
+        # Debits are still written back as if the processor had run
+        if args.upload_to_s3:
+            prepayment_proc._backup_s3_prepay_debits()
+        prepayment_proc._export_prepay_debits()
+        if args.upload_to_s3:
+            prepayment_proc._export_s3_prepay_debits()
 
     processed_data = prepayment_proc.data
 
@@ -317,6 +676,7 @@ def main():
         name=args.Lenovo_file,
         invoice_month=invoice_month,
         data=processed_data,
+        output_format=args.output_format,
     )
     nonbillable_inv = nonbillable_invoice.NonbillableInvoice(
         name=args.nonbillable_file,
@@ -324,37 +684,47 @@ def main():
         data=processed_data,
         nonbillable_pis=pi,
         nonbillable_projects=projects,
+        output_format=args.output_format,
     )
 
-    if args.upload_to_s3:
+    if args.upload_to_s3 and ledgers is None:
         backup_to_s3_old_pi_file(old_pi_file)
 
     billable_inv = billable_invoice.BillableInvoice(
         name=args.output_file,
         invoice_month=invoice_month,
         data=processed_data,
-        old_pi_filepath=old_pi_file,
+        old_pi_filepath=old_pi_file if ledgers is None else None,
         updated_old_pi_df=new_pi_credit_proc.updated_old_pi_df,
+        output_format=args.output_format,
     )
 
     nerc_total_inv = NERC_total_invoice.NERCTotalInvoice(
         name=args.NERC_total_invoice_file,
         invoice_month=invoice_month,
         data=processed_data,
+        output_format=args.output_format,
     )
 
     bu_internal_inv = bu_internal_invoice.BUInternalInvoice(
         name=args.BU_invoice_file,
         invoice_month=invoice_month,
         data=processed_data,
+        output_format=args.output_format,
     )
 
     pi_inv = pi_specific_invoice.PIInvoice(
-        name=args.output_folder, invoice_month=invoice_month, data=processed_data
+        name=args.output_folder,
+        invoice_month=invoice_month,
+        data=processed_data,
+        output_format=args.output_format,
     )
 
     moca_prepaid_inv = MOCA_prepaid_invoice.MOCAPrepaidInvoice(
-        name="", invoice_month=invoice_month, data=processed_data.copy()
+        name="",
+        invoice_month=invoice_month,
+        data=util.copy_dataframe(processed_data),
+        output_format=args.output_format,
     )
 
     util.process_and_export_invoices(
@@ -368,39 +738,106 @@ def main():
             moca_prepaid_inv,
         ],
         args.upload_to_s3,
+        use_processes=args.invoice_processes,
+    )
+
+    checkpoint_runner.log_summary()
+    instrumentation.get_run_report().stage_reuse = checkpoint_runner.statuses
+    if ledgers is not None:
+        return Ledgers(
+            billable_invoice.BillableInvoice.get_old_pi_ledger(
+                new_pi_credit_proc.updated_old_pi_df
+            ),
+            prepayment_proc.prepay_debits,
+        )
+
+    if checkpoint_cache:
+        # This run rewrote the old PI file and prepay debits. Processing the
+        # month again from the rewritten files gives the same results, so
+        # their keys are linked to this run's checkpoints
+        checkpoint_runner.link_inputs(get_month_stage_inputs())
+    return None
+
+
+def get_stage_inputs(
+    invoice_month,
+    csv_files,
+    ingest_engine,
+    categorical_identifiers,
+    alias_dict,
+    institute_list,
+    nonbillable_pis,
+    nonbillable_projects,
+    timed_projects,
+    old_pi_digest,
+    limit_new_pi_credit_to_partners,
+    bu_subsidy_amount,
+    prepay_digests,
+):
+    """Returns the inputs of every processing stage, in order, besides the
+    output of the stage before it. Files are fingerprinted by their digest,
+    and so are the old PI file and prepay files, passed as digests
+
+    The institute list is an input of every stage resolving institutions:
+    the New PI credit reads partnership dates from it, and prepayments
+    resolve group contacts with it.
+    """
+    from process_report import checkpoint
+
+    stage_inputs = {
+        "merge": [
+            ingest_engine,
+            categorical_identifiers,
+            [checkpoint.file_digest(csv_file) for csv_file in csv_files],
+        ],
+        "validate_pi_alias": [alias_dict],
+        "add_institution": [institute_list],
+        "lenovo": [],
+        "validate_billable_pi": [
+            nonbillable_pis,
+            nonbillable_projects,
+            sorted(timed_projects),
+        ],
+        "new_pi_credit": [
+            old_pi_digest,
+            limit_new_pi_credit_to_partners,
+            institute_list,
+        ],
+        "bu_subsidy": [bu_subsidy_amount],
+        "prepayment": [prepay_digests, institute_list],
+    }
+    return {stage: [invoice_month, *stage_inputs[stage]] for stage in PROCESSING_STAGES}
+
+
+def get_limit_new_pi_credit_to_partners(rates_info, invoice_month) -> bool:
+    """Whether the new PI credit is limited to MGHPCC partners this month.
+    The rate is a "True" or "False" string"""
+    return (
+        rates_info.get_value_at("Limit New PI Credit to MGHPCC Partners", invoice_month)
+        == "True"
     )
 
 
 def fetch_s3_invoices(invoice_month):
     """Fetches usage invoices from S3 given invoice month"""
-    s3_invoice_list = list()
-    invoice_bucket = util.get_invoice_bucket()
-    for obj in invoice_bucket.objects.filter(
-        Prefix=f"Invoices/{invoice_month}/Service Invoices/"
-    ):
-        local_name = obj.key.split("/")[-1]
-        s3_invoice_list.append(local_name)
-        invoice_bucket.download_file(obj.key, local_name)
+    from process_report import util
+
+    s3_downloader = util.get_s3_downloader()
+    s3_invoice_list = s3_downloader.list_prefix(
+        f"Invoices/{invoice_month}/Service Invoices/"
+    )
+    s3_downloader.download(s3_invoice_list)
 
-    return s3_invoice_list
+    return [s3_invoice.local_path for s3_invoice in s3_invoice_list]
 
 
-def merge_csv(files):
+def merge_csv(files, engine=PANDAS_ENGINE, categorical_identifiers=False):
     """Merge multiple CSV files and return a single pandas dataframe"""
-    dataframes = []
-    for file in files:
-        dataframe = pandas.read_csv(
-            file,
-            dtype={
-                COST_FIELD: pandas.ArrowDtype(pyarrow.decimal128(12, 2)),
-                RATE_FIELD: str,
-            },
-        )
-        dataframes.append(dataframe)
+    from process_report import ingest
 
-    merged_dataframe = pandas.concat(dataframes, ignore_index=True)
-    merged_dataframe.reset_index(drop=True, inplace=True)
-    return merged_dataframe
+    return ingest.merge_invoices(
+        files, engine, categorical_identifiers=categorical_identifiers
+    )
 
 
 def get_invoice_date(dataframe):
@@ -409,30 +846,86 @@ def get_invoice_date(dataframe):
     Note that it only checks the first entry because it should
     be the same for every row.
     """
+    import pandas
+
     invoice_date_str = dataframe[INVOICE_DATE_FIELD][0]
     invoice_date = pandas.to_datetime(invoice_date_str, format="%Y-%m")
     return invoice_date
 
 
+def load_timed_projects(timed_projects_file) -> pandas.DataFrame:
+    import pandas
+
+    return pandas.read_csv(timed_projects_file)
+
+
 def timed_projects(timed_projects_file, invoice_date):
     """Returns list of projects that should be excluded based on dates"""
-    dataframe = pandas.read_csv(timed_projects_file)
+    return get_timed_projects(load_timed_projects(timed_projects_file), invoice_date)
 
-    # convert to pandas timestamp objects
-    dataframe["Start Date"] = pandas.to_datetime(
-        dataframe["Start Date"], format="%Y-%m"
-    )
-    dataframe["End Date"] = pandas.to_datetime(dataframe["End Date"], format="%Y-%m")
 
-    mask = (dataframe["Start Date"] <= invoice_date) & (
-        invoice_date <= dataframe["End Date"]
-    )
+def get_timed_projects(dataframe: pandas.DataFrame, invoice_date):
+    """Returns the projects of the loaded timed projects file that should
+    be excluded from the invoice of `invoice_date`"""
+    import pandas
+
+    from process_report import util
+
+    # The invoice date may be a YYYY-MM string or a pandas timestamp
+    invoice_month = pandas.Timestamp(invoice_date).strftime("%Y-%m")
+    mask = ~util.compare_invoice_months(
+        dataframe["Start Date"], invoice_month
+    ) & ~util.compare_invoice_months(invoice_month, dataframe["End Date"])
     return dataframe[mask]["Project"].to_list()
 
 
+def select_invoice_month(merge_invoices, invoice_month) -> pandas.DataFrame:
+    """Returns the rows of `invoice_month` from the invoices merged by
+    `merge_invoices`, indexed like a month's merged invoices"""
+    merged_dataframe = merge_invoices()
+    return merged_dataframe[
+        merged_dataframe[INVOICE_DATE_FIELD] == invoice_month
+    ].reset_index(drop=True)
+
+
+def persist_ledgers(
+    ledgers: Ledgers, old_pi_file, prepay_debits_filepath, upload_to_s3
+):
+    """Writes the ledgers back to the old PI file and prepay debits file,
+    and uploads them to S3"""
+    ledgers.old_pi.to_csv(old_pi_file, index=False)
+    ledgers.prepay_debits.to_csv(prepay_debits_filepath, index=False)
+    logger.info(f"Wrote ledgers to {old_pi_file} and {prepay_debits_filepath}")
+    if upload_to_s3:
+        from process_report import util, s3_transfer
+
+        util.upload_to_s3_bucket(
+            [
+                s3_transfer.S3Upload(old_pi_file, PI_S3_FILEPATH),
+                s3_transfer.S3Upload(prepay_debits_filepath, PREPAY_DEBITS_S3_FILEPATH),
+            ]
+        )
+
+
 def backup_to_s3_old_pi_file(old_pi_file):
-    invoice_bucket = util.get_invoice_bucket()
-    invoice_bucket.upload_file(old_pi_file, f"PIs/Archive/PI {get_iso8601_time()}.csv")
+    from process_report import util, s3_transfer
+
+    util.upload_to_s3_bucket(
+        [s3_transfer.S3Upload(old_pi_file, f"PIs/Archive/PI {get_iso8601_time()}.csv")]
+    )
+
+
+def backup_to_s3_prepay_debits(prepay_debits_filepath):
+    from process_report import util, s3_transfer
+
+    util.upload_to_s3_bucket(
+        [
+            s3_transfer.S3Upload(
+                prepay_debits_filepath,
+                f"Prepay/Archive/prepay_debits {get_iso8601_time()}.csv",
+            )
+        ]
+    )
 
 
 def export_billables(dataframe, output_file):
@@ -16,7 +16,7 @@ logging.basicConfig(level=logging.INFO)
 class AddInstitutionProcessor(processor.Processor):
     def _add_institution(self):
         """Determine every PI's institution name, logging any PI whose institution cannot be determined
-        This is performed by `get_institution_from_pi()`, which tries to match the PI's username to
+        This is performed by `util.InstitutionResolver`, which tries to match the PI's username to
         a list of known institution email domains (i.e bu.edu), or to several edge cases (i.e rudolph) if
         the username is not an email address.
 
@@ -25,18 +25,43 @@ class AddInstitutionProcessor(processor.Processor):
         I.e "foo@bu.edu" would match with "bu.edu", which maps to the instition name "Boston University"
 
         The list of mappings are defined in `institute_map.json`.
+
+        Each distinct PI is only resolved once, and the results are then
+        mapped back onto every row.
         """
-        institute_list = util.load_institute_list()
-        institute_map = util.get_institute_mapping(institute_list)
-        self.data = self.data.astype({invoice.INSTITUTION_FIELD: "str"})
-        for i, row in self.data.iterrows():
-            pi_name = row[invoice.PI_FIELD]
-            if pandas.isna(pi_name):
-                logger.info(f"Project {row[invoice.PROJECT_FIELD]} has no PI")
-            else:
-                self.data.at[
-                    i, invoice.INSTITUTION_FIELD
-                ] = util.get_institution_from_pi(institute_map, pi_name)
+        resolver = util.get_institution_resolver()
+        pi_names = self.data[invoice.PI_FIELD]
+        has_pi = pi_names.notna()
+        institutions = util.map_identifiers(pi_names, resolver.resolve_series)
+
+        # Projects without a PI keep their institution, as a string
+        if not has_pi.all():
+            # Categoricals cannot be converted to strings directly in
+            # copy-on-write mode
+            other_institutions = (
+                self.data.loc[~has_pi, invoice.INSTITUTION_FIELD]
+                .astype(object)
+                .astype("str")
+            )
+            if isinstance(institutions.dtype, pandas.CategoricalDtype):
+                institutions = institutions.cat.add_categories(
+                    pandas.Index(other_institutions.unique()).difference(
+                        institutions.cat.categories
+                    )
+                )
+            institutions[~has_pi] = other_institutions
+        self.data[invoice.INSTITUTION_FIELD] = institutions
+
+        projects_without_pi = self.data.loc[~has_pi, invoice.PROJECT_FIELD].unique()
+        if len(projects_without_pi) > 0:
+            logger.info(
+                f"{len(projects_without_pi)} projects have no PI: {', '.join(map(str, projects_without_pi))}"
+            )
+        unmatched_pis = pi_names[has_pi & (institutions == "")].unique()
+        if len(unmatched_pis) > 0:
+            logger.warning(
+                f"{len(unmatched_pis)} PIs do not match any institution: {', '.join(unmatched_pis)}"
+            )
 
     def _process(self):
         self._add_institution()
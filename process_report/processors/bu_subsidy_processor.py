@@ -1,6 +1,9 @@
 from dataclasses import dataclass
 from decimal import Decimal
 
+import pandas
+
+from process_report import util
 from process_report.invoices import invoice
 from process_report.processors import discount_processor
 
@@ -12,14 +15,16 @@ class BUSubsidyProcessor(discount_processor.DiscountProcessor):
     subsidy_amount: int
 
     def _prepare(self):
-        def get_project(row):
-            project_alloc = row[invoice.PROJECT_FIELD]
+        def get_project(project_alloc):
             if project_alloc.rfind("-") == -1:
                 return project_alloc
             else:
                 return project_alloc[: project_alloc.rfind("-")]
 
-        self.data[invoice.PROJECT_NAME_FIELD] = self.data.apply(get_project, axis=1)
+        self.data[invoice.PROJECT_NAME_FIELD] = util.map_identifiers(
+            self.data[invoice.PROJECT_FIELD],
+            lambda project_allocs: project_allocs.map(get_project),
+        )
         self.data[invoice.SUBSIDY_FIELD] = Decimal(0)
 
     def _process(self):
@@ -30,9 +35,11 @@ class BUSubsidyProcessor(discount_processor.DiscountProcessor):
         filtered_data = data[
             data[invoice.IS_BILLABLE_FIELD] & ~data[invoice.MISSING_PI_FIELD]
         ]
-        filtered_data = filtered_data[
-            filtered_data[invoice.INSTITUTION_FIELD] == "Boston University"
-        ].copy()
+        filtered_data = util.copy_dataframe(
+            filtered_data[
+                filtered_data[invoice.INSTITUTION_FIELD] == "Boston University"
+            ]
+        )
 
         return filtered_data
 
@@ -40,17 +47,14 @@ class BUSubsidyProcessor(discount_processor.DiscountProcessor):
         subsidy_eligible_projects = self._get_subsidy_eligible_projects(dataframe)
         pi_list = subsidy_eligible_projects[invoice.PI_FIELD].unique()
 
-        for pi in pi_list:
-            pi_projects = subsidy_eligible_projects[
-                subsidy_eligible_projects[invoice.PI_FIELD] == pi
-            ]
-            self.apply_flat_discount(
-                dataframe,
-                pi_projects,
-                invoice.PI_BALANCE_FIELD,
-                subsidy_amount,
-                invoice.SUBSIDY_FIELD,
-                invoice.BALANCE_FIELD,
-            )
+        self.apply_flat_discounts(
+            dataframe,
+            subsidy_eligible_projects,
+            invoice.PI_FIELD,
+            pandas.Series(subsidy_amount, index=pi_list, dtype=object),
+            invoice.PI_BALANCE_FIELD,
+            invoice.SUBSIDY_FIELD,
+            invoice.BALANCE_FIELD,
+        )
 
         return dataframe
@@ -1,5 +1,7 @@
+import numpy
 import pandas
 
+from process_report import money
 from process_report.processors import processor
 
 
@@ -78,3 +80,171 @@ class DiscountProcessor(processor.Processor):
 
         discount_used = discount_amount - remaining_discount_amount
         return discount_used
+
+    def apply_flat_discounts(
+        self,
+        invoice: pandas.DataFrame,
+        projects: pandas.DataFrame,
+        key_field: str,
+        discount_amounts: pandas.Series,
+        pi_balance_field: str,
+        discount_field: str,
+        balance_field: str,
+        code_field: str = None,
+        discount_code: str = None,
+    ) -> pandas.Series:
+        """
+        Batch version of `apply_flat_discount`. `projects` is a subset of
+        `invoice` holding the projects of many PIs (or groups), identified by
+        `key_field`, and `discount_amounts` holds the discount given to each
+        key. Every key's discount is applied to its projects with the same
+        in-order greedy semantics as `apply_flat_discount`.
+
+        Instead of walking each project, a project's remaining discount is
+        the key's discount minus the cumulative balance of the key's previous
+        projects. A project gets a discount if that remaining discount is
+        positive. This only matches the row-by-row semantics for non-negative
+        amounts with exact arithmetic, so amounts that are not a whole number
+        of cents (i.e floats) or are negative fall back to
+        `apply_flat_discount`.
+
+        Returns the amount of discount used by each key, indexed like
+        `discount_amounts`.
+
+        :param invoice: Dataframe containing all projects
+        :param projects: A subset of `invoice`, containing the projects of every key you want to apply the discount
+        :param key_field: Name of the field identifying the PI or group of each project
+        :param discount_amounts: The discount given to each PI or group, indexed by key
+        """
+        projects = projects[projects[key_field].isin(discount_amounts.index)]
+        discount_amounts = discount_amounts[~discount_amounts.index.duplicated()]
+        balance_fields = [pi_balance_field]
+        if self.IS_DISCOUNT_BY_NERC:
+            balance_fields.append(balance_field)
+
+        # Amounts are computed on int64 cents, keeping the scale Decimal
+        # arithmetic would give each amount, so they are written back exactly
+        # as the row by row path writes them. The invoice columns themselves
+        # stay decimals: the exports print each amount with the scale it was
+        # computed with, and the other processors and the row by row path,
+        # which also handles floats and negative amounts, work on them
+        try:
+            balances, balance_scales = money.to_cents(projects[pi_balance_field])
+            amounts, amount_scales = money.to_cents(discount_amounts)
+            is_exact = projects.index.is_unique and not (
+                (balances < 0).any() or (amounts < 0).any()
+            )
+            invoice_balances = {
+                field: money.to_cents(invoice.loc[projects.index, field])
+                for field in balance_fields
+            }
+        except ValueError:
+            is_exact = False
+
+        if not is_exact:
+            return pandas.Series(
+                [
+                    self.apply_flat_discount(
+                        invoice,
+                        projects[projects[key_field] == key],
+                        pi_balance_field,
+                        discount_amount,
+                        discount_field,
+                        balance_field,
+                        code_field,
+                        discount_code,
+                    )
+                    for key, discount_amount in discount_amounts.items()
+                ],
+                index=discount_amounts.index,
+                dtype=object,
+            )
+
+        # Group each key's projects together, keeping their order
+        key_codes = discount_amounts.index.get_indexer(projects[key_field])
+        order = numpy.argsort(key_codes, kind="stable")
+        key_codes = key_codes[order]
+        project_index = projects.index[order]
+        project_balances = balances[order]
+        project_balance_scales = balance_scales[order]
+
+        # Balance of the key's projects before each project. The scale of a
+        # sum is the largest scale of its terms
+        preceding_balances = numpy.cumsum(project_balances) - project_balances
+        is_first = numpy.ones(len(key_codes), dtype=bool)
+        is_first[1:] = key_codes[1:] != key_codes[:-1]
+        group_starts = numpy.maximum.accumulate(
+            numpy.where(is_first, numpy.arange(len(key_codes)), 0)
+        )
+        previous_balances = preceding_balances - preceding_balances[group_starts]
+        # Largest scale of the key's previous balances. Keys are sorted, so
+        # offsetting each key's scales above the previous key's restarts the
+        # running maximum at every key
+        scale_offsets = (numpy.cumsum(is_first) - 1) * (money.MAX_SCALE + 1)
+        previous_balance_scales = numpy.zeros(len(key_codes), dtype=numpy.int8)
+        previous_balance_scales[1:] = (
+            numpy.maximum.accumulate(project_balance_scales + scale_offsets)
+            - scale_offsets
+        )[:-1]
+
+        project_amounts = amounts[key_codes]
+        project_amount_scales = amount_scales[key_codes]
+        # The first project sees the discount amount itself, like the loop
+        remaining_amounts = numpy.where(
+            is_first, project_amounts, project_amounts - previous_balances
+        )
+        remaining_scales = numpy.where(
+            is_first,
+            project_amount_scales,
+            numpy.maximum(project_amount_scales, previous_balance_scales),
+        )
+        is_discounted = remaining_amounts > 0
+        is_remaining_applied = (remaining_amounts < project_balances)[is_discounted]
+        applied_discounts = numpy.where(
+            is_remaining_applied,
+            remaining_amounts[is_discounted],
+            project_balances[is_discounted],
+        )
+        applied_scales = numpy.where(
+            is_remaining_applied,
+            remaining_scales[is_discounted],
+            project_balance_scales[is_discounted],
+        )
+        discounted_index = project_index[is_discounted]
+        discounted_positions = order[is_discounted]
+
+        def set_values(field, cents, scales):
+            invoice.loc[discounted_index, field] = pandas.Series(
+                money.from_cents(cents, scales, invoice[field].dtype),
+                index=discounted_index,
+            )
+
+        set_values(discount_field, applied_discounts, applied_scales)
+        for field, (field_balances, field_scales) in invoice_balances.items():
+            set_values(
+                field,
+                field_balances[discounted_positions] - applied_discounts,
+                numpy.maximum(field_scales[discounted_positions], applied_scales),
+            )
+        if code_field and discount_code:
+            codes = invoice.loc[discounted_index, code_field]
+            new_codes = pandas.Series(discount_code, index=codes.index, dtype=object)
+            has_code = codes.notna()
+            new_codes[has_code] = codes[has_code] + "," + discount_code
+            invoice.loc[discounted_index, code_field] = new_codes
+
+        applied_totals = numpy.zeros(len(amounts), dtype=numpy.int64)
+        applied_total_scales = numpy.zeros(len(amounts), dtype=numpy.int8)
+        numpy.add.at(applied_totals, key_codes[is_discounted], applied_discounts)
+        numpy.maximum.at(applied_total_scales, key_codes[is_discounted], applied_scales)
+        # Same as the loop, which subtracts the discount used from the
+        # remaining amount before returning the difference
+        return pandas.Series(
+            money.from_cents(
+                applied_totals,
+                numpy.maximum(amount_scales, applied_total_scales),
+                object,
+            ),
+            index=discount_amounts.index,
+            dtype=object,
+        )
@@ -28,6 +28,9 @@ class NewPICreditProcessor(discount_processor.DiscountProcessor):
 
     old_pi_filepath: str
     limit_new_pi_credit_to_partners: bool = False
+    # The old PI file's contents, if already loaded, i.e the ledger updated
+    # by the previous month when processing a range of months
+    old_pi_df: pandas.DataFrame | None = None
 
     @staticmethod
     def _load_old_pis(old_pi_filepath) -> pandas.DataFrame:
@@ -48,34 +51,34 @@ class NewPICreditProcessor(discount_processor.DiscountProcessor):
         return old_pi_df
 
     @staticmethod
-    def _get_pi_age(old_pi_df: pandas.DataFrame, pi, invoice_month):
-        """Returns time difference between current invoice month and PI's first invoice month
-        I.e 0 for new PIs
-        Will raise an error if the PI'a age is negative, which suggests a faulty invoice, or a program bug"""
-        first_invoice_month = old_pi_df.loc[
-            old_pi_df[invoice.PI_PI_FIELD] == pi, invoice.PI_FIRST_MONTH
-        ]
-        if first_invoice_month.empty:
-            return 0
-
-        month_diff = util.get_month_diff(invoice_month, first_invoice_month.iat[0])
-        if month_diff < 0:
+    def _get_pi_ages(
+        old_pi_df: pandas.DataFrame, pis: pandas.Index, invoice_month
+    ) -> pandas.Series:
+        """Returns time difference between current invoice month and the first
+        invoice month of every PI in `pis`, I.e 0 for new PIs
+        Will exit if a PI's age is negative, which suggests a faulty invoice, or a program bug"""
+        first_invoice_months = (
+            old_pi_df.drop_duplicates(invoice.PI_PI_FIELD)
+            .set_index(invoice.PI_PI_FIELD)[invoice.PI_FIRST_MONTH]
+            .reindex(pis)
+        )
+        is_old_pi = first_invoice_months.notna()
+        pi_ages = pandas.Series(0, index=pis)
+        pi_ages[is_old_pi] = util.get_month_ordinal(
+            invoice_month
+        ) - util.get_month_ordinals(first_invoice_months[is_old_pi])
+
+        if (pi_ages < 0).any():
+            pi = pi_ages.index[(pi_ages < 0).to_numpy()][0]
             sys.exit(
-                f"PI {pi} from {first_invoice_month} found in {invoice_month} invoice!"
+                f"PI {pi} from {first_invoice_months[pi]} found in {invoice_month} invoice!"
             )
-        else:
-            return month_diff
+        return pi_ages
 
     def _filter_partners(self, data):
-        active_partnerships = list()
-        institute_list = util.load_institute_list()
-        for institute_info in institute_list:
-            if partnership_start_date := institute_info.get(
-                "mghpcc_partnership_start_date"
-            ):
-                if util.get_month_diff(self.invoice_month, partnership_start_date) >= 0:
-                    active_partnerships.append(institute_info["display_name"])
-
+        active_partnerships = util.get_institution_resolver().active_partnerships(
+            self.invoice_month
+        )
         return data[data[invoice.INSTITUTION_FIELD].isin(active_partnerships)]
 
     def _filter_excluded_su_types(self, data):
@@ -124,63 +127,97 @@ class NewPICreditProcessor(discount_processor.DiscountProcessor):
         )
 
         credit_eligible_projects = self._get_credit_eligible_projects(data)
-        current_pi_set = set(credit_eligible_projects[invoice.PI_FIELD])
-        for pi in current_pi_set:
-            pi_projects = credit_eligible_projects[
-                credit_eligible_projects[invoice.PI_FIELD] == pi
-            ]
-            pi_age = self._get_pi_age(old_pi_df, pi, self.invoice_month)
-            pi_old_pi_entry = old_pi_df.loc[
-                old_pi_df[invoice.PI_PI_FIELD] == pi
-            ].squeeze()
-
-            if pi_age > 1:
-                for i, row in pi_projects.iterrows():
-                    data.at[i, invoice.BALANCE_FIELD] = row[invoice.COST_FIELD]
+        # Keep the set's iteration order, which decides the order in which
+        # new PIs are added to the old PI file
+        current_pis = pandas.Index(
+            list(set(credit_eligible_projects[invoice.PI_FIELD])), dtype=object
+        )
+        pi_ages = self._get_pi_ages(old_pi_df, current_pis, self.invoice_month)
+
+        old_pi_projects = credit_eligible_projects[
+            credit_eligible_projects[invoice.PI_FIELD].isin(
+                current_pis[pi_ages.to_numpy() > 1]
+            )
+        ]
+        data.loc[old_pi_projects.index, invoice.BALANCE_FIELD] = old_pi_projects[
+            invoice.COST_FIELD
+        ]
+
+        # Brand new PIs are added to the top of the old PI file at once, in
+        # the reverse order they are processed
+        old_pi_index = pandas.Index(old_pi_df[invoice.PI_PI_FIELD])
+        new_pis = current_pis[
+            (pi_ages.to_numpy() == 0) & ~current_pis.isin(old_pi_index)
+        ]
+        if len(new_pis) > 0:
+            old_pi_df = pandas.concat(
+                [
+                    pandas.DataFrame(
+                        [
+                            [pi, self.invoice_month, new_pi_credit_amount, 0, 0]
+                            for pi in reversed(new_pis)
+                        ],
+                        columns=old_pi_df.columns,
+                    ),
+                    old_pi_df,
+                ],
+                ignore_index=True,
+            )
+        old_pi_entries = old_pi_df.drop_duplicates(invoice.PI_PI_FIELD).set_index(
+            invoice.PI_PI_FIELD
+        )
+
+        for pi_age, credit_used_field in [
+            (0, invoice.PI_1ST_USED),
+            (1, invoice.PI_2ND_USED),
+        ]:
+            credit_pis = current_pis[pi_ages.to_numpy() == pi_age]
+            if len(credit_pis) == 0:
+                continue
+            pi_old_pi_entries = old_pi_entries.loc[credit_pis]
+            if pi_age == 0:
+                remaining_credits = pandas.Series(
+                    new_pi_credit_amount, index=credit_pis, dtype=object
+                )
             else:
-                if pi_age == 0:
-                    if len(pi_old_pi_entry) == 0:
-                        pi_entry = [pi, self.invoice_month, new_pi_credit_amount, 0, 0]
-                        old_pi_df = pandas.concat(
-                            [
-                                pandas.DataFrame([pi_entry], columns=old_pi_df.columns),
-                                old_pi_df,
-                            ],
-                            ignore_index=True,
-                        )
-                        pi_old_pi_entry = old_pi_df.loc[
-                            old_pi_df[invoice.PI_PI_FIELD] == pi
-                        ].squeeze()
-
-                    remaining_credit = new_pi_credit_amount
-                    credit_used_field = invoice.PI_1ST_USED
-                elif pi_age == 1:
-                    remaining_credit = (
-                        pi_old_pi_entry[invoice.PI_INITIAL_CREDITS]
-                        - pi_old_pi_entry[invoice.PI_1ST_USED]
-                    )
-                    credit_used_field = invoice.PI_2ND_USED
-
-                credits_used = self.apply_flat_discount(
-                    data,
-                    pi_projects,
-                    invoice.PI_BALANCE_FIELD,
-                    remaining_credit,
-                    invoice.CREDIT_FIELD,
-                    invoice.BALANCE_FIELD,
-                    invoice.CREDIT_CODE_FIELD,
-                    self.NEW_PI_CREDIT_CODE,
+                remaining_credits = pandas.Series(
+                    (
+                        pi_old_pi_entries[invoice.PI_INITIAL_CREDITS]
+                        - pi_old_pi_entries[invoice.PI_1ST_USED]
+                    ).to_numpy(dtype=object),
+                    index=credit_pis,
+                    dtype=object,
+                )
+
+            credits_used = self.apply_flat_discounts(
+                data,
+                credit_eligible_projects,
+                invoice.PI_FIELD,
+                remaining_credits,
+                invoice.PI_BALANCE_FIELD,
+                invoice.CREDIT_FIELD,
+                invoice.BALANCE_FIELD,
+                invoice.CREDIT_CODE_FIELD,
+                self.NEW_PI_CREDIT_CODE,
+            )
+
+            previous_credits_used = pi_old_pi_entries[credit_used_field].to_numpy(
+                dtype=object
+            )
+            is_overwritten = (previous_credits_used != 0) & (
+                credits_used.to_numpy() != previous_credits_used
+            )
+            for pi, previous_credit_used in zip(
+                credit_pis[is_overwritten], previous_credits_used[is_overwritten]
+            ):
+                logger.warning(
+                    f"PI file overwritten. PI {pi} previously used ${previous_credit_used} of New PI credits, now uses ${credits_used[pi]}"
                 )
 
-                if (pi_old_pi_entry[credit_used_field] != 0) and (
-                    credits_used != pi_old_pi_entry[credit_used_field]
-                ):
-                    logger.warning(
-                        f"PI file overwritten. PI {pi} previously used ${pi_old_pi_entry[credit_used_field]} of New PI credits, now uses ${credits_used}"
-                    )
-                old_pi_df.loc[
-                    old_pi_df[invoice.PI_PI_FIELD] == pi, credit_used_field
-                ] = credits_used
+            credit_pi_rows = old_pi_df[invoice.PI_PI_FIELD].isin(credit_pis)
+            old_pi_df.loc[credit_pi_rows, credit_used_field] = old_pi_df.loc[
+                credit_pi_rows, invoice.PI_PI_FIELD
+            ].map(credits_used)
 
         return (data, old_pi_df)
 
@@ -189,7 +226,8 @@ class NewPICreditProcessor(discount_processor.DiscountProcessor):
         self.data[invoice.CREDIT_CODE_FIELD] = None
         self.data[invoice.PI_BALANCE_FIELD] = self.data[invoice.COST_FIELD]
         self.data[invoice.BALANCE_FIELD] = self.data[invoice.COST_FIELD]
-        self.old_pi_df = self._load_old_pis(self.old_pi_filepath)
+        if self.old_pi_df is None:
+            self.old_pi_df = self._load_old_pis(self.old_pi_filepath)
 
     def _process(self):
         self.data, self.updated_old_pi_df = self._apply_credits_new_pi(
@@ -2,9 +2,10 @@ import sys
 import logging
 from dataclasses import dataclass
 
+import numpy
 import pandas
 
-from process_report import util
+from process_report import util, ingest, s3_transfer
 from process_report.invoices import invoice
 from process_report.processors import discount_processor
 
@@ -27,6 +28,10 @@ class PrepaymentProcessor(discount_processor.DiscountProcessor):
     prepay_contacts: pandas.DataFrame
     prepay_debits_filepath: str
     upload_to_s3: bool
+    # The prepay debits, if already loaded, i.e the debits updated by the
+    # previous month when processing a range of months. Debits passed in are
+    # only updated in memory, for the caller to persist
+    prepay_debits: pandas.DataFrame | None = None
 
     @staticmethod
     def _load_prepay_debits(prepay_debits_filepath):
@@ -38,106 +43,182 @@ class PrepaymentProcessor(discount_processor.DiscountProcessor):
         return prepay_debits
 
     def _prepare(self):
-        self.data[invoice.GROUP_NAME_FIELD] = None
+        if ingest.is_encoded(self.data):
+            self.data[invoice.GROUP_NAME_FIELD] = pandas.Categorical.from_codes(
+                numpy.full(len(self.data), -1),
+                categories=self.prepay_contacts[
+                    invoice.PREPAY_GROUP_NAME_FIELD
+                ].unique(),
+            )
+        else:
+            self.data[invoice.GROUP_NAME_FIELD] = None
         self.data[invoice.GROUP_INSTITUTION_FIELD] = None
         self.data[invoice.GROUP_MANAGED_FIELD] = None
         self.data[invoice.GROUP_BALANCE_FIELD] = None
         self.data[invoice.GROUP_BALANCE_USED_FIELD] = None
 
-        self.prepay_debits = self._load_prepay_debits(self.prepay_debits_filepath)
+        self.is_debits_file = self.prepay_debits is None
+        if self.is_debits_file:
+            self.prepay_debits = self._load_prepay_debits(self.prepay_debits_filepath)
         self.group_info_dict = self._get_prepay_group_dict()
-        if self.upload_to_s3:
+        if self.upload_to_s3 and self.is_debits_file:
             self._backup_s3_prepay_debits()
 
     def _process(self):
         self._add_prepay_info()
         self._apply_prepayments()
 
-        self._export_prepay_debits()
-        if self.upload_to_s3:
-            self._export_s3_prepay_debits()
+        if self.is_debits_file:
+            self._export_prepay_debits()
+            if self.upload_to_s3:
+                self._export_s3_prepay_debits()
+
+    @staticmethod
+    def _reduce_by_group(
+        ufunc, initial_values: pandas.Series, groups: pandas.Series, amounts
+    ) -> pandas.Series:
+        """Reduces every group's amounts onto the group's initial value, one
+        amount at a time in their original order. I.e for `numpy.subtract`,
+        a group's result is `((initial - amount_1) - amount_2) - ...`
+
+        Raises KeyError if a group is not in the index of `initial_values`
+        """
+        results = initial_values.to_numpy(dtype=object).copy()
+        group_codes = initial_values.index.get_indexer(groups)
+        if (is_unknown_group := group_codes < 0).any():
+            raise KeyError(numpy.asarray(groups)[is_unknown_group][0])
+        order = numpy.argsort(group_codes, kind="stable")
+        group_codes = group_codes[order]
+        values = numpy.asarray(amounts, dtype=object)[order]
+
+        if len(group_codes) > 0:
+            group_starts = numpy.flatnonzero(
+                numpy.concatenate(([True], group_codes[1:] != group_codes[:-1]))
+            )
+            reduced_groups = group_codes[group_starts]
+            values = numpy.insert(values, group_starts, results[reduced_groups])
+            results[reduced_groups] = ufunc.reduceat(
+                values, group_starts + numpy.arange(len(group_starts))
+            )
+
+        return pandas.Series(results, index=initial_values.index, dtype=object)
+
+    def get_prepay_balances(self, month=None) -> pandas.Series:
+        """Returns the prepay balance of every group as of `month`, which
+        defaults to the invoice month. A group's balance is the sum of its
+        credits from current and past months, minus its debits from past
+        months. Debits from `month` itself are not included.
+
+        Exits if a group's balance becomes negative after any debit. Raises
+        KeyError if a credit or debit is for a group without contacts
+        """
+        month_ordinal = util.get_month_ordinal(month or self.invoice_month)
+        group_names = pandas.Index(
+            self.prepay_contacts[invoice.PREPAY_GROUP_NAME_FIELD]
+        ).drop_duplicates(keep="last")
+        balances = pandas.Series(0, index=group_names, dtype=object)
+
+        group_credits = self.prepay_credits[
+            util.get_month_ordinals(self.prepay_credits[invoice.PREPAY_MONTH_FIELD])
+            <= month_ordinal
+        ]
+        balances = self._reduce_by_group(
+            numpy.add,
+            balances,
+            group_credits[invoice.PREPAY_GROUP_NAME_FIELD],
+            group_credits[invoice.PREPAY_CREDIT_FIELD],
+        )
+
+        group_debits = self.prepay_debits[
+            util.get_month_ordinals(self.prepay_debits[invoice.PREPAY_MONTH_FIELD])
+            < month_ordinal
+        ]
+        debit_groups = group_debits[invoice.PREPAY_GROUP_NAME_FIELD]
+        debits = group_debits[invoice.PREPAY_DEBIT_FIELD]
+        debited_balances = self._reduce_by_group(
+            numpy.subtract, balances, debit_groups, debits
+        )
+
+        # The balance after each debit is the group's credits minus the
+        # cumulative sum of the group's debits so far
+        debit_codes = balances.index.get_indexer(debit_groups)
+        order = numpy.argsort(debit_codes, kind="stable")
+        sorted_codes = debit_codes[order]
+        cumulative_debits = numpy.cumsum(debits.to_numpy(dtype=object)[order])
+        is_group_start = numpy.concatenate(
+            ([True], sorted_codes[1:] != sorted_codes[:-1])
+        )[: len(sorted_codes)]
+        previous_groups_debits = numpy.concatenate(([0], cumulative_debits[:-1]))[
+            numpy.maximum.accumulate(
+                numpy.where(is_group_start, numpy.arange(len(sorted_codes)), 0)
+            )
+        ]
+        balances_after_debits = balances.to_numpy(dtype=object)[sorted_codes] - (
+            cumulative_debits - previous_groups_debits
+        )
+        if (is_negative := balances_after_debits < 0).any():
+            logger.error(
+                f"Balance for prepay group {balances.index[sorted_codes[is_negative][0]]} is negative!"
+            )
+            sys.exit(1)
+
+        return debited_balances
 
     def _get_prepay_group_dict(self):
         """Loads prepay info into a dict for simpler indexing
         during processing step"""
         prepay_group_dict = dict()
 
-        # Load each group's contact info, and initialize $0 balance and empty project list
-        for _, group_info in self.prepay_contacts.iterrows():
-            group_name = group_info[invoice.PREPAY_GROUP_NAME_FIELD]
-            prepay_group_dict[group_name] = dict()
-            prepay_group_dict[group_name][
-                invoice.PREPAY_GROUP_CONTACT_FIELD
-            ] = group_info[invoice.PREPAY_GROUP_CONTACT_FIELD]
-            prepay_group_dict[group_name][invoice.PREPAY_MANAGED_FIELD] = group_info[
-                invoice.PREPAY_MANAGED_FIELD
-            ]
-            prepay_group_dict[group_name][invoice.GROUP_BALANCE_FIELD] = 0
-            prepay_group_dict[group_name][invoice.PREPAY_PROJECT_FIELD] = []
-
-        # Sum up each group's credits from current and past months
-        for _, group_credit in self.prepay_credits.iterrows():
-            if (
-                util.get_month_diff(
-                    self.invoice_month, group_credit[invoice.PREPAY_MONTH_FIELD]
-                )
-                >= 0
-            ):
-                prepay_group_dict[group_credit[invoice.PREPAY_GROUP_NAME_FIELD]][
-                    invoice.GROUP_BALANCE_FIELD
-                ] += group_credit[invoice.PREPAY_CREDIT_FIELD]
-
-        # Sum up each group's debits from past months. DOES NOT INCLUDE CURRENT MONTH
-        for _, group_debit in self.prepay_debits.iterrows():
-            if (
-                util.get_month_diff(
-                    self.invoice_month, group_debit[invoice.PREPAY_MONTH_FIELD]
-                )
-                > 0
-            ):
-                prepay_group_dict[group_debit[invoice.PREPAY_GROUP_NAME_FIELD]][
-                    invoice.GROUP_BALANCE_FIELD
-                ] -= group_debit[invoice.PREPAY_DEBIT_FIELD]
-
-                if (
-                    prepay_group_dict[group_debit[invoice.PREPAY_GROUP_NAME_FIELD]][
-                        invoice.GROUP_BALANCE_FIELD
-                    ]
-                    < 0
-                ):
-                    logger.error(
-                        f"Balance for prepay group {group_credit[invoice.PREPAY_GROUP_NAME_FIELD]} is negative!"
-                    )
-                    sys.exit(1)
+        # Load each group's contact info, and initialize an empty project list
+        for group_name, contact, is_managed in zip(
+            self.prepay_contacts[invoice.PREPAY_GROUP_NAME_FIELD],
+            self.prepay_contacts[invoice.PREPAY_GROUP_CONTACT_FIELD],
+            self.prepay_contacts[invoice.PREPAY_MANAGED_FIELD],
+        ):
+            prepay_group_dict[group_name] = {
+                invoice.PREPAY_GROUP_CONTACT_FIELD: contact,
+                invoice.PREPAY_MANAGED_FIELD: is_managed,
+                invoice.PREPAY_PROJECT_FIELD: [],
+            }
+
+        for group_name, balance in self.get_prepay_balances().items():
+            prepay_group_dict[group_name][invoice.GROUP_BALANCE_FIELD] = balance
 
         # Populate each group's list of "active" prepay projects
         # Projects' "active" period includes their start and end dates
-        for _, group_project in self.prepay_projects.iterrows():
-            if (
-                util.get_month_diff(
-                    self.invoice_month, group_project[invoice.PREPAY_START_DATE_FIELD]
+        month_ordinal = util.get_month_ordinal(self.invoice_month)
+        active_projects = self.prepay_projects[
+            (
+                util.get_month_ordinals(
+                    self.prepay_projects[invoice.PREPAY_START_DATE_FIELD]
                 )
-                >= 0
-                and util.get_month_diff(
-                    group_project[invoice.PREPAY_END_DATE_FIELD], self.invoice_month
+                <= month_ordinal
+            )
+            & (
+                util.get_month_ordinals(
+                    self.prepay_projects[invoice.PREPAY_END_DATE_FIELD]
                 )
-                >= 0
-            ):
-                prepay_group_dict[group_project[invoice.PREPAY_GROUP_NAME_FIELD]][
-                    invoice.PREPAY_PROJECT_FIELD
-                ].append(group_project[invoice.PREPAY_PROJECT_FIELD])
+                >= month_ordinal
+            )
+        ]
+        for group_name, project in zip(
+            active_projects[invoice.PREPAY_GROUP_NAME_FIELD],
+            active_projects[invoice.PREPAY_PROJECT_FIELD],
+        ):
+            prepay_group_dict[group_name][invoice.PREPAY_PROJECT_FIELD].append(project)
 
         return prepay_group_dict
 
     def _add_prepay_info(self):
         """Populate prepaid group name, institute, and MGHPCC managed field"""
-        institute_list = util.load_institute_list()
-        institute_map = util.get_institute_mapping(institute_list)
+        resolver = util.get_institution_resolver()
 
         for group_name, group_dict in self.group_info_dict.items():
-            group_institute = util.get_institution_from_pi(
-                institute_map, group_dict[invoice.PREPAY_GROUP_CONTACT_FIELD]
-            )
+            group_contact = group_dict[invoice.PREPAY_GROUP_CONTACT_FIELD]
+            if not (group_institute := resolver.lookup(group_contact)):
+                logger.warning(
+                    f"Prepay group {group_name} contact {group_contact} does not match any institution!"
+                )
 
             # Prepay projects are identified by project name, not project - allocation name
             row_mask = self.data[invoice.PROJECT_NAME_FIELD].isin(
@@ -157,18 +238,24 @@ class PrepaymentProcessor(discount_processor.DiscountProcessor):
             ]
 
     def _apply_prepayments(self):
+        prepay_amounts_used = self.apply_flat_discounts(
+            self.data,
+            self.data,
+            invoice.GROUP_NAME_FIELD,
+            pandas.Series(
+                {
+                    group_name: group_dict[invoice.GROUP_BALANCE_FIELD]
+                    for group_name, group_dict in self.group_info_dict.items()
+                },
+                dtype=object,
+            ),
+            invoice.PI_BALANCE_FIELD,
+            invoice.GROUP_BALANCE_USED_FIELD,
+            invoice.BALANCE_FIELD,
+        )
+
         for group_name, group_dict in self.group_info_dict.items():
-            group_projects = self.data[
-                self.data[invoice.GROUP_NAME_FIELD] == group_name
-            ]
-            prepay_amount_used = self.apply_flat_discount(
-                self.data,
-                group_projects,
-                invoice.PI_BALANCE_FIELD,
-                group_dict[invoice.GROUP_BALANCE_FIELD],
-                invoice.GROUP_BALANCE_USED_FIELD,
-                invoice.BALANCE_FIELD,
-            )
+            prepay_amount_used = prepay_amounts_used[group_name]
 
             remaining_prepay_balance = (
                 group_dict[invoice.GROUP_BALANCE_FIELD] - prepay_amount_used
@@ -202,16 +289,22 @@ class PrepaymentProcessor(discount_processor.DiscountProcessor):
                     ] = prepay_amount_used
 
     def _backup_s3_prepay_debits(self):
-        invoice_bucket = util.get_invoice_bucket()
-        invoice_bucket.upload_file(
-            self.prepay_debits_filepath, self.PREPAY_DEBITS_S3_BACKUP_FILEPATH
+        util.upload_to_s3_bucket(
+            [
+                s3_transfer.S3Upload(
+                    self.prepay_debits_filepath, self.PREPAY_DEBITS_S3_BACKUP_FILEPATH
+                )
+            ]
         )
 
     def _export_prepay_debits(self):
         self.prepay_debits.to_csv(self.prepay_debits_filepath, index=False)
 
     def _export_s3_prepay_debits(self):
-        invoice_bucket = util.get_invoice_bucket()
-        invoice_bucket.upload_file(
-            self.prepay_debits_filepath, self.PREPAY_DEBITS_S3_FILEPATH
+        util.upload_to_s3_bucket(
+            [
+                s3_transfer.S3Upload(
+                    self.prepay_debits_filepath, self.PREPAY_DEBITS_S3_FILEPATH
+                )
+            ]
         )
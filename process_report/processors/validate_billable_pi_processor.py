@@ -3,6 +3,7 @@ import logging
 
 import pandas
 
+from process_report import nonbillable, ingest
 from process_report.invoices import invoice
 from process_report.processors import processor
 
@@ -14,6 +15,9 @@ logging.basicConfig(level=logging.INFO)
 class ValidateBillablePIsProcessor(processor.Processor):
     nonbillable_pis: list[str]
     nonbillable_projects: list[str]
+    # Built from the nonbillable lists if not given, i.e to include the
+    # month's timed projects
+    nonbillable_matcher: nonbillable.NonbillableMatcher | None = None
 
     @staticmethod
     def _validate_pi_names(data: pandas.DataFrame):
@@ -25,24 +29,14 @@ class ValidateBillablePIsProcessor(processor.Processor):
                 )
         return pandas.isna(data[invoice.PI_FIELD])
 
-    @staticmethod
-    def _get_billables(
-        data: pandas.DataFrame,
-        nonbillable_pis: list[str],
-        nonbillable_projects: list[str],
-    ):
-        def _str_to_lowercase(data):
-            return data.lower()
-
-        nonbillable_projects_lowercase = [
-            project.lower() for project in nonbillable_projects
-        ]
-        return ~data[invoice.PI_FIELD].isin(nonbillable_pis) & ~data[
-            invoice.PROJECT_FIELD
-        ].apply(_str_to_lowercase).isin(nonbillable_projects_lowercase)
-
     def _process(self):
-        self.data[invoice.IS_BILLABLE_FIELD] = self._get_billables(
-            self.data, self.nonbillable_pis, self.nonbillable_projects
-        )
+        if self.nonbillable_matcher is None:
+            self.nonbillable_matcher = nonbillable.NonbillableMatcher(
+                self.nonbillable_pis, self.nonbillable_projects
+            )
+        nonbillable_rules = self.nonbillable_matcher.match(self.data)
+        self.data[invoice.IS_BILLABLE_FIELD] = nonbillable_rules.isna()
+        if ingest.is_encoded(self.data):
+            nonbillable_rules = nonbillable_rules.astype("category")
+        self.data[invoice.NONBILLABLE_RULE_FIELD] = nonbillable_rules
         self.data[invoice.MISSING_PI_FIELD] = self._validate_pi_names(self.data)
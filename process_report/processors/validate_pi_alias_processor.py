@@ -1,5 +1,6 @@
 from dataclasses import dataclass
 
+from process_report import util
 from process_report.invoices import invoice
 from process_report.processors import processor
 
@@ -7,12 +8,19 @@ from process_report.processors import processor
 @dataclass
 class ValidatePIAliasProcessor(processor.Processor):
     alias_map: dict
+    # The PI of each alias, built from `alias_map` if not given
+    alias_index: dict | None = None
+
+    def _replace_aliases(self, pis):
+        canonical_pis = pis.map(self.alias_index)
+        return pis.where(canonical_pis.isna(), canonical_pis)
 
     def _validate_pi_aliases(self):
-        for pi, pi_aliases in self.alias_map.items():
-            self.data.loc[
-                self.data[invoice.PI_FIELD].isin(pi_aliases), invoice.PI_FIELD
-            ] = pi
+        if self.alias_index is None:
+            self.alias_index = util.get_alias_index(self.alias_map)
+        self.data[invoice.PI_FIELD] = util.map_identifiers(
+            self.data[invoice.PI_FIELD], self._replace_aliases
+        )
 
     def _process(self):
         self._validate_pi_aliases()
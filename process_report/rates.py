@@ -0,0 +1,166 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import tempfile
+
+# requests and nerc_rates are imported when loading the rates, so importing
+# this module stays cheap
+
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+
+DEFAULT_CACHE_DIR = ".rates_cache"
+DEFAULT_TTL = 24 * 60 * 60
+DEFAULT_TIMEOUT = 30
+
+
+class MemoizedRates:
+    """Wraps the NERC rates, looking up each rate once per month"""
+
+    def __init__(self, rates):
+        self.rates = rates
+        self._values = dict()
+
+    def get_value_at(self, name, month, *args):
+        key = (name, month, *args)
+        if key not in self._values:
+            self._values[key] = self.rates.get_value_at(name, month, *args)
+        return self._values[key]
+
+
+class RatesCache:
+    """Keeps the last rates file fetched from `url` in `cache_dir`
+
+    The cached file is used instead of fetching the rates again for `ttl`
+    seconds after it was fetched, as long as its content still matches the
+    digest recorded when it was fetched. If the rates cannot be fetched, a
+    cached file older than `ttl` is used rather than failing the run.
+    """
+
+    MANIFEST_FILENAME = "manifest.json"
+    RATES_FILENAME = "rates.yaml"
+
+    def __init__(
+        self,
+        url=None,
+        cache_dir=DEFAULT_CACHE_DIR,
+        ttl=DEFAULT_TTL,
+        timeout=DEFAULT_TIMEOUT,
+    ):
+        if url is None:
+            from nerc_rates.rates import DEFAULT_RATES_URL
+
+            url = DEFAULT_RATES_URL
+        self.url = url
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.timeout = timeout
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.manifest = self._load_manifest()
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self.cache_dir, self.MANIFEST_FILENAME)
+
+    @property
+    def rates_path(self):
+        return os.path.join(self.cache_dir, self.RATES_FILENAME)
+
+    def _load_manifest(self):
+        try:
+            with open(self.manifest_path) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return dict()
+
+    def _save_manifest(self):
+        with tempfile.NamedTemporaryFile(
+            "w", dir=self.cache_dir, delete=False
+        ) as manifest_file:
+            json.dump(self.manifest, manifest_file, indent=2, sort_keys=True)
+        os.replace(manifest_file.name, self.manifest_path)
+
+    def _is_cached(self):
+        """Returns if the cached rates file is the one last fetched from
+        `url`, regardless of its age"""
+        try:
+            with open(self.rates_path, "rb") as f:
+                digest = hashlib.sha256(f.read()).hexdigest()
+        except FileNotFoundError:
+            return False
+        return (
+            self.manifest.get("url") == self.url
+            and self.manifest.get("sha256") == digest
+        )
+
+    def _is_fresh(self):
+        return time.time() - self.manifest.get("fetched_at", 0) < self.ttl
+
+    def _fetch(self):
+        import requests
+        import nerc_rates
+
+        response = requests.get(self.url, allow_redirects=True, timeout=self.timeout)
+        response.raise_for_status()
+
+        # Only replace the cached file once the new rates are known to be valid
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(response.content)
+            nerc_rates.load_from_file(tmp_path)
+            os.replace(tmp_path, self.rates_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        self.manifest = {
+            "url": self.url,
+            "sha256": hashlib.sha256(response.content).hexdigest(),
+            "fetched_at": time.time(),
+        }
+        self._save_manifest()
+
+    def load(self):
+        """Returns the rates, fetching them only if the cached rates are
+        missing, invalid or older than `ttl`"""
+        import requests
+        import nerc_rates
+
+        is_cached = self._is_cached()
+        if is_cached and self._is_fresh():
+            logger.info(f"Using rates cached in {self.rates_path}")
+        else:
+            try:
+                self._fetch()
+                logger.info(f"Fetched rates from {self.url}")
+            except requests.RequestException as e:
+                if not is_cached:
+                    raise
+                logger.warning(
+                    f"Failed to fetch rates ({e}), using stale rates cached in {self.rates_path}"
+                )
+
+        return nerc_rates.load_from_file(self.rates_path)
+
+
+def load_rates(rates_file=None, cache_dir=DEFAULT_CACHE_DIR, ttl=DEFAULT_TTL):
+    """Returns the NERC rates, with each rate memoized per month
+
+    With `rates_file`, the rates are read from that file without using the
+    network. Otherwise they are fetched through a `RatesCache` in `cache_dir`.
+    """
+    if rates_file:
+        import nerc_rates
+
+        logger.info(f"Using rates from {rates_file}")
+        rates = nerc_rates.load_from_file(rates_file)
+    else:
+        rates = RatesCache(cache_dir=cache_dir, ttl=ttl).load()
+
+    return MemoizedRates(rates)
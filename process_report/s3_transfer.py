@@ -0,0 +1,308 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+import tempfile
+import threading
+import functools
+import concurrent.futures
+from dataclasses import dataclass, field
+
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+
+DEFAULT_CACHE_DIR = ".s3_cache"
+DEFAULT_MAX_WORKERS = 8
+DEFAULT_MULTIPART_THRESHOLD = 8 * 1024 * 1024
+DEFAULT_MULTIPART_CHUNKSIZE = 8 * 1024 * 1024
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_BACKOFF = 1.0
+
+
+@functools.cache
+def get_retryable_errors():
+    """Returns the errors worth retrying. Failed uploads surface as
+    `S3UploadFailedError`. boto3 is only imported once S3 is used"""
+    import boto3.exceptions
+    import botocore.exceptions
+
+    return (
+        botocore.exceptions.BotoCoreError,
+        botocore.exceptions.ClientError,
+        boto3.exceptions.S3UploadFailedError,
+    )
+
+
+@dataclass
+class S3Object:
+    key: str
+    etag: str
+    size: int
+    local_path: str
+
+
+@dataclass
+class DownloadStats:
+    fetched_files: int = 0
+    fetched_bytes: int = 0
+    cached_files: int = 0
+    cached_bytes: int = 0
+
+    def __str__(self):
+        return (
+            f"fetched {self.fetched_files} files ({self.fetched_bytes} bytes) from S3, "
+            f"served {self.cached_files} files ({self.cached_bytes} bytes) from cache"
+        )
+
+
+class S3Downloader:
+    """Downloads S3 objects concurrently through a local content cache
+
+    Every downloaded object is kept in `cache_dir`, along with the ETag and
+    size it had in S3. When an object is requested again and S3 still
+    reports the same ETag and size, the cached copy is used instead of
+    downloading it again. The cached copy is always copied to the requested
+    local path, since the local file may later be modified by the run.
+    """
+
+    MANIFEST_FILENAME = "manifest.json"
+
+    def __init__(
+        self, s3_bucket, cache_dir=DEFAULT_CACHE_DIR, max_workers=DEFAULT_MAX_WORKERS
+    ):
+        self.s3_bucket = s3_bucket
+        self.cache_dir = cache_dir
+        self.max_workers = max_workers
+        self._stats_lock = threading.Lock()
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.manifest = self._load_manifest()
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self.cache_dir, self.MANIFEST_FILENAME)
+
+    def _load_manifest(self):
+        try:
+            with open(self.manifest_path) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return dict()
+
+    def _save_manifest(self):
+        with tempfile.NamedTemporaryFile(
+            "w", dir=self.cache_dir, delete=False
+        ) as manifest_file:
+            json.dump(self.manifest, manifest_file, indent=2, sort_keys=True)
+        os.replace(manifest_file.name, self.manifest_path)
+
+    def _cache_path(self, key):
+        return os.path.join(self.cache_dir, hashlib.sha256(key.encode()).hexdigest())
+
+    def _is_cached(self, s3_object: S3Object):
+        cache_entry = self.manifest.get(s3_object.key)
+        cache_path = self._cache_path(s3_object.key)
+        return (
+            cache_entry == {"etag": s3_object.etag, "size": s3_object.size}
+            and os.path.exists(cache_path)
+            and os.path.getsize(cache_path) == s3_object.size
+        )
+
+    def _fetch(self, s3_object: S3Object, stats: DownloadStats):
+        cache_path = self._cache_path(s3_object.key)
+        if self._is_cached(s3_object):
+            with self._stats_lock:
+                stats.cached_files += 1
+                stats.cached_bytes += s3_object.size
+        else:
+            # Download to a temporary file first, so an interrupted download
+            # never leaves a partial object in the cache
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir)
+            os.close(fd)
+            try:
+                # Clients are thread-safe, unlike the bucket resource
+                self.s3_bucket.meta.client.download_file(
+                    self.s3_bucket.name, s3_object.key, tmp_path
+                )
+                os.replace(tmp_path, cache_path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+            with self._stats_lock:
+                stats.fetched_files += 1
+                stats.fetched_bytes += s3_object.size
+
+        shutil.copyfile(cache_path, s3_object.local_path)
+        return s3_object
+
+    def head(self, key, local_path=None) -> S3Object:
+        """Returns the current ETag and size of a single S3 object"""
+        response = self.s3_bucket.meta.client.head_object(
+            Bucket=self.s3_bucket.name, Key=key
+        )
+        if local_path is None:
+            local_path = os.path.basename(key)
+        return S3Object(key, response["ETag"], response["ContentLength"], local_path)
+
+    def list_prefix(self, prefix) -> list[S3Object]:
+        """Lists all objects under `prefix`, to be downloaded by their basename"""
+        return [
+            S3Object(obj.key, obj.e_tag, obj.size, obj.key.split("/")[-1])
+            for obj in self.s3_bucket.objects.filter(Prefix=prefix)
+        ]
+
+    def download(self, s3_objects: list[S3Object]) -> DownloadStats:
+        """Downloads all `s3_objects` to their local paths, using at most
+        `max_workers` concurrent transfers"""
+        stats = DownloadStats()
+        with concurrent.futures.ThreadPoolExecutor(self.max_workers) as executor:
+            futures = [
+                executor.submit(self._fetch, s3_object, stats)
+                for s3_object in s3_objects
+            ]
+            try:
+                for future in concurrent.futures.as_completed(futures):
+                    s3_object = future.result()
+                    self.manifest[s3_object.key] = {
+                        "etag": s3_object.etag,
+                        "size": s3_object.size,
+                    }
+            finally:
+                # Keep whatever was downloaded, even if another transfer failed
+                self._save_manifest()
+
+        logger.info(f"S3 download: {stats}")
+        return stats
+
+
+@dataclass
+class S3Upload:
+    """A local file to upload to `key`. If `archive_key` is set, the
+    uploaded object is then copied to it"""
+
+    local_path: str
+    key: str
+    archive_key: str | None = None
+
+
+@dataclass
+class UploadStats:
+    uploaded_files: int = 0
+    uploaded_bytes: int = 0
+    archived_files: int = 0
+    retries: int = 0
+    elapsed_seconds: float = 0.0
+    failed: list[tuple[str, str]] = field(default_factory=list)
+
+    def __str__(self):
+        summary = (
+            f"uploaded {self.uploaded_files} files ({self.uploaded_bytes} bytes), "
+            f"archived {self.archived_files} files, in {self.elapsed_seconds:.2f}s "
+            f"({self.uploaded_bytes / max(self.elapsed_seconds, 1e-9) / 1024 / 1024:.2f} MiB/sec), "
+            f"{self.retries} retries, {len(self.failed)} failed"
+        )
+        for key, error in self.failed:
+            summary += f"\n  {key}: {error}"
+        return summary
+
+
+class S3Uploader:
+    """Uploads files to S3 concurrently
+
+    Each file is uploaded once. Its archive copy is made with a server-side
+    copy of the uploaded object, so the file is only transferred once.
+    Files larger than `multipart_threshold` are uploaded in parts of
+    `multipart_chunksize` bytes. Failed transfers are retried up to
+    `max_attempts` times in total, waiting `backoff`, then twice as long,
+    between attempts. Files that still fail are reported in the returned
+    stats, and do not stop the other uploads.
+    """
+
+    def __init__(
+        self,
+        s3_bucket,
+        max_workers=DEFAULT_MAX_WORKERS,
+        multipart_threshold=DEFAULT_MULTIPART_THRESHOLD,
+        multipart_chunksize=DEFAULT_MULTIPART_CHUNKSIZE,
+        max_attempts=DEFAULT_MAX_ATTEMPTS,
+        backoff=DEFAULT_BACKOFF,
+    ):
+        from boto3.s3.transfer import TransferConfig
+
+        self.s3_bucket = s3_bucket
+        self.max_workers = max_workers
+        self.transfer_config = TransferConfig(
+            multipart_threshold=multipart_threshold,
+            multipart_chunksize=multipart_chunksize,
+        )
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self._stats_lock = threading.Lock()
+
+    def _retry(self, transfer, stats: UploadStats):
+        for attempt in range(self.max_attempts):
+            try:
+                return transfer()
+            except get_retryable_errors():
+                if attempt == self.max_attempts - 1:
+                    raise
+                with self._stats_lock:
+                    stats.retries += 1
+                time.sleep(self.backoff * 2**attempt)
+
+    def _upload(self, s3_upload: S3Upload, stats: UploadStats):
+        # Clients are thread-safe, unlike the bucket resource
+        s3_client = self.s3_bucket.meta.client
+        self._retry(
+            lambda: s3_client.upload_file(
+                s3_upload.local_path,
+                self.s3_bucket.name,
+                s3_upload.key,
+                Config=self.transfer_config,
+            ),
+            stats,
+        )
+        with self._stats_lock:
+            stats.uploaded_files += 1
+            stats.uploaded_bytes += os.path.getsize(s3_upload.local_path)
+
+        if s3_upload.archive_key:
+            self._retry(
+                lambda: s3_client.copy(
+                    {"Bucket": self.s3_bucket.name, "Key": s3_upload.key},
+                    self.s3_bucket.name,
+                    s3_upload.archive_key,
+                    Config=self.transfer_config,
+                ),
+                stats,
+            )
+            with self._stats_lock:
+                stats.archived_files += 1
+
+    def upload(self, s3_uploads: list[S3Upload]) -> UploadStats:
+        """Uploads all `s3_uploads`, using at most `max_workers` concurrent
+        transfers"""
+        stats = UploadStats()
+        start = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(self.max_workers) as executor:
+            futures = {
+                executor.submit(self._upload, s3_upload, stats): s3_upload
+                for s3_upload in s3_uploads
+            }
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    future.result()
+                except (*get_retryable_errors(), OSError) as e:
+                    stats.failed.append((futures[future].key, repr(e)))
+
+        stats.elapsed_seconds = time.perf_counter() - start
+        stats.failed.sort()
+        if stats.failed:
+            logger.error(f"S3 upload: {stats}")
+        else:
+            logger.info(f"S3 upload: {stats}")
+        return stats
@@ -0,0 +1,83 @@
+"""Compares institution resolution against the previous row-by-row loop
+
+Run from the repository root:
+
+    python -m process_report.tests.benchmarks.bench_add_institution --rows 1000000
+"""
+
+import argparse
+import logging
+import time
+
+import numpy
+import pandas
+
+from process_report import util
+from process_report.invoices import invoice
+from process_report.tests import util as test_utils
+
+
+def legacy_add_institution(data):
+    """Row-by-row implementation the processor used before"""
+    institute_map = util.get_institute_mapping(util.load_institute_list())
+    data = data.astype({invoice.INSTITUTION_FIELD: "str"})
+    for i, row in data.iterrows():
+        pi_name = row[invoice.PI_FIELD]
+        if not pandas.isna(pi_name):
+            data.at[i, invoice.INSTITUTION_FIELD] = util.match_institution_from_pi(
+                institute_map, pi_name
+            )
+    return data
+
+
+def generate_invoice(rows, pis, seed=0):
+    rng = numpy.random.default_rng(seed)
+    domains = [
+        domain
+        for institute_info in util.load_institute_list()
+        for domain in institute_info["domains"]
+    ] + ["unknown.org"]
+    pi_names = numpy.array(
+        [f"pi{i}@{domains[i % len(domains)]}" for i in range(pis)], dtype=object
+    )
+    pi_column = pi_names[rng.integers(0, pis, rows)]
+    pi_column[rng.random(rows) < 0.01] = None
+    return pandas.DataFrame(
+        {
+            invoice.PROJECT_FIELD: [
+                f"project{i}" for i in rng.integers(0, pis * 2, rows)
+            ],
+            invoice.PI_FIELD: pi_column,
+            invoice.INSTITUTION_FIELD: None,
+        }
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--pis", type=int, default=5_000)
+    parser.add_argument(
+        "--skip-legacy", action="store_true", help="Only time the current processor"
+    )
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    data = generate_invoice(args.rows, args.pis)
+
+    start = time.perf_counter()
+    add_institution_proc = test_utils.new_add_institution_processor(data=data)
+    add_institution_proc.process()
+    vectorized_time = time.perf_counter() - start
+    print(f"vectorized: {vectorized_time:.3f}s for {args.rows} rows")
+
+    if not args.skip_legacy:
+        start = time.perf_counter()
+        legacy_data = legacy_add_institution(data)
+        legacy_time = time.perf_counter() - start
+        print(f"legacy:     {legacy_time:.3f}s ({legacy_time / vectorized_time:.0f}x)")
+        assert legacy_data.equals(add_institution_proc.data)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""Compares the BU-Internal project roll-up against the previous per-project loop
+
+Run from the repository root:
+
+    python -m process_report.tests.benchmarks.bench_bu_internal
+
+Times both at BU scale and 10x BU scale.
+"""
+
+import argparse
+import time
+from decimal import Decimal
+
+import numpy
+import pandas
+import pyarrow
+
+from process_report.invoices import bu_internal_invoice, invoice
+
+BU_SCALE_PROJECTS = 2_000
+ALLOCATIONS_PER_PROJECT = 5
+
+
+def legacy_sum_project_allocations(dataframe):
+    """Per-project implementation the invoice used before"""
+    project_list = dataframe[invoice.PROJECT_NAME_FIELD].unique()
+    data_no_dup = dataframe.drop_duplicates(invoice.PROJECT_NAME_FIELD, inplace=False)
+    sum_fields = bu_internal_invoice.BUInternalInvoice.aggregation_sum_fields
+    for project in project_list:
+        project_mask = dataframe[invoice.PROJECT_NAME_FIELD] == project
+        no_dup_project_mask = data_no_dup[invoice.PROJECT_NAME_FIELD] == project
+
+        sum_fields_sums = dataframe[project_mask][sum_fields].sum().values
+        data_no_dup.loc[no_dup_project_mask, sum_fields] = sum_fields_sums
+
+    return data_no_dup
+
+
+def generate_invoice(projects, seed=0):
+    rng = numpy.random.default_rng(seed)
+    rows = projects * ALLOCATIONS_PER_PROJECT
+    decimal_type = pandas.ArrowDtype(pyarrow.decimal128(12, 2))
+
+    def random_decimals():
+        return pandas.Series(
+            [Decimal(int(c)).scaleb(-2) for c in rng.integers(0, 100_000, rows)],
+            dtype=decimal_type,
+        )
+
+    return pandas.DataFrame(
+        {
+            invoice.INVOICE_DATE_FIELD: "2024-06",
+            invoice.PI_FIELD: [f"pi{i % (projects // 2)}@bu.edu" for i in range(rows)],
+            invoice.PROJECT_NAME_FIELD: [
+                f"project{i}" for i in rng.integers(0, projects, rows)
+            ],
+            invoice.COST_FIELD: random_decimals(),
+            invoice.CREDIT_FIELD: numpy.where(
+                rng.random(rows) < 0.2, Decimal("10.00"), None
+            ),
+            invoice.SUBSIDY_FIELD: Decimal(0),
+            invoice.PI_BALANCE_FIELD: random_decimals(),
+        }
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--skip-legacy", action="store_true", help="Only time the grouped roll-up"
+    )
+    args = parser.parse_args()
+
+    for scale in [1, 10]:
+        data = generate_invoice(BU_SCALE_PROJECTS * scale)
+        bu_inv = bu_internal_invoice.BUInternalInvoice("", "2024-06", data)
+
+        start = time.perf_counter()
+        aggregated_data = bu_inv._aggregate(data)
+        grouped_time = time.perf_counter() - start
+        print(
+            f"{scale}x BU scale ({len(data)} rows): grouped {grouped_time:.3f}s",
+            end="",
+        )
+
+        if not args.skip_legacy:
+            start = time.perf_counter()
+            legacy_data = legacy_sum_project_allocations(data)
+            legacy_time = time.perf_counter() - start
+            print(
+                f", per-project {legacy_time:.3f}s ({legacy_time / grouped_time:.0f}x)",
+                end="",
+            )
+            assert aggregated_data.to_csv() == legacy_data.to_csv()
+        print()
+
+
+if __name__ == "__main__":
+    main()
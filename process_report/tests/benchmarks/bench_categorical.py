@@ -0,0 +1,77 @@
+"""Compares the memory and run time of processing with identifiers kept as
+categoricals against keeping them as Python strings
+
+Run from the repository root:
+
+    python -m process_report.tests.benchmarks.bench_categorical --rows 1000000 --pis 10000
+"""
+
+import argparse
+import logging
+import os
+import shutil
+import tempfile
+
+from process_report import ingest
+from process_report.tests.benchmarks import bench_pipeline, synthetic
+
+
+def get_memory_usage(dataframe, fields) -> int:
+    return int(
+        dataframe[[field for field in fields if field in dataframe]]
+        .memory_usage(deep=True, index=False)
+        .sum()
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--pis", type=int, default=1_000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    results = dict()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_dir = os.path.join(tmp_dir, "data")
+        synthetic.generate_workload(data_dir, args.rows, args.pis, args.seed)
+        cwd = os.getcwd()
+        for mode, categorical_identifiers in [("object", False), ("categorical", True)]:
+            run_dir = os.path.join(tmp_dir, mode)
+            shutil.copytree(data_dir, run_dir)
+            os.chdir(run_dir)
+            frames = dict()
+            try:
+                timings = bench_pipeline.time_stages(
+                    synthetic.get_workload(run_dir), categorical_identifiers, frames
+                )
+            finally:
+                os.chdir(cwd)
+
+            identifier_fields = ingest.CATEGORICAL_FIELDS + [
+                "Institution",
+                "Project",
+                "Prepaid Group Name",
+            ]
+            results[mode] = {
+                "identifiers MB": get_memory_usage(
+                    frames["processed"], identifier_fields
+                )
+                / 1e6,
+                "processed MB": frames["processed"].memory_usage(deep=True).sum() / 1e6,
+                **{f"{stage} s": seconds for stage, seconds in timings.items()},
+                "total s": sum(timings.values()),
+            }
+
+    print(f"{'':>28} {'object':>10} {'categorical':>12} {'ratio':>7}")
+    for metric, value in results["object"].items():
+        categorical_value = results["categorical"][metric]
+        print(
+            f"{metric:>28} {value:10.3f} {categorical_value:12.3f} "
+            f"{categorical_value / max(value, 1e-9):7.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""Compares batch flat discounts against applying them one PI at a time
+
+Run from the repository root:
+
+    python -m process_report.tests.benchmarks.bench_discounts --pis 100000
+
+The per-PI loop filters the whole invoice for every PI, so it is only timed
+on the first `--legacy-pis` PIs and extrapolated to all of them.
+"""
+
+import argparse
+import time
+from decimal import Decimal
+
+import numpy
+import pandas
+import pyarrow
+
+from process_report.invoices import invoice
+from process_report.tests import util as test_utils
+
+
+def generate_invoice(pis, projects_per_pi, seed=0):
+    rng = numpy.random.default_rng(seed)
+    rows = pis * projects_per_pi
+    cents = rng.integers(0, 200_000, rows)
+    balances = pandas.Series(
+        [Decimal(int(c)).scaleb(-2) for c in cents],
+        dtype=pandas.ArrowDtype(pyarrow.decimal128(12, 2)),
+    )
+    return pandas.DataFrame(
+        {
+            invoice.PI_FIELD: [f"pi{i}" for i in rng.permutation(rows) % pis],
+            invoice.PI_BALANCE_FIELD: balances,
+            invoice.BALANCE_FIELD: balances.copy(),
+            invoice.CREDIT_FIELD: None,
+            invoice.CREDIT_CODE_FIELD: None,
+        }
+    )
+
+
+def apply_discounts(data, discount_amounts, batch):
+    discount_proc = test_utils.new_discount_processor()
+    args = (
+        invoice.PI_BALANCE_FIELD,
+        invoice.CREDIT_FIELD,
+        invoice.BALANCE_FIELD,
+        invoice.CREDIT_CODE_FIELD,
+        "0002",
+    )
+    if batch:
+        discount_proc.apply_flat_discounts(
+            data, data, invoice.PI_FIELD, discount_amounts, *args
+        )
+    else:
+        for pi, discount_amount in discount_amounts.items():
+            discount_proc.apply_flat_discount(
+                data,
+                data[data[invoice.PI_FIELD] == pi],
+                args[0],
+                discount_amount,
+                *args[1:],
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pis", type=int, default=100_000)
+    parser.add_argument("--projects-per-pi", type=int, default=3)
+    parser.add_argument("--legacy-pis", type=int, default=1_000)
+    args = parser.parse_args()
+
+    data = generate_invoice(args.pis, args.projects_per_pi)
+    pi_list = data[invoice.PI_FIELD].unique()
+    discount_amounts = pandas.Series(1000, index=pi_list, dtype=object)
+
+    batch_data = data.copy()
+    start = time.perf_counter()
+    apply_discounts(batch_data, discount_amounts, batch=True)
+    batch_time = time.perf_counter() - start
+    print(f"batch:   {batch_time:.3f}s for {len(pi_list)} PIs, {len(data)} rows")
+
+    legacy_amounts = discount_amounts.iloc[: args.legacy_pis]
+    legacy_data = data.copy()
+    start = time.perf_counter()
+    apply_discounts(legacy_data, legacy_amounts, batch=False)
+    legacy_time = (
+        (time.perf_counter() - start) * len(discount_amounts) / len(legacy_amounts)
+    )
+    print(
+        f"per-PI:  {legacy_time:.3f}s extrapolated from {len(legacy_amounts)} PIs "
+        f"({legacy_time / batch_time:.0f}x)"
+    )
+
+    legacy_rows = legacy_data[invoice.PI_FIELD].isin(legacy_amounts.index)
+    assert legacy_data[legacy_rows].equals(batch_data[legacy_rows])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""Times importing the entry point with `python -X importtime`, and checks
+that modules only some runs need are not imported with it
+
+Run from the repository root:
+
+    python -m process_report.tests.benchmarks.bench_import
+
+Exits with an error if the entry point imports any of `LAZY_MODULES`, or if
+importing it took more than `--threshold` longer than its baseline in
+`baselines.json`. As for the pipeline benchmarks, the baseline is stored as
+a ratio to the reference workload timed in the same run, and is refreshed
+with `--update-baselines`.
+"""
+
+import argparse
+import subprocess
+import sys
+
+from process_report.tests.benchmarks import bench_pipeline
+
+ENTRY_POINT = "process_report.process_report"
+BASELINES_KEY = "import"
+# Only imported once a run needs them, i.e to process a month or use S3, so
+# that `--help` and argument errors do not load them
+LAZY_MODULES = [
+    "boto3",
+    "botocore",
+    "nerc_rates",
+    "requests",
+    "numpy",
+    "pandas",
+    "pyarrow",
+    "pyarrow.parquet",
+    "process_report.checkpoint",
+    "process_report.ingest",
+    "process_report.util",
+    "process_report.invoices.invoice",
+    "process_report.invoices.billable_invoice",
+    "process_report.invoices.pi_specific_invoice",
+    "process_report.processors.new_pi_credit_processor",
+    "process_report.processors.prepayment_processor",
+]
+
+
+def time_import(module) -> tuple[float, set[str]]:
+    """Returns how long importing `module` took in a fresh interpreter, and
+    every module it imported"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    cumulative_times = dict()
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative_us, name = line.split("|")
+        cumulative_times[name.strip()] = int(cumulative_us) / 1_000_000
+
+    return cumulative_times[module], set(cumulative_times)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--repeat", type=int, default=5, help="Keeps the best of this many runs"
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=bench_pipeline.DEFAULT_THRESHOLD,
+        help="Fails if importing is this much slower than its baseline, i.e 0.25 for 25%%",
+    )
+    parser.add_argument(
+        "--update-baselines",
+        action="store_true",
+        help="Stores this run's import time as the baseline",
+    )
+    args = parser.parse_args()
+
+    timings = list()
+    for _ in range(args.repeat):
+        import_seconds, imported_modules = time_import(ENTRY_POINT)
+        timings.append(import_seconds)
+    seconds = min(timings)
+
+    errors = list()
+    reference_seconds = bench_pipeline.time_reference()
+    baseline_ratio = (
+        bench_pipeline.load_baselines()
+        .get(BASELINES_KEY, dict())
+        .get("ratios", dict())
+        .get(ENTRY_POINT)
+    )
+    line, is_regression = bench_pipeline.compare_to_baseline(
+        ENTRY_POINT, seconds, reference_seconds, baseline_ratio, args.threshold
+    )
+    if is_regression and not args.update_baselines:
+        errors.append(f"import regressed by more than {args.threshold:.0%}")
+    print(line)
+
+    if eager_modules := sorted(set(LAZY_MODULES) & imported_modules):
+        errors.append(f"{ENTRY_POINT} imports {', '.join(eager_modules)}")
+
+    if args.update_baselines:
+        bench_pipeline.update_baselines(
+            BASELINES_KEY, {ENTRY_POINT: seconds}, reference_seconds
+        )
+    if errors:
+        sys.exit("; ".join(errors))
+
+
+if __name__ == "__main__":
+    main()
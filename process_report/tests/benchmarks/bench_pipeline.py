@@ -0,0 +1,356 @@
+"""Times every processor, every invoice and the whole of `main()` on
+synthetic data, and compares them against stored baselines
+
+Run from the repository root:
+
+    python -m process_report.tests.benchmarks.bench_pipeline --size small
+
+Exits with an error if any timing regressed by more than `--threshold`
+compared to `baselines.json`. Absolute timings depend on the machine, so
+each run also times a fixed pandas workload, the reference, and baselines
+are stored as ratios of every timing to the reference. A baseline recorded
+on one machine is then scaled to the machine running the benchmark.
+
+Baselines are refreshed by running each size, and the import benchmark,
+with `--update-baselines` on the tip of the branch, after an intended
+change in performance:
+
+    python -m process_report.tests.benchmarks.bench_pipeline --size small --update-baselines
+    python -m process_report.tests.benchmarks.bench_pipeline --size medium --update-baselines
+    python -m process_report.tests.benchmarks.bench_import --update-baselines
+
+and committing `baselines.json` along with the change.
+"""
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+import types
+from unittest import mock
+
+import numpy
+import pandas
+
+from process_report import process_report, rates
+from process_report.invoices import (
+    lenovo_invoice,
+    nonbillable_invoice,
+    billable_invoice,
+    NERC_total_invoice,
+    bu_internal_invoice,
+    pi_specific_invoice,
+    MOCA_prepaid_invoice,
+)
+from process_report.processors import (
+    validate_pi_alias_processor,
+    add_institution_processor,
+    lenovo_processor,
+    validate_billable_pi_processor,
+    new_pi_credit_processor,
+    bu_subsidy_processor,
+    prepayment_processor,
+)
+from process_report.tests.benchmarks import synthetic
+
+# Service invoice rows and PIs of each workload size
+SIZES = {
+    "small": (10_000, 100),
+    "medium": (1_000_000, 10_000),
+    "large": (10_000_000, 100_000),
+}
+BASELINES_PATH = os.path.join(os.path.dirname(__file__), "baselines.json")
+DEFAULT_THRESHOLD = 0.25
+# Timings this close to their baseline are noise, whatever the ratio
+MIN_REGRESSION_SECONDS = 0.05
+
+# Rows of the reference workload, which takes a few tenths of a second
+REFERENCE_ROWS = 100_000
+
+# Rates are normally fetched from the network
+OFFLINE_RATES = types.SimpleNamespace(get_value_at=lambda name, month: "False")
+
+
+def time_stages(
+    workload: synthetic.Workload, categorical_identifiers=False, frames=None
+) -> dict[str, float]:
+    """Runs the processors and invoices the way `main()` does, timing each.
+    If given, `frames` gets the merged and the processed data"""
+    timings = dict()
+
+    def timed(name, func):
+        start = time.perf_counter()
+        result = func()
+        timings[name] = time.perf_counter() - start
+        return result
+
+    invoice_month = workload.invoice_month
+    with open(workload.nonbillable_pis) as f:
+        nonbillable_pis = [line.rstrip() for line in f]
+    with open(workload.nonbillable_projects) as f:
+        nonbillable_projects = [line.rstrip() for line in f]
+    nonbillable_projects += process_report.timed_projects(
+        workload.timed_projects, invoice_month
+    )
+    prepay_credits, prepay_projects, prepay_contacts = process_report.load_prepay_csv(
+        workload.prepay_credits, workload.prepay_projects, workload.prepay_contacts
+    )
+
+    data = timed(
+        "merge",
+        lambda: process_report.merge_csv(
+            workload.service_invoices, categorical_identifiers=categorical_identifiers
+        ),
+    )
+    if frames is not None:
+        frames["merged"] = data
+    processors = [
+        (
+            "validate_pi_alias",
+            lambda data: validate_pi_alias_processor.ValidatePIAliasProcessor(
+                "", invoice_month, data, process_report.load_alias(workload.alias_file)
+            ),
+        ),
+        (
+            "add_institution",
+            lambda data: add_institution_processor.AddInstitutionProcessor(
+                "", invoice_month, data
+            ),
+        ),
+        (
+            "lenovo",
+            lambda data: lenovo_processor.LenovoProcessor("", invoice_month, data),
+        ),
+        (
+            "validate_billable_pi",
+            lambda data: validate_billable_pi_processor.ValidateBillablePIsProcessor(
+                "", invoice_month, data, nonbillable_pis, nonbillable_projects
+            ),
+        ),
+        (
+            "new_pi_credit",
+            lambda data: new_pi_credit_processor.NewPICreditProcessor(
+                "", invoice_month, data=data, old_pi_filepath=workload.old_pi_file
+            ),
+        ),
+        (
+            "bu_subsidy",
+            lambda data: bu_subsidy_processor.BUSubsidyProcessor(
+                "", invoice_month, data, 100
+            ),
+        ),
+        (
+            "prepayment",
+            lambda data: prepayment_processor.PrepaymentProcessor(
+                "",
+                invoice_month,
+                data,
+                prepay_credits,
+                prepay_projects,
+                prepay_contacts,
+                workload.prepay_debits,
+                False,
+            ),
+        ),
+    ]
+    for name, new_processor in processors:
+        proc = new_processor(data)
+        if name == "new_pi_credit":
+            new_pi_credit_proc = proc
+        timed(name, proc.process)
+        data = proc.data
+    if frames is not None:
+        frames["processed"] = data
+
+    invoices = [
+        lenovo_invoice.LenovoInvoice("Lenovo", invoice_month, data),
+        nonbillable_invoice.NonbillableInvoice(
+            "nonbillable", invoice_month, data, nonbillable_pis, nonbillable_projects
+        ),
+        billable_invoice.BillableInvoice(
+            "billable",
+            invoice_month,
+            data,
+            workload.old_pi_file,
+            new_pi_credit_proc.updated_old_pi_df,
+        ),
+        NERC_total_invoice.NERCTotalInvoice("NERC", invoice_month, data),
+        bu_internal_invoice.BUInternalInvoice("BU_Internal", invoice_month, data),
+        pi_specific_invoice.PIInvoice("pi_invoices", invoice_month, data),
+        MOCA_prepaid_invoice.MOCAPrepaidInvoice("", invoice_month, data.copy()),
+    ]
+    for inv in invoices:
+
+        def process_and_export(inv=inv):
+            inv.process()
+            inv.export()
+
+        timed(type(inv).__name__, process_and_export)
+
+    return timings
+
+
+def time_main(workload: synthetic.Workload) -> float:
+    argv = ["process_report", *workload.main_args(), "--no-checkpoint"]
+    with (
+        mock.patch.object(sys, "argv", argv),
+        mock.patch.object(rates, "load_rates", return_value=OFFLINE_RATES),
+    ):
+        start = time.perf_counter()
+        process_report.main()
+        return time.perf_counter() - start
+
+
+def run_benchmarks(rows, pis, seed, repeat) -> dict[str, float]:
+    """Returns the best time of every stage and of `main()` over `repeat`
+    runs, each on a fresh copy of the generated data"""
+    best_timings = dict()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_dir = os.path.join(tmp_dir, "data")
+        start = time.perf_counter()
+        synthetic.generate_workload(data_dir, rows, pis, seed)
+        print(
+            f"Generated {rows} rows for {pis} PIs in {time.perf_counter() - start:.1f}s"
+        )
+
+        cwd = os.getcwd()
+        for i in range(repeat):
+            for name, run in [("stages", time_stages), ("main", time_main)]:
+                # Invoices are written to the working directory, and
+                # processing updates the old PI and prepay debit files
+                run_dir = os.path.join(tmp_dir, f"{name}{i}")
+                shutil.copytree(data_dir, run_dir)
+                os.chdir(run_dir)
+                try:
+                    timings = run(synthetic.get_workload(run_dir))
+                finally:
+                    os.chdir(cwd)
+                if name == "main":
+                    timings = {"main": timings}
+                for stage, seconds in timings.items():
+                    best_timings[stage] = min(seconds, best_timings.get(stage, seconds))
+
+    return best_timings
+
+
+def time_reference(repeat=5) -> float:
+    """Returns the best time of a fixed pandas workload over `repeat` runs.
+    Like the pipeline, it parses, groups and sorts identifiers and sums
+    amounts, so it scales with the machine the same way"""
+    rng = numpy.random.default_rng(0)
+    frame = pandas.DataFrame(
+        {
+            "PI": [f"pi{i}@example.com" for i in rng.integers(0, 1000, REFERENCE_ROWS)],
+            "Cost": rng.random(REFERENCE_ROWS),
+        }
+    )
+    timings = list()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        frame["PI"].str.split("@").str[-1].value_counts()
+        frame.groupby("PI")["Cost"].sum()
+        frame.sort_values(["PI", "Cost"])
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def compare_to_baseline(
+    stage, seconds, reference_seconds, baseline_ratio, threshold
+) -> tuple[str, bool]:
+    """Returns the report line of `stage` and whether it regressed. The
+    baseline is the stage's ratio to the reference, scaled by this run's
+    reference time"""
+    line = f"{stage:>24}: {seconds:8.3f}s"
+    if baseline_ratio is None:
+        return line, False
+    baseline = baseline_ratio * reference_seconds
+    line += f"  baseline {baseline:8.3f}s ({seconds / baseline - 1:+.0%})"
+    is_regression = (
+        seconds > baseline * (1 + threshold)
+        and seconds - baseline > MIN_REGRESSION_SECONDS
+    )
+    if is_regression:
+        line += "  REGRESSION"
+    return line, is_regression
+
+
+def update_baselines(key, timings: dict[str, float], reference_seconds):
+    """Stores `timings` as the baselines of `key`, as ratios to the
+    reference"""
+    baselines = load_baselines()
+    baselines[key] = {
+        "reference_seconds": round(reference_seconds, 4),
+        "ratios": {
+            stage: round(seconds / reference_seconds, 4)
+            for stage, seconds in timings.items()
+        },
+    }
+    with open(BASELINES_PATH, "w") as f:
+        json.dump(baselines, f, indent=2, sort_keys=True)
+        f.write("\n")
+    print(f"Updated {key} baselines in {BASELINES_PATH}")
+
+
+def load_baselines() -> dict:
+    try:
+        with open(BASELINES_PATH) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return dict()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", choices=SIZES, default="small")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="Keeps the best of this many runs"
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=DEFAULT_THRESHOLD,
+        help="Fails if a stage is this much slower than its baseline, i.e 0.25 for 25%%",
+    )
+    parser.add_argument(
+        "--update-baselines",
+        action="store_true",
+        help="Stores this run's timings as the baselines of its size",
+    )
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    rows, pis = SIZES[args.size]
+    timings = run_benchmarks(rows, pis, args.seed, args.repeat)
+    reference_seconds = time_reference()
+    print(f"{'reference':>24}: {reference_seconds:8.3f}s")
+    baseline_ratios = load_baselines().get(args.size, dict()).get("ratios", dict())
+
+    regressions = list()
+    for stage, seconds in timings.items():
+        line, is_regression = compare_to_baseline(
+            stage,
+            seconds,
+            reference_seconds,
+            baseline_ratios.get(stage),
+            args.threshold,
+        )
+        if is_regression:
+            regressions.append(stage)
+        print(line)
+
+    if args.update_baselines:
+        update_baselines(args.size, timings, reference_seconds)
+    elif regressions:
+        sys.exit(
+            f"{len(regressions)} stages regressed by more than {args.threshold:.0%}: "
+            + ", ".join(regressions)
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,322 @@
+"""Generates a seeded synthetic month of invoicing data
+
+Run from the repository root:
+
+    python -m process_report.tests.benchmarks.synthetic OUTPUT_DIR --rows 1000000 --pis 10000
+
+Writes every input `process_report.main()` reads: the service invoices,
+the old PI file, the alias file, the prepay credits, projects, contacts and
+debits, and the nonbillable PI, project and timed project lists. The same
+seed and sizes always produce the same files.
+"""
+
+import argparse
+import os
+from dataclasses import dataclass
+
+import numpy
+import pandas
+
+from process_report import util
+from process_report.invoices import invoice
+
+INVOICE_MONTH = "2024-06"
+SERVICE_INVOICES = ["OpenShift", "OpenStack", "Storage"]
+# SU types of each service invoice and their hourly rates
+SU_TYPE_RATES = {
+    "OpenShift": {
+        "OpenShift CPU": "0.013",
+        "OpenShift GPUA100": "1.803",
+        "OpenShift GPUA100SXM4": "2.078",
+        "OpenShift GPUV100": "1.214",
+    },
+    "OpenStack": {
+        "OpenStack CPU": "0.013",
+        "OpenStack GPUA100": "1.803",
+        "OpenStack GPUA100SXM4": "2.078",
+        "OpenStack GPUK80": "0.463",
+    },
+    "Storage": {
+        "OpenShift Storage": "0.000009",
+        "OpenStack Storage": "0.000009",
+    },
+}
+ALLOCATIONS_PER_PROJECT = 2
+PROJECTS_PER_PI = 3
+UNMATCHED_DOMAINS = ["example.com", "gmail.com"]
+
+MISSING_PI_RATE = 0.005
+ALIASED_PI_RATE = 0.05
+OLD_PI_RATE = 0.7
+NONBILLABLE_RATE = 0.01
+PIS_PER_PREPAY_GROUP = 100
+
+
+@dataclass
+class Workload:
+    """Paths of a generated month of data"""
+
+    invoice_month: str
+    service_invoices: list[str]
+    old_pi_file: str
+    alias_file: str
+    prepay_credits: str
+    prepay_projects: str
+    prepay_contacts: str
+    prepay_debits: str
+    nonbillable_pis: str
+    nonbillable_projects: str
+    timed_projects: str
+
+    def main_args(self) -> list[str]:
+        """Arguments to run `process_report.main()` on this workload"""
+        return [
+            *self.service_invoices,
+            "--invoice-month",
+            self.invoice_month,
+            "--pi-file",
+            self.nonbillable_pis,
+            "--projects-file",
+            self.nonbillable_projects,
+            "--timed-projects-file",
+            self.timed_projects,
+            "--prepay-credits",
+            self.prepay_credits,
+            "--prepay-projects",
+            self.prepay_projects,
+            "--prepay-contacts",
+            self.prepay_contacts,
+            "--prepay-debits",
+            self.prepay_debits,
+            "--old-pi-file",
+            self.old_pi_file,
+            "--alias-file",
+            self.alias_file,
+            "--BU-subsidy-amount",
+            "100",
+        ]
+
+
+def get_workload(output_dir, invoice_month=INVOICE_MONTH) -> Workload:
+    """Returns the paths of the workload generated in `output_dir`"""
+
+    def path(filename):
+        return os.path.join(output_dir, filename)
+
+    return Workload(
+        invoice_month,
+        [path(f"{service} {invoice_month}.csv") for service in SERVICE_INVOICES],
+        path("PI.csv"),
+        path("alias.csv"),
+        path("prepaid_credits.csv"),
+        path("prepaid_projects.csv"),
+        path("prepaid_contacts.csv"),
+        path("prepay_debits.csv"),
+        path("pi.txt"),
+        path("projects.txt"),
+        path("timed_projects.csv"),
+    )
+
+
+def _month(ordinal):
+    return f"{ordinal // 12:04d}-{ordinal % 12 + 1:02d}"
+
+
+def _write_lines(path, lines):
+    with open(path, "w") as f:
+        f.writelines(f"{line}\n" for line in lines)
+
+
+def generate_workload(
+    output_dir, rows=10_000, pis=100, seed=0, invoice_month=INVOICE_MONTH
+) -> Workload:
+    """Writes `rows` service invoice rows for `pis` PIs to `output_dir`"""
+    rng = numpy.random.default_rng(seed)
+    os.makedirs(output_dir, exist_ok=True)
+    month_ordinal = util.get_month_ordinal(invoice_month)
+    workload = get_workload(output_dir, invoice_month)
+
+    # PIs belong to the listed institutions, weighted towards the first
+    # ones, and some match no institution at all
+    domains = [
+        domain
+        for institute_info in util.load_institute_list()
+        for domain in institute_info.get("domains", [])
+    ]
+    domain_weights = 1 / numpy.arange(1, len(domains) + 1)
+    pi_domains = numpy.where(
+        rng.random(pis) < 0.02,
+        rng.choice(UNMATCHED_DOMAINS, pis),
+        rng.choice(domains, pis, p=domain_weights / domain_weights.sum()),
+    )
+    pi_names = numpy.array([f"pi{i}@{domain}" for i, domain in enumerate(pi_domains)])
+    alias_names = numpy.array([f"alias{i}" for i in range(pis)])
+    is_aliased_pi = rng.random(pis) < ALIASED_PI_RATE
+
+    projects = pis * PROJECTS_PER_PI
+    project_pis = rng.integers(0, pis, projects)
+    allocations = projects * ALLOCATIONS_PER_PROJECT
+    allocation_projects = numpy.arange(allocations) // ALLOCATIONS_PER_PROJECT
+    allocation_names = numpy.array(
+        [
+            f"project{project}-{allocation % ALLOCATIONS_PER_PROJECT}"
+            for allocation, project in enumerate(allocation_projects)
+        ]
+    )
+
+    for service_index, service in enumerate(SERVICE_INVOICES):
+        service_rows = rows // len(SERVICE_INVOICES) + (
+            service_index < rows % len(SERVICE_INVOICES)
+        )
+        row_allocations = rng.integers(0, allocations, service_rows)
+        row_pis = project_pis[allocation_projects[row_allocations]]
+        pi_field = numpy.where(
+            is_aliased_pi[row_pis] & (rng.random(service_rows) < 0.5),
+            alias_names[row_pis],
+            pi_names[row_pis],
+        ).astype(object)
+        pi_field[rng.random(service_rows) < MISSING_PI_RATE] = None
+
+        su_types = numpy.array(list(SU_TYPE_RATES[service]))
+        rates = numpy.array(list(SU_TYPE_RATES[service].values()))
+        row_su_type_codes = rng.choice(
+            len(su_types), service_rows, p=_su_type_weights(su_types)
+        )
+        # Storage is billed by the GB-hour
+        su_hours = rng.integers(
+            1, 2_000_000 if service == "Storage" else 2_000, service_rows
+        )
+        costs = numpy.round(su_hours * rates[row_su_type_codes].astype(float), 2)
+
+        service_invoice = pandas.DataFrame(
+            {
+                invoice.INVOICE_DATE_FIELD: invoice_month,
+                invoice.PROJECT_FIELD: allocation_names[row_allocations],
+                invoice.PROJECT_ID_FIELD: [f"id{a}" for a in row_allocations],
+                invoice.PI_FIELD: pi_field,
+                invoice.INVOICE_EMAIL_FIELD: None,
+                invoice.INVOICE_ADDRESS_FIELD: None,
+                invoice.INSTITUTION_FIELD: None,
+                invoice.INSTITUTION_ID_FIELD: None,
+                invoice.SU_HOURS_FIELD: su_hours,
+                invoice.SU_TYPE_FIELD: su_types[row_su_type_codes],
+                invoice.RATE_FIELD: rates[row_su_type_codes],
+                invoice.COST_FIELD: costs,
+            }
+        )
+        service_invoice.to_csv(
+            workload.service_invoices[service_index], index=False, float_format="%.2f"
+        )
+
+    # Most PIs were billed before, some for the first time last month
+    is_old_pi = rng.random(pis) < OLD_PI_RATE
+    first_months = month_ordinal - rng.integers(1, 24, pis)
+    first_months[rng.random(pis) < 0.1] = month_ordinal - 1
+    old_pis = pandas.DataFrame(
+        {
+            invoice.PI_PI_FIELD: pi_names[is_old_pi],
+            invoice.PI_FIRST_MONTH: [_month(m) for m in first_months[is_old_pi]],
+            invoice.PI_INITIAL_CREDITS: 1000,
+            invoice.PI_1ST_USED: rng.integers(0, 1001, is_old_pi.sum()),
+            invoice.PI_2ND_USED: 0,
+        }
+    )
+    old_pis.to_csv(workload.old_pi_file, index=False)
+
+    _write_lines(
+        workload.alias_file,
+        [f"{pi_names[i]},{alias_names[i]}" for i in numpy.flatnonzero(is_aliased_pi)],
+    )
+
+    # Prepay groups pay for some projects of their PIs
+    groups = max(1, pis // PIS_PER_PREPAY_GROUP)
+    group_names = [f"Group{i}" for i in range(groups)]
+    group_contacts = pi_names[rng.choice(pis, groups, replace=False)]
+    pandas.DataFrame(
+        {
+            invoice.PREPAY_GROUP_NAME_FIELD: group_names,
+            invoice.PREPAY_GROUP_CONTACT_FIELD: group_contacts,
+            invoice.PREPAY_MANAGED_FIELD: rng.choice(["Yes", "No"], groups),
+        }
+    ).to_csv(workload.prepay_contacts, index=False)
+
+    prepay_projects = rng.choice(projects, min(projects, groups * 5), replace=False)
+    pandas.DataFrame(
+        {
+            invoice.PREPAY_GROUP_NAME_FIELD: [
+                group_names[i % groups] for i in range(len(prepay_projects))
+            ],
+            invoice.PREPAY_PROJECT_FIELD: [f"project{p}" for p in prepay_projects],
+            invoice.PREPAY_START_DATE_FIELD: _month(month_ordinal - 6),
+            invoice.PREPAY_END_DATE_FIELD: [
+                _month(month_ordinal + int(offset))
+                for offset in rng.integers(-1, 12, len(prepay_projects))
+            ],
+        }
+    ).to_csv(workload.prepay_projects, index=False)
+
+    pandas.DataFrame(
+        {
+            invoice.PREPAY_MONTH_FIELD: [_month(month_ordinal - 6)] * groups
+            + [invoice_month] * groups,
+            invoice.PREPAY_GROUP_NAME_FIELD: group_names * 2,
+            invoice.PREPAY_CREDIT_FIELD: rng.integers(1, 100, groups * 2) * 1000,
+        }
+    ).to_csv(workload.prepay_credits, index=False)
+
+    # Past debits never exceed the first month's credits
+    pandas.DataFrame(
+        {
+            invoice.PREPAY_MONTH_FIELD: [_month(month_ordinal - 1)] * groups,
+            invoice.PREPAY_GROUP_NAME_FIELD: group_names,
+            invoice.PREPAY_DEBIT_FIELD: rng.integers(0, 1000, groups),
+        }
+    ).to_csv(workload.prepay_debits, index=False)
+
+    nonbillable_pis = rng.choice(pis, max(1, int(pis * NONBILLABLE_RATE)), False)
+    _write_lines(workload.nonbillable_pis, pi_names[nonbillable_pis])
+    nonbillable_allocations = rng.choice(
+        allocations, max(1, int(allocations * NONBILLABLE_RATE)), False
+    )
+    # Nonbillable projects are matched case-insensitively
+    _write_lines(
+        workload.nonbillable_projects,
+        numpy.char.upper(allocation_names[nonbillable_allocations]),
+    )
+    timed_projects = rng.choice(projects, max(1, projects // 200), False)
+    pandas.DataFrame(
+        {
+            "PI": pi_names[project_pis[timed_projects]],
+            "Project": [f"project{p}-0" for p in timed_projects],
+            "Start Date": _month(month_ordinal - 3),
+            "End Date": _month(month_ordinal + 3),
+            "Reason": "Internal",
+        }
+    ).to_csv(workload.timed_projects, index=False)
+
+    return workload
+
+
+def _su_type_weights(su_types):
+    """CPU and storage usage is far more common than GPU usage"""
+    weights = numpy.array([1.0 if "GPU" in su_type else 20.0 for su_type in su_types])
+    return weights / weights.sum()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("output_dir")
+    parser.add_argument("--rows", type=int, default=10_000)
+    parser.add_argument("--pis", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--invoice-month", default=INVOICE_MONTH)
+    args = parser.parse_args()
+
+    workload = generate_workload(
+        args.output_dir, args.rows, args.pis, args.seed, args.invoice_month
+    )
+    print(" ".join(workload.main_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,15 @@
 from unittest import TestCase, mock
+import os
+import tempfile
+from decimal import Decimal
+import numpy
 import pandas
+import pyarrow
+import pyarrow.ipc
+import pyarrow.parquet
 
+from process_report import util, s3_transfer, instrumentation, pipeline
+from process_report.invoices import invoice
 from process_report.tests import util as test_utils
 
 
@@ -17,49 +26,306 @@ class TestBaseInvoice(TestCase):
 
         self.assertTrue(result_invoice.equals(answer_invoice))
 
+    def test_select_export_data(self):
+        size = 100000
+        test_invoice = pandas.DataFrame(
+            {f"C{i}": numpy.arange(size, dtype=float) for i in range(10)}
+        )
+        row_mask = test_invoice["C0"] % 2 == 0
+        inv = test_utils.new_base_invoice(data=test_invoice)
+        inv.export_columns_list = ["C3", "C1"]
+        inv.aggregation_fields = ["C2"]
+
+        peak, result_invoice = test_utils.peak_memory(
+            lambda: inv._select_export_data(row_mask, ["C9"])
+        )
+        filter_peak, answer_invoice = test_utils.peak_memory(
+            lambda: test_invoice[row_mask][["C1", "C2", "C3", "C9"]]
+        )
+
+        self.assertTrue(result_invoice.equals(answer_invoice))
+        # Only the selected columns are copied, not all the filtered rows
+        self.assertLess(peak, filter_peak * 0.5)
+
+    def test_aggregate(self):
+        test_invoice = pandas.DataFrame(
+            {
+                "K1": ["A", "B", "A", "B", "C", "A"],
+                "K2": [1, 1, 1, 2, 1, 1],
+                "Meta": ["a1", "b1", "a2", "b2", "c1", "a3"],
+                "S1": [1, 2, 3, 4, 5, 6],
+                "S2": [None, Decimal("1.50"), Decimal("2.25"), None, None, 7],
+            },
+            index=[10, 11, 12, 13, 14, 15],
+        )
+        inv = test_utils.new_base_invoice(data=test_invoice)
+        inv.aggregation_sum_fields = ["S1", "S2"]
+
+        inv.aggregation_fields = ["K1"]
+        answer_invoice = pandas.DataFrame(
+            {
+                "K1": ["A", "B", "C"],
+                "K2": [1, 1, 1],
+                "Meta": ["a1", "b1", "c1"],
+                "S1": [10, 6, 5],
+                "S2": [Decimal("9.25"), Decimal("1.50"), 0],
+            },
+            index=[10, 11, 14],
+        )
+        self.assertTrue(inv._aggregate(test_invoice).equals(answer_invoice))
+
+        inv.aggregation_fields = ["K1", "K2"]
+        answer_invoice = pandas.DataFrame(
+            {
+                "K1": ["A", "B", "B", "C"],
+                "K2": [1, 1, 2, 1],
+                "Meta": ["a1", "b1", "b2", "c1"],
+                "S1": [10, 2, 4, 5],
+                "S2": [Decimal("9.25"), Decimal("1.50"), 0, 0],
+            },
+            index=[10, 11, 13, 14],
+        )
+        self.assertTrue(inv._aggregate(test_invoice).equals(answer_invoice))
+        # The input is left untouched
+        self.assertEqual(test_invoice["S1"].tolist(), [1, 2, 3, 4, 5, 6])
+
+
+class TestExportFormats(TestCase):
+    def setUp(self):
+        self.output_dir = tempfile.TemporaryDirectory()
+        self.test_invoice = pandas.DataFrame(
+            {
+                "PI": ["PI1", "PI2", "PI3"],
+                "Cost": pandas.array(
+                    [Decimal("1.50"), Decimal("0.00"), Decimal("2.25")],
+                    dtype=pandas.ArrowDtype(pyarrow.decimal128(12, 2)),
+                ),
+                "Credit": [Decimal("1.50"), None, 100],
+                "Rate": ["0.013", "1.803", "0.013"],
+                "Internal": [1, 2, 3],
+            }
+        )
+
+    def tearDown(self):
+        self.output_dir.cleanup()
+
+    def _export(self, output_format):
+        inv = test_utils.new_base_invoice(
+            os.path.join(self.output_dir.name, "test"),
+            "2024-06",
+            self.test_invoice,
+            output_format,
+        )
+        inv.export_data = self.test_invoice
+        inv.export_columns_list = ["PI", "Cost", "Credit", "Rate"]
+        inv.exported_columns_map = {"PI": "Manager"}
+        inv.export()
+        return inv.output_path
+
+    def test_export_parquet_and_arrow(self):
+        parquet_path = self._export(invoice.PARQUET_FORMAT)
+        arrow_path = self._export(invoice.ARROW_FORMAT)
+        self.assertTrue(parquet_path.endswith("test 2024-06.parquet"))
+        self.assertTrue(arrow_path.endswith("test 2024-06.arrow"))
+
+        parquet_table = pyarrow.parquet.read_table(parquet_path)
+        arrow_table = pyarrow.ipc.open_file(arrow_path).read_all()
+        self.assertTrue(parquet_table.equals(arrow_table))
+        self.assertEqual(
+            parquet_table.column_names, ["Manager", "Cost", "Credit", "Rate"]
+        )
+        # Amounts stay exact decimals
+        self.assertEqual(
+            parquet_table.schema.field("Cost").type, pyarrow.decimal128(12, 2)
+        )
+        self.assertEqual(
+            parquet_table.column("Credit").to_pylist(),
+            [Decimal("1.50"), None, Decimal("100.00")],
+        )
+        self.assertEqual(
+            parquet_table.column("Rate").to_pylist(), ["0.013", "1.803", "0.013"]
+        )
+
+    def test_export_schema_fixed(self):
+        # Amounts with different scales, whole amounts and missing values
+        # are exported with the same declared types
+        columns = [
+            invoice.PI_FIELD,
+            invoice.INSTITUTION_ID_FIELD,
+            invoice.SU_HOURS_FIELD,
+            invoice.COST_FIELD,
+            invoice.CREDIT_FIELD,
+            invoice.CREDIT_CODE_FIELD,
+        ]
+        dataframes = [
+            pandas.DataFrame(
+                [["PI1", "BU-1", 10, Decimal("1.5"), Decimal("0.25"), "0002"]],
+                columns=columns,
+            ),
+            pandas.DataFrame(
+                [["PI2", None, 4.0, 3, 100, None], ["PI3", None, 1.0, 2, None, None]],
+                columns=columns,
+            ),
+        ]
+        schemas = list()
+        for i, dataframe in enumerate(dataframes):
+            inv = test_utils.new_base_invoice(
+                os.path.join(self.output_dir.name, f"test{i}"),
+                "2024-06",
+                dataframe,
+                invoice.PARQUET_FORMAT,
+            )
+            inv.export_data = dataframe
+            inv.export_columns_list = columns
+            inv.export()
+            schemas.append(pyarrow.parquet.read_schema(inv.output_path))
+
+        self.assertTrue(schemas[0].equals(schemas[1]))
+        self.assertEqual(
+            schemas[0].field(invoice.CREDIT_FIELD).type, invoice.MONEY_TYPE
+        )
+        self.assertEqual(schemas[0].field(invoice.SU_HOURS_FIELD).type, pyarrow.int64())
+        self.assertEqual(
+            schemas[0].field(invoice.CREDIT_CODE_FIELD).type, pyarrow.string()
+        )
+
+    def test_export_csv(self):
+        csv_path = self._export(invoice.CSV_FORMAT)
+        self.assertTrue(csv_path.endswith("test 2024-06.csv"))
+        with open(csv_path) as f:
+            self.assertEqual(
+                f.read(),
+                "Manager,Cost,Credit,Rate\nPI1,1.50,1.50,0.013\nPI2,0.00,,1.803\nPI3,2.25,100,0.013\n",
+            )
+
+    def test_unknown_format(self):
+        with self.assertRaises(ValueError):
+            invoice.write_dataframe(
+                self.test_invoice, os.path.join(self.output_dir.name, "test"), "xlsx"
+            )
+
 
 class TestUploadToS3(TestCase):
-    @mock.patch("process_report.util.get_invoice_bucket")
     @mock.patch("process_report.util.get_iso8601_time")
-    def test_upload_to_s3(self, mock_get_time, mock_get_bucket):
-        mock_bucket = mock.MagicMock()
-        mock_get_bucket.return_value = mock_bucket
+    def test_s3_uploads(self, mock_get_time):
         mock_get_time.return_value = "0"
 
         invoice_month = "2024-03"
         filenames = ["test-test", "test2.test", "test3"]
         sample_base_invoice = test_utils.new_base_invoice(invoice_month=invoice_month)
 
-        answers = [
-            (
-                f"test-test {invoice_month}.csv",
-                f"Invoices/{invoice_month}/test-test {invoice_month}.csv",
-            ),
-            (
-                f"test-test {invoice_month}.csv",
-                f"Invoices/{invoice_month}/Archive/test-test {invoice_month} 0.csv",
-            ),
-            (
-                f"test2.test {invoice_month}.csv",
-                f"Invoices/{invoice_month}/test2.test {invoice_month}.csv",
-            ),
-            (
-                f"test2.test {invoice_month}.csv",
-                f"Invoices/{invoice_month}/Archive/test2.test {invoice_month} 0.csv",
-            ),
-            (
-                f"test3 {invoice_month}.csv",
-                f"Invoices/{invoice_month}/test3 {invoice_month}.csv",
-            ),
-            (
-                f"test3 {invoice_month}.csv",
-                f"Invoices/{invoice_month}/Archive/test3 {invoice_month} 0.csv",
-            ),
-        ]
-
         for filename in filenames:
             sample_base_invoice.name = filename
-            sample_base_invoice.export_s3(mock_bucket)
+            self.assertEqual(
+                sample_base_invoice.s3_uploads(),
+                [
+                    s3_transfer.S3Upload(
+                        f"{filename} {invoice_month}.csv",
+                        f"Invoices/{invoice_month}/{filename} {invoice_month}.csv",
+                        f"Invoices/{invoice_month}/Archive/{filename} {invoice_month} 0.csv",
+                    )
+                ],
+            )
+
+    @mock.patch("process_report.util.get_iso8601_time")
+    def test_upload_to_s3(self, mock_get_time):
+        mock_get_time.return_value = "0"
+        local_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(local_dir.cleanup)
+        bucket_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(bucket_dir.cleanup)
+        bucket = test_utils.LocalS3Bucket(bucket_dir.name)
+
+        invoice_month = "2024-03"
+        filenames = ["test-test", "test2.test", "test3"]
+        sample_base_invoice = test_utils.new_base_invoice(invoice_month=invoice_month)
+
+        answers = list()
+        for filename in filenames:
+            sample_base_invoice.name = os.path.join(local_dir.name, filename)
+            with open(sample_base_invoice.output_path, "w") as f:
+                f.write(filename)
+            sample_base_invoice.export_s3(bucket)
+
+            key = f"Invoices/{invoice_month}/{local_dir.name}/{filename} {invoice_month}.csv"
+            archive_key = f"Invoices/{invoice_month}/Archive/{local_dir.name}/{filename} {invoice_month} 0.csv"
+            answers.extend([("upload", key), ("copy", key, archive_key)])
+
+        # Each file is uploaded once, then copied to its archive key
+        self.assertEqual(bucket.calls, answers)
+        self.assertEqual(bucket.get(answers[-1][2]), b"test3")
+
+    def test_process_and_export_invoices_threads(self):
+        # Invoices run on threads by default, updating the invoice objects
+        local_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(local_dir.cleanup)
+        inv = test_utils.new_base_invoice(
+            os.path.join(local_dir.name, "test"),
+            "2024-03",
+            pandas.DataFrame({"Cost": [1, 2], "Internal": [3, 4]}),
+        )
+        inv.export_data = inv.data
+        inv.export_columns_list = ["Cost"]
+        util.process_and_export_invoices([inv], upload_to_s3=False)
+
+        self.assertEqual(inv.export_data.columns.tolist(), ["Cost"])
+        self.assertTrue(os.path.exists(inv.output_path))
+
+    @mock.patch("process_report.util.get_iso8601_time")
+    @mock.patch("process_report.util.get_invoice_bucket")
+    def test_process_and_export_invoices(self, mock_get_bucket, mock_get_time):
+        mock_get_time.return_value = "0"
+        local_dir = tempfile.TemporaryDirectory()
+        bucket_dir = tempfile.TemporaryDirectory()
+        bucket = test_utils.LocalS3Bucket(bucket_dir.name)
+        mock_get_bucket.return_value = bucket
+
+        invoices = list()
+        for name in ["Lenovo", "NERC"]:
+            # Pipeline nodes are named after the invoice classes
+            inv = type(name, (invoice.Invoice,), dict())(
+                os.path.join(local_dir.name, name),
+                "2024-03",
+                pandas.DataFrame({"Cost": [1, 2]}),
+            )
+            inv.export_data = inv.data
+            inv.export_columns_list = ["Cost"]
+            invoices.append(inv)
+
+        run_report = instrumentation.RunReport()
+        with (
+            self.assertLogs("process_report.s3_transfer", level="INFO") as logs,
+            mock.patch.object(instrumentation, "_run_report", run_report),
+        ):
+            report = util.process_and_export_invoices(
+                invoices, upload_to_s3=True, use_processes=pipeline.can_fork()
+            )
+
+        self.assertEqual(sorted(report.timings), ["Lenovo", "NERC"])
+        # Stages are reported even when run in worker processes
+        self.assertEqual(
+            sorted((m.component, m.stage) for m in run_report.stages),
+            [
+                ("Lenovo", "_prepare"),
+                ("Lenovo", "_prepare_export"),
+                ("Lenovo", "_process"),
+                ("Lenovo", "export"),
+                ("NERC", "_prepare"),
+                ("NERC", "_prepare_export"),
+                ("NERC", "_process"),
+                ("NERC", "export"),
+                ("S3Uploader", "upload"),
+            ],
+        )
 
-        for i, call_args in enumerate(mock_bucket.upload_file.call_args_list):
-            self.assertTrue(answers[i] in call_args)
+        # All files are uploaded by a single upload stage, and each file is
+        # transferred only once
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn("uploaded 2 files", logs.output[0])
+        self.assertIn("archived 2 files", logs.output[0])
+        self.assertEqual(
+            sorted(call[0] for call in bucket.calls),
+            ["copy", "copy", "upload", "upload"],
+        )
+        archive_key = f"Invoices/2024-03/Archive/{local_dir.name}/NERC 2024-03 0.csv"
+        self.assertEqual(bucket.get(archive_key), b"Cost\n1\n2\n")
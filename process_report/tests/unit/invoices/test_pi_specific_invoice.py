@@ -66,3 +66,89 @@ class TestExportPICSV(TestCase):
         self.assertNotIn("ProjectA", pi_df["Project - Allocation"].tolist())
         self.assertNotIn("ProjectB", pi_df["Project - Allocation"].tolist())
         self.assertNotIn("ProjectC", pi_df["Project - Allocation"].tolist())
+
+    def test_export_matches_per_pi_filter(self):
+        test_invoice = pandas.DataFrame(
+            {
+                "Invoice Month": ["2023-01"] * 6,
+                "Manager (PI)": ["PI2", "PI1", None, "PI2", "PI3", "PI1"],
+                "Institution": ["HU", "BU", "BU", "HU", "", "BU"],
+                "Cost": [1.5, 2, 3, 4, 5, 6],
+                "Is Billable": [True, True, True, True, True, False],
+                "Missing PI": [False] * 6,
+            },
+            index=[5, 4, 3, 2, 1, 0],
+        )
+        output_dir = tempfile.TemporaryDirectory()
+        pi_inv = test_utils.new_pi_specific_invoice(
+            output_dir.name, invoice_month="2023-01", data=test_invoice
+        )
+        pi_inv.export_columns_list = list(test_invoice.columns)
+        pi_inv.export_max_workers = 2
+        pi_inv.process()
+        with self.assertLogs(level="INFO") as logs:
+            pi_inv.export()
+
+        self.assertIn("Exported 3 PI invoices", logs.output[0])
+        self.assertEqual(
+            sorted(os.listdir(output_dir.name)),
+            ["BU_PI1 2023-01.csv", "HU_PI2 2023-01.csv", "_PI3 2023-01.csv"],
+        )
+        billable_invoice = test_invoice[test_invoice["Is Billable"]]
+        for pi, filename in [("PI1", "BU_PI1"), ("PI2", "HU_PI2"), ("PI3", "_PI3")]:
+            with open(os.path.join(output_dir.name, f"{filename} 2023-01.csv")) as f:
+                self.assertEqual(
+                    f.read(),
+                    billable_invoice[billable_invoice["Manager (PI)"] == pi].to_csv(),
+                )
+
+
+class TestPIInvoiceS3Uploads(TestCase):
+    def setUp(self):
+        self.output_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.output_dir.cleanup)
+
+    def _export(self, invoice_month):
+        test_invoice = pandas.DataFrame(
+            {
+                "Invoice Month": [invoice_month] * 2,
+                "Manager (PI)": ["PI1", "PI2"],
+                "Institution": ["BU", "HU"],
+                "Is Billable": [True, True],
+                "Missing PI": [False, False],
+            }
+        )
+        pi_inv = test_utils.new_pi_specific_invoice(
+            self.output_dir.name, invoice_month=invoice_month, data=test_invoice
+        )
+        pi_inv.export_columns_list = list(test_invoice.columns)
+        pi_inv.process()
+        pi_inv.export()
+        return pi_inv
+
+    @mock.patch("process_report.util.get_iso8601_time", return_value="0")
+    def test_range_uploads_only_month(self, mock_get_time):
+        # Months of a range are exported to the same folder
+        self._export("2024-07")
+        pi_inv = self._export("2024-08")
+        # Left by an earlier run in another output format
+        stale_path = os.path.join(self.output_dir.name, "BU_PI1 2024-08.parquet")
+        open(stale_path, "w").close()
+        self.assertEqual(len(os.listdir(self.output_dir.name)), 5)
+
+        folder = self.output_dir.name
+        expected_keys = [
+            (
+                f"Invoices/2024-08/{folder}/{filename} 2024-08.csv",
+                f"Invoices/2024-08/Archive/{folder}/{filename} 2024-08 0.csv",
+            )
+            for filename in ["BU_PI1", "HU_PI2"]
+        ]
+        # Also when exported in a forked process, which leaves the object of
+        # the main process as it was
+        forked_inv = test_utils.new_pi_specific_invoice(folder, invoice_month="2024-08")
+        for inv in [pi_inv, forked_inv]:
+            self.assertEqual(
+                sorted((upload.key, upload.archive_key) for upload in inv.s3_uploads()),
+                expected_keys,
+            )
@@ -1,6 +1,9 @@
-from unittest import TestCase
+from unittest import TestCase, mock
+
+import pandas
 
 from process_report import util
+from process_report.tests import util as test_utils
 
 
 class TestAddInstitute(TestCase):
@@ -36,3 +39,42 @@ class TestAddInstitute(TestCase):
             self.assertEqual(
                 util.get_institution_from_pi(institute_map, pi_email), answer
             )
+
+    @mock.patch("process_report.util.load_institute_list")
+    def test_add_institution(self, mock_load_institute_list):
+        mock_load_institute_list.return_value = [
+            {"display_name": "Boston University", "domains": ["bu.edu"]},
+            {"display_name": "Harvard University", "domains": ["harvard.edu"]},
+        ]
+        test_invoice = pandas.DataFrame(
+            {
+                "Project - Allocation": ["P1", "P2", "P3", "P4", "P5"],
+                "Manager (PI)": [
+                    "a@bu.edu",
+                    "b@x.harvard.edu",
+                    None,
+                    "a@bu.edu",
+                    "c@mit.edu",
+                ],
+                "Institution": [None, None, "Keep", None, None],
+            }
+        )
+        answer_institutions = [
+            "Boston University",
+            "Harvard University",
+            "Keep",
+            "Boston University",
+            "",
+        ]
+
+        add_institution_proc = test_utils.new_add_institution_processor(
+            data=test_invoice
+        )
+        add_institution_proc.process()
+
+        # Every PI is only resolved once
+        lookup_info = util.get_institution_resolver().lookup.cache_info()
+        self.assertEqual(lookup_info.misses, 3)
+        self.assertEqual(
+            add_institution_proc.data["Institution"].tolist(), answer_institutions
+        )
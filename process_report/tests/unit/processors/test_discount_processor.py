@@ -0,0 +1,192 @@
+from unittest import TestCase, mock
+from decimal import Decimal
+import random
+
+import pandas
+import pyarrow
+
+from process_report.processors import discount_processor
+from process_report.tests import util as test_utils
+
+
+class TestApplyFlatDiscounts(TestCase):
+    def _get_test_invoice(self, pis, balances, dtype, codes=None):
+        if codes is None:
+            codes = [None] * len(pis)
+        return pandas.DataFrame(
+            {
+                "Manager (PI)": pis,
+                "PI Balance": pandas.Series(balances, dtype=dtype),
+                "Balance": pandas.Series(balances, dtype=dtype),
+                "Credit": [None] * len(pis),
+                "Credit Code": codes,
+            }
+        )
+
+    def _apply_discounts(self, test_invoice, discount_amounts, batch):
+        discount_proc = test_utils.new_discount_processor()
+        args = (
+            "PI Balance",
+            "Credit",
+            "Balance",
+            "Credit Code",
+            "0002",
+        )
+        if batch:
+            return discount_proc.apply_flat_discounts(
+                test_invoice,
+                test_invoice,
+                "Manager (PI)",
+                pandas.Series(discount_amounts, dtype=object),
+                *args,
+            )
+
+        return pandas.Series(
+            {
+                pi: discount_proc.apply_flat_discount(
+                    test_invoice,
+                    test_invoice[test_invoice["Manager (PI)"] == pi],
+                    args[0],
+                    amount,
+                    *args[1:],
+                )
+                for pi, amount in discount_amounts.items()
+            },
+            dtype=object,
+        )
+
+    def _assert_matches_loop(self, test_invoice, discount_amounts):
+        answer_invoice = test_invoice.copy()
+        answer_used = self._apply_discounts(answer_invoice, discount_amounts, False)
+        output_used = self._apply_discounts(test_invoice, discount_amounts, True)
+
+        self.assertTrue(test_invoice.equals(answer_invoice))
+        # Discounts must also be exported exactly as before
+        self.assertEqual(test_invoice.to_csv(), answer_invoice.to_csv())
+        self.assertEqual(
+            list(map(str, output_used)), list(map(str, answer_used[output_used.index]))
+        )
+
+    def test_decimal_balances(self):
+        decimal_type = pandas.ArrowDtype(pyarrow.decimal128(12, 2))
+        test_invoice = self._get_test_invoice(
+            ["PI1", "PI1", "PI2", "PI2", "PI2", "PI3", "PI4", None, "PI1"],
+            [
+                Decimal("60.00"),
+                Decimal("50.00"),
+                Decimal("0.00"),
+                Decimal("40.00"),
+                Decimal("80.50"),
+                Decimal("10.00"),
+                Decimal("5.00"),
+                Decimal("20.00"),
+                Decimal("1.00"),
+            ],
+            decimal_type,
+            codes=[None, "0001", None, None, "0001", None, None, None, None],
+        )
+        self._assert_matches_loop(
+            test_invoice,
+            {"PI1": 100, "PI2": Decimal("40.00"), "PI3": Decimal("0"), "PI5": 10},
+        )
+
+    def test_randomized(self):
+        rng = random.Random(0)
+        pis = [f"PI{rng.randrange(50)}" for _ in range(500)]
+        balances = [rng.choice([0, 1, 10, 25, 100, 250]) for _ in range(500)]
+        amounts = {f"PI{i}": rng.choice([0, 10, 100, 500, 1000]) for i in range(60)}
+
+        self._assert_matches_loop(
+            self._get_test_invoice(pis, balances, "int64"), amounts
+        )
+        self._assert_matches_loop(
+            self._get_test_invoice(
+                pis,
+                [Decimal(balance) / 4 for balance in balances],
+                pandas.ArrowDtype(pyarrow.decimal128(12, 2)),
+            ),
+            {pi: Decimal(amount) / 4 for pi, amount in amounts.items()},
+        )
+
+    def test_fallback(self):
+        # Negative balances and float amounts take the row by row path
+        self._assert_matches_loop(
+            self._get_test_invoice(
+                ["PI1", "PI1", "PI1", "PI2"], [50, -20, 100, 10], "int64"
+            ),
+            {"PI1": 100, "PI2": 5},
+        )
+        self._assert_matches_loop(
+            self._get_test_invoice(["PI1", "PI1", "PI2"], [0.1, 0.2, 0.3], "float64"),
+            {"PI1": 0.25, "PI2": 0.1},
+        )
+
+    def _assert_cents_match_loop(self, pis, balances, amounts):
+        """Checks the batch path gives the same invoice and discounts used as
+        the row by row path, without falling back to it"""
+        for dtype in [object, pandas.ArrowDtype(pyarrow.decimal128(12, 2))]:
+            with mock.patch.object(
+                discount_processor.DiscountProcessor,
+                "apply_flat_discount",
+                side_effect=AssertionError("Fell back to the row by row path"),
+            ):
+                output_invoice = self._get_test_invoice(pis, balances, dtype)
+                output_used = self._apply_discounts(output_invoice, amounts, True)
+
+            answer_invoice = self._get_test_invoice(pis, balances, dtype)
+            answer_used = self._apply_discounts(answer_invoice, amounts, False)
+            self.assertTrue(output_invoice.equals(answer_invoice))
+            self.assertEqual(output_invoice.to_csv(), answer_invoice.to_csv())
+            self.assertEqual(
+                list(map(str, output_used)),
+                list(map(str, answer_used[output_used.index])),
+            )
+
+    def test_cents_match_decimals(self):
+        # Balances and amounts written with 0, 1 or 2 decimals, as left by
+        # earlier discounts, are applied on cents without the row by row path
+        rng = random.Random(1)
+        pis = [f"PI{rng.randrange(40)}" for _ in range(400)]
+        balances = [
+            Decimal(rng.randrange(0, 5000)).scaleb(-rng.choice([0, 1, 2]))
+            for _ in range(400)
+        ]
+        amounts = {
+            f"PI{i}": rng.choice([0, 100, Decimal("12.5"), Decimal("250.25")])
+            for i in range(50)
+        }
+        self._assert_cents_match_loop(pis, balances, amounts)
+
+    def test_cents_match_loop_property(self):
+        # Random amounts of mixed scales, including Python ints, zeros and
+        # amounts larger than, equal to and smaller than a PI's balances
+        def get_random_amount(rng, max_cents):
+            if rng.random() < 0.2:
+                return rng.randrange(0, max_cents // 100 + 1)
+            scale = rng.choice([0, 1, 2])
+            max_amount = max_cents // 10 ** (2 - scale)
+            return Decimal(rng.randrange(0, max_amount + 1)).scaleb(-scale)
+
+        for seed in range(100):
+            rng = random.Random(seed)
+            pi_count = rng.randrange(1, 10)
+            project_count = rng.randrange(1, 40)
+            pis = [f"PI{rng.randrange(pi_count)}" for _ in range(project_count)]
+            balances = [get_random_amount(rng, 10000) for _ in range(project_count)]
+            amounts = {
+                f"PI{i}": get_random_amount(rng, rng.choice([100, 10000, 100000]))
+                for i in range(pi_count + 1)
+            }
+            with self.subTest(seed=seed):
+                self._assert_cents_match_loop(pis, balances, amounts)
+
+    def test_scales_per_group(self):
+        # The scale of a PI's earlier balances must not carry over to the
+        # next PI, nor include the balance of the project discounted
+        test_invoice = self._get_test_invoice(
+            ["PI1", "PI2", "PI2", "PI3", "PI3"],
+            [Decimal("10.00"), 5, 50, 5, Decimal("50.00")],
+            object,
+        )
+        self._assert_matches_loop(test_invoice, {"PI1": 100, "PI2": 20, "PI3": 20})
+        self.assertEqual(test_invoice["Credit"].map(str).tolist()[1:], ["5", "15"] * 2)
@@ -520,4 +520,22 @@ class TestNewPICreditProcessor(TestCase):
         invoice_month = "2024-03"
         test_invoice = test_utils.new_new_pi_credit_processor()
         with self.assertRaises(SystemExit):
-            test_invoice._get_pi_age(old_pi_df, "PI1", invoice_month)
+            test_invoice._get_pi_ages(old_pi_df, pandas.Index(["PI1"]), invoice_month)
+
+    def test_get_pi_ages(self):
+        old_pi_df = pandas.DataFrame(
+            {
+                "PI": ["PI1", "PI2", "PI3"],
+                "First Invoice Month": ["2024-04", "2023-12", "2024-03"],
+            }
+        )
+        pis = pandas.Index(["PI2", "PI4", "PI1"])
+        pi_ages = test_utils.new_new_pi_credit_processor()._get_pi_ages(
+            old_pi_df, pis, "2024-04"
+        )
+        self.assertEqual(pi_ages.to_dict(), {"PI2": 4, "PI4": 0, "PI1": 0})
+
+        with self.assertRaises(SystemExit):
+            test_utils.new_new_pi_credit_processor()._get_pi_ages(
+                old_pi_df, pis, "2024-03"
+            )
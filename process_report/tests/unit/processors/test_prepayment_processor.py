@@ -1,5 +1,5 @@
 import os
-from unittest import TestCase
+from unittest import TestCase, mock
 import tempfile
 import pandas
 
@@ -429,3 +429,116 @@ class TestPrepaymentProcessor(TestCase):
             answer_prepay_debits,
             invoice_month,
         )
+
+    def test_get_prepay_balances(self):
+        prepayment_proc = test_utils.new_prepayment_processor(
+            invoice_month="2024-08",
+            prepay_credits=self._get_test_prepay_credits(
+                ["2024-04", "2024-04", "2024-06", "2024-08", "2024-10"],
+                ["G1", "G2", "G1", "G2", "G1"],
+                [700, 800, 1000, 2000, 3500],
+            ),
+            prepay_contacts=self._get_test_prepay_contacts(
+                ["G1", "G2", "G3"],
+                ["G1@bu.edu", "G2@harvard.edu", "G3@bu.edu"],
+                [True, False, True],
+            ),
+        )
+        prepayment_proc.prepay_debits = self._get_test_prepay_debits(
+            ["2024-05", "2024-06", "2024-07", "2024-10"],
+            ["G1", "G2", "G2", "G1"],
+            [200, 300, 1000, 2000],
+        )
+
+        for month, answer_balances in [
+            ("2024-03", [0, 0, 0]),
+            ("2024-07", [1500, 500, 0]),
+            ("2024-10", [5000, 1500, 0]),
+            ("2024-11", [3000, 1500, 0]),
+        ]:
+            self.assertEqual(
+                prepayment_proc.get_prepay_balances(month).to_dict(),
+                dict(zip(["G1", "G2", "G3"], answer_balances)),
+            )
+        # Defaults to the invoice month
+        self.assertEqual(
+            prepayment_proc.get_prepay_balances().to_dict(),
+            {"G1": 1500, "G2": 1500, "G3": 0},
+        )
+
+    def test_negative_balance(self):
+        prepayment_proc = test_utils.new_prepayment_processor(
+            invoice_month="2024-08",
+            prepay_credits=self._get_test_prepay_credits(
+                ["2024-04", "2024-04"], ["G1", "G2"], [700, 800]
+            ),
+            prepay_contacts=self._get_test_prepay_contacts(
+                ["G1", "G2"], ["G1@bu.edu", "G2@harvard.edu"], [True, False]
+            ),
+        )
+        prepayment_proc.prepay_debits = self._get_test_prepay_debits(
+            ["2024-05", "2024-06", "2024-07"], ["G1", "G2", "G2"], [200, 900, -100]
+        )
+
+        # G2's balance is negative after its first debit
+        with self.assertLogs(level="ERROR") as logs:
+            with self.assertRaises(SystemExit):
+                prepayment_proc.get_prepay_balances()
+        self.assertIn("prepay group G2 is negative", logs.output[0])
+
+    def test_unknown_group(self):
+        prepayment_proc = test_utils.new_prepayment_processor(
+            invoice_month="2024-08",
+            prepay_credits=self._get_test_prepay_credits(
+                ["2024-04", "2024-04"], ["G1", "G2"], [700, 800]
+            ),
+            prepay_contacts=self._get_test_prepay_contacts(
+                ["G1"], ["G1@bu.edu"], [True]
+            ),
+        )
+        prepayment_proc.prepay_debits = self._get_test_prepay_debits(
+            ["2024-05"], ["G1"], [200]
+        )
+
+        # G2 has credits but no contacts
+        with self.assertRaises(KeyError) as cm:
+            prepayment_proc.get_prepay_balances()
+        self.assertEqual(cm.exception.args, ("G2",))
+
+        prepayment_proc.prepay_credits = self._get_test_prepay_credits(
+            ["2024-04"], ["G1"], [700]
+        )
+        prepayment_proc.prepay_debits = self._get_test_prepay_debits(
+            ["2024-05", "2024-06"], ["G1", "G3"], [200, 100]
+        )
+        with self.assertRaises(KeyError) as cm:
+            prepayment_proc.get_prepay_balances()
+        self.assertEqual(cm.exception.args, ("G3",))
+
+    @mock.patch("process_report.util.get_iso8601_time")
+    @mock.patch("process_report.util.get_invoice_bucket")
+    def test_upload_prepay_debits(self, mock_get_bucket, mock_get_time):
+        mock_get_time.return_value = "0"
+        bucket_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(bucket_dir.cleanup)
+        bucket = test_utils.LocalS3Bucket(bucket_dir.name)
+        # Transient errors are retried by the uploader
+        bucket.failures["Prepay/prepay_debits.csv"] = 1
+        mock_get_bucket.return_value = bucket
+        self.test_prepay_debits_file.write("Month,Group Name,Debit\n")
+        self.test_prepay_debits_file.flush()
+
+        prepayment_proc = test_utils.new_prepayment_processor(
+            prepay_debits_filepath=self.test_prepay_debits_file.name
+        )
+        with mock.patch("process_report.s3_transfer.time.sleep"):
+            prepayment_proc._backup_s3_prepay_debits()
+            prepayment_proc._export_s3_prepay_debits()
+
+        self.assertEqual(
+            sorted(bucket.keys()),
+            ["Prepay/Archive/prepay_debits 0.csv", "Prepay/prepay_debits.csv"],
+        )
+        self.assertEqual(
+            bucket.get("Prepay/prepay_debits.csv"), b"Month,Group Name,Debit\n"
+        )
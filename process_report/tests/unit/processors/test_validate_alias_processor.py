@@ -1,4 +1,5 @@
 from unittest import TestCase
+import numpy
 import pandas
 
 from process_report.tests import util as test_utils
@@ -23,3 +24,34 @@ class TestValidateAliasProcessor(TestCase):
         )
         validate_pi_alias_proc.process()
         self.assertTrue(answer_data.equals(validate_pi_alias_proc.data))
+
+    def test_alias_conflict(self):
+        alias_map = {"PI1": ["PI1_1", "PI_shared"], "PI2": ["PI_shared"]}
+        with self.assertRaisesRegex(
+            ValueError, "PI_shared is listed for both PI1 and PI2"
+        ):
+            test_utils.new_validate_pi_alias_processor(
+                data=pandas.DataFrame({"Manager (PI)": ["PI1"]}), alias_map=alias_map
+            ).process()
+
+        with self.assertRaisesRegex(ValueError, "cycle: PI1 -> PI2 -> PI1"):
+            test_utils.new_validate_pi_alias_processor(
+                data=pandas.DataFrame({"Manager (PI)": ["PI1"]}),
+                alias_map={"PI2": ["PI1"], "PI1": ["PI2"]},
+            ).process()
+
+    def test_categorical_aliases(self):
+        alias_map = {"PI1": ["PI1_1"], "PI2": ["PI2_1", "PI1"], "PI4": ["PI4"]}
+        test_data = pandas.DataFrame(
+            {"Manager (PI)": ["PI1", "PI1_1", None, "PI2_1", "PI3", "PI4"]}
+        ).astype("category")
+
+        validate_pi_alias_proc = test_utils.new_validate_pi_alias_processor(
+            data=test_data, alias_map=alias_map
+        )
+        validate_pi_alias_proc.process()
+        # Aliases are followed from PI1_1 to PI1, and from PI1 to PI2
+        self.assertEqual(
+            validate_pi_alias_proc.data["Manager (PI)"].tolist(),
+            ["PI2", "PI2", numpy.nan, "PI2", "PI3", "PI4"],
+        )
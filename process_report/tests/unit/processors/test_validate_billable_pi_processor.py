@@ -3,6 +3,7 @@ import pandas
 import uuid
 import math
 
+from process_report import nonbillable
 from process_report.tests import util as test_utils
 
 
@@ -52,3 +53,89 @@ class TestValidateBillablePIProcessor(TestCase):
         output_data = validate_billable_pi_proc.data
         output_data = output_data[~output_data["Missing PI"]]
         self.assertEqual(0, len(output_data[pandas.isna(output_data["Manager (PI)"])]))
+
+    def test_nonbillable_rules(self):
+        test_data = pandas.DataFrame(
+            {
+                "Manager (PI)": ["PI1", "PI2", "PI2", "PI3", "PI3", "PI4", "PI5"],
+                "Project - Allocation": [
+                    "ProjectA",
+                    "Test-ProjectB",
+                    "ProjectC",
+                    "ProjectD",
+                    "projectd",
+                    "ProjectE",
+                    "project[a]",
+                ],
+            }
+        )
+        validate_billable_pi_proc = test_utils.new_validate_billable_pi_processor(
+            data=test_data,
+            nonbillable_pis=["PI1", "pi4"],
+            nonbillable_projects=["PROJECTD", "glob:test-*", "Project[A]", "Project?"],
+        )
+        validate_billable_pi_proc.process()
+        output_data = validate_billable_pi_proc.data
+
+        self.assertEqual(
+            output_data["Is Billable"].tolist(),
+            [False, False, True, False, False, True, False],
+        )
+        # Glob characters are only patterns with the glob prefix
+        self.assertEqual(
+            output_data["Nonbillable Rule"].tolist(),
+            [
+                "PI PI1",
+                "Project glob:test-*",
+                None,
+                "Project PROJECTD",
+                "Project PROJECTD",
+                None,
+                "Project Project[A]",
+            ],
+        )
+
+    def test_timed_projects_rule(self):
+        test_data = pandas.DataFrame(
+            {
+                "Manager (PI)": ["PI1", "PI2"],
+                "Project - Allocation": ["ProjectA", "ProjectB"],
+            }
+        )
+        validate_billable_pi_proc = test_utils.new_validate_billable_pi_processor(
+            data=test_data,
+            nonbillable_matcher=nonbillable.NonbillableMatcher(
+                ["PI1"], [], timed_projects=["ProjectA", "ProjectB"]
+            ),
+        )
+        validate_billable_pi_proc.process()
+        self.assertEqual(
+            validate_billable_pi_proc.data["Nonbillable Rule"].tolist(),
+            ["PI PI1", "Timed project ProjectB"],
+        )
+
+    def test_exact_rule_before_glob(self):
+        matcher = nonbillable.NonbillableMatcher(
+            [],
+            ["glob:project*", "ProjectB", "glob:*a"],
+            timed_projects=["ProjectA", "glob:*"],
+        )
+        rules = matcher.match(
+            pandas.DataFrame(
+                {
+                    "Manager (PI)": ["PI1", "PI1", "PI1", "PI1"],
+                    "Project - Allocation": ["ProjectA", "ProjectB", "ProjectC", "A"],
+                }
+            )
+        )
+        # Exact entries are reported over earlier glob entries, and glob
+        # entries in file order
+        self.assertEqual(
+            rules.tolist(),
+            [
+                "Timed project ProjectA",
+                "Project ProjectB",
+                "Project glob:project*",
+                "Project glob:*a",
+            ],
+        )
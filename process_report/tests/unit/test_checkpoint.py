@@ -0,0 +1,232 @@
+from unittest import TestCase, mock
+from decimal import Decimal
+import tempfile
+import os
+
+import numpy
+import pandas
+import pyarrow
+import pyarrow.parquet
+
+from process_report import checkpoint
+
+
+class TestCheckpointCache(TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.cache = checkpoint.CheckpointCache(self.cache_dir.name)
+
+    def tearDown(self):
+        self.cache_dir.cleanup()
+
+    def test_roundtrip(self):
+        test_data = pandas.DataFrame(
+            {
+                "Manager (PI)": ["PI1", None, "PI2"],
+                "Cost": pandas.array(
+                    [Decimal("1.50"), Decimal("0.00"), Decimal("2.25")],
+                    dtype=pandas.ArrowDtype(pyarrow.decimal128(12, 2)),
+                ),
+                "Credit": [Decimal("1.50"), None, 100],
+                "Subsidy": [Decimal(0), Decimal(0), Decimal("0.50")],
+                "Credit Code": [None, None, None],
+                "Balance": [Decimal("1E+2"), numpy.nan, 7],
+                "Institution": ["BU", numpy.nan, None],
+                "Invoice Email": [numpy.nan, "a@bu.edu", numpy.nan],
+                "Is Billable": [True, False, True],
+                "SU Hours (GBhr or SUhr)": [1.5, 2.0, 3.0],
+            },
+            index=[3, 4, 5],
+        )
+        key = self.cache.key("stage", "2024-06")
+        self.assertFalse(self.cache.has(key))
+        self.assertIsNone(self.cache.load(key))
+
+        self.cache.save(key, {"data": test_data})
+        output_data = self.cache.load(key)["data"]
+
+        self.assertTrue(output_data.equals(test_data))
+        self.assertTrue(output_data.dtypes.equals(test_data.dtypes))
+        # Values must export exactly as they did before being cached
+        self.assertEqual(output_data.to_csv(), test_data.to_csv())
+        for name in test_data:
+            self.assertEqual(
+                list(map(repr, output_data[name])), list(map(repr, test_data[name]))
+            )
+
+        # Object columns are stored as typed columns, not pickled
+        (checkpoint_path,) = [
+            entry.path for entry in os.scandir(self.cache_dir.name) if entry.is_dir()
+        ]
+        schema = pyarrow.parquet.read_schema(
+            os.path.join(checkpoint_path, "data.parquet")
+        )
+        self.assertEqual(
+            schema.field("Institution").type.field("value").type, pyarrow.string()
+        )
+        self.assertEqual(
+            schema.field("Credit").type.field("amount").type,
+            pyarrow.decimal128(38, 2),
+        )
+        self.assertFalse(any(pyarrow.types.is_binary(field.type) for field in schema))
+
+    def test_unsupported_values(self):
+        with self.assertRaises(TypeError):
+            self.cache.save("key", {"data": pandas.DataFrame({"C1": [1.5, "a"]})})
+
+    def test_key(self):
+        key = self.cache.key("stage", "2024-06", ["a", "b"], {"PI1": ["PI1_1"]})
+        self.assertEqual(
+            key, self.cache.key("stage", "2024-06", ["a", "b"], {"PI1": ["PI1_1"]})
+        )
+        self.assertNotEqual(key, self.cache.key("stage", "2024-06", ["a", "c"]))
+        self.assertNotEqual(key, self.cache.key("stage", "2024-07", ["a", "b"]))
+        self.assertNotEqual(key, self.cache.key("other", "2024-06", ["a", "b"]))
+
+    def test_link(self):
+        test_data = pandas.DataFrame({"C1": [1, 2]})
+        content_key = self.cache.save("key", {"data": test_data})
+        self.cache.link("alias", "key")
+
+        self.assertEqual(self.cache.resolve("key"), content_key)
+        self.assertEqual(self.cache.resolve("alias"), content_key)
+        self.assertTrue(self.cache.load("alias")["data"].equals(test_data))
+
+    def test_same_content(self):
+        test_data = pandas.DataFrame({"C1": [1, 2]})
+        content_key = self.cache.save("key1", {"data": test_data})
+        self.assertEqual(self.cache.save("key2", {"data": test_data}), content_key)
+        self.assertNotEqual(
+            self.cache.save("key3", {"data": test_data * 2}), content_key
+        )
+        self.assertEqual(len(self.cache._checkpoints()), 2)
+
+    def test_evict(self):
+        for i in range(3):
+            test_data = pandas.DataFrame({f"C{i}": list(range(1000))})
+            content_key = self.cache.save(f"key{i}", {"data": test_data})
+            os.utime(os.path.join(self.cache_dir.name, content_key), (i, i))
+        self.cache.link("alias0", "key0")
+
+        # Only room for two checkpoints
+        self.cache.max_bytes = self.cache.size() * 2 // 3
+        self.cache.evict()
+
+        self.assertFalse(self.cache.has("key0"))
+        self.assertFalse(self.cache.has("alias0"))
+        self.assertTrue(self.cache.has("key1"))
+        self.assertTrue(self.cache.has("key2"))
+
+    def test_purge(self):
+        self.cache.save("key", {"data": pandas.DataFrame({"C1": [1]})})
+        self.cache.purge()
+        self.assertFalse(self.cache.has("key"))
+
+
+class TestCheckpointRunner(TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.cache = checkpoint.CheckpointCache(self.cache_dir.name)
+        self.stage_inputs = {"first": ["a"], "second": ["b"], "third": ["c"]}
+
+    def tearDown(self):
+        self.cache_dir.cleanup()
+
+    def _get_processor(self, data, output):
+        processor = mock.MagicMock()
+        processor.data = data
+        processor.extra = pandas.DataFrame({"E": [1]})
+
+        def process():
+            processor.data = output
+
+        processor.process.side_effect = process
+        return processor
+
+    def _run(self, stage_inputs, first_output):
+        """Runs the three stages, the later ones adding the length of their
+        input to the data, and returns their processors"""
+        runner = checkpoint.CheckpointRunner(self.cache, stage_inputs)
+        data = pandas.DataFrame({"C1": [1, 2]})
+        processors = list()
+        for stage in stage_inputs:
+            output = (
+                first_output if stage == "first" else data + len(stage_inputs[stage][0])
+            )
+            processor = self._get_processor(data, output)
+            runner.run_processor(stage, processor, saved_attributes=["extra"])
+            processors.append(processor)
+            data = processor.data
+        return runner, processors
+
+    def test_resume_from_latest_checkpoint(self):
+        test_data = pandas.DataFrame({"C1": [1, 2]})
+        self._run(self.stage_inputs, test_data)
+
+        runner, processors = self._run(self.stage_inputs, test_data)
+        first_proc, second_proc, third_proc = processors
+        # Earlier stages are skipped, but their extra attribute is still
+        # restored, and only the last stage is loaded
+        first_proc.process.assert_not_called()
+        self.assertTrue(first_proc.extra.equals(pandas.DataFrame({"E": [1]})))
+        second_proc.process.assert_not_called()
+        third_proc.process.assert_not_called()
+        self.assertTrue(runner.is_loaded("third"))
+        self.assertTrue(third_proc.data.equals(test_data + 2))
+
+    def test_changed_inputs(self):
+        test_data = pandas.DataFrame({"C1": [1, 2]})
+        self._run(self.stage_inputs, test_data)
+
+        # Changing an input recomputes its stage and every stage after it
+        stage_inputs = {**self.stage_inputs, "second": ["changed"]}
+        runner, processors = self._run(stage_inputs, test_data)
+        self.assertEqual(
+            runner.statuses,
+            {
+                "first": checkpoint.LOADED,
+                "second": checkpoint.RECOMPUTED,
+                "third": checkpoint.RECOMPUTED,
+            },
+        )
+        self.assertTrue(processors[2].data.equals(test_data + 8))
+
+    def test_early_cutoff(self):
+        test_data = pandas.DataFrame({"C1": [1, 2]})
+        self._run(self.stage_inputs, test_data)
+
+        # The first stage produces the same output from different inputs
+        stage_inputs = {**self.stage_inputs, "first": ["changed"]}
+        runner, processors = self._run(stage_inputs, test_data)
+        self.assertEqual(
+            runner.statuses,
+            {
+                "first": checkpoint.RECOMPUTED,
+                "second": checkpoint.SKIPPED,
+                "third": checkpoint.LOADED,
+            },
+        )
+        self.assertTrue(processors[2].data.equals(test_data + 2))
+
+        # Its output changes, so every stage is recomputed
+        stage_inputs = {**self.stage_inputs, "first": ["changed again"]}
+        runner, processors = self._run(stage_inputs, test_data * 10)
+        self.assertEqual(set(runner.statuses.values()), {checkpoint.RECOMPUTED})
+        self.assertTrue(processors[2].data.equals(test_data * 10 + 2))
+
+    def test_link_inputs(self):
+        test_data = pandas.DataFrame({"C1": [1, 2]})
+        runner, _ = self._run(self.stage_inputs, test_data)
+        stage_inputs = {**self.stage_inputs, "first": ["rewritten"]}
+        runner.link_inputs(stage_inputs)
+
+        runner, _ = self._run(stage_inputs, test_data * 10)
+        self.assertEqual(runner.statuses["third"], checkpoint.LOADED)
+
+    def test_no_cache(self):
+        runner = checkpoint.CheckpointRunner(None, self.stage_inputs)
+        processor = self._get_processor(None, pandas.DataFrame({"C1": [1]}))
+        runner.run_processor("first", processor)
+        processor.process.assert_called_once()
+        self.assertEqual(runner.statuses, {"first": checkpoint.RECOMPUTED})
+        self.assertEqual(os.listdir(self.cache_dir.name), [])
@@ -0,0 +1,109 @@
+from unittest import TestCase, mock
+import tempfile
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import pandas
+
+from process_report import instrumentation
+from process_report.tests import util as test_utils
+
+
+class TestInstrumentation(TestCase):
+    def setUp(self):
+        self.run_report = instrumentation.RunReport()
+        patcher = mock.patch.object(instrumentation, "_run_report", self.run_report)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_invoice_stages(self):
+        test_invoice = pandas.DataFrame({"Cost": [1, 2, 3]})
+        inv = test_utils.new_base_invoice(data=test_invoice)
+        inv._prepare_export = mock.Mock(
+            __name__="_prepare_export",
+            side_effect=lambda: setattr(inv, "export_data", test_invoice[1:]),
+        )
+        inv.process()
+
+        self.assertEqual(
+            [
+                (m.component, m.stage, m.rows_in, m.rows_out)
+                for m in self.run_report.stages
+            ],
+            [
+                ("Invoice", "_prepare", 3, 3),
+                ("Invoice", "_process", 3, 3),
+                ("Invoice", "_prepare_export", 3, 2),
+            ],
+        )
+        for metrics in self.run_report.stages:
+            self.assertGreaterEqual(metrics.wall_seconds, 0)
+            self.assertGreaterEqual(metrics.cpu_seconds, 0)
+            self.assertGreaterEqual(metrics.peak_memory_delta_bytes, 0)
+
+    def test_cpu_of_threads_and_children(self):
+        busy_loop = (
+            "end = time.process_time() + 0.2\nwhile time.process_time() < end: pass"
+        )
+        with instrumentation.measure("merge", "merge_csv") as metrics:
+            thread = threading.Thread(target=exec, args=(busy_loop, {"time": time}))
+            thread.start()
+            thread.join()
+            subprocess.run(
+                [sys.executable, "-c", f"import time\n{busy_loop}"], check=True
+            )
+        # Neither ran on the thread measuring the stage
+        self.assertGreaterEqual(metrics.cpu_seconds, 0.4)
+
+    def test_report_and_profiles(self):
+        output_dir = tempfile.TemporaryDirectory()
+        profile_dir = os.path.join(output_dir.name, "profiles")
+        instrumentation.enable_profiling(profile_dir)
+        with self.assertRaises(ValueError):
+            with instrumentation.measure("merge", "merge_csv", 10, "2024-08"):
+                raise ValueError
+
+        report_path = os.path.join(output_dir.name, "report.json")
+        self.run_report.write(report_path)
+        with open(report_path) as f:
+            report = json.load(f)
+
+        # Failed stages are reported too
+        self.assertEqual(len(report["stages"]), 1)
+        self.assertEqual(report["stages"][0]["component"], "merge")
+        self.assertEqual(report["stages"][0]["rows_in"], 10)
+        self.assertEqual(report["stages"][0]["invoice_month"], "2024-08")
+        self.assertEqual(os.listdir(profile_dir), ["merge.merge_csv.2024-08.prof"])
+
+    def test_concurrent_profiled_stages(self):
+        output_dir = tempfile.TemporaryDirectory()
+        instrumentation.enable_profiling(output_dir.name)
+        running_stages = []
+        max_running_stages = []
+
+        def run_stage(invoice_month):
+            with instrumentation.measure("Invoice", "_prepare", None, invoice_month):
+                running_stages.append(invoice_month)
+                max_running_stages.append(len(running_stages))
+                time.sleep(0.05)
+                running_stages.remove(invoice_month)
+
+        threads = [
+            threading.Thread(target=run_stage, args=(invoice_month,))
+            for invoice_month in ["2024-07", "2024-08"]
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Profiled stages run one at a time, with one profile per month
+        self.assertEqual(max_running_stages, [1, 1])
+        self.assertEqual(
+            sorted(os.listdir(output_dir.name)),
+            ["Invoice._prepare.2024-07.prof", "Invoice._prepare.2024-08.prof"],
+        )
@@ -0,0 +1,62 @@
+from unittest import TestCase
+from decimal import Decimal
+
+import numpy
+import pandas
+import pyarrow
+
+from process_report import money
+
+
+class TestMoney(TestCase):
+    def test_to_cents(self):
+        for values, answer_cents, answer_scales in [
+            (pandas.Series([1, 0, 25]), [100, 0, 2500], [0, 0, 0]),
+            (
+                [Decimal("1.50"), 2, Decimal("-0.5"), Decimal("7")],
+                [150, 200, -50, 700],
+                [2, 0, 1, 0],
+            ),
+            (
+                pandas.Series(
+                    [Decimal("12.34"), Decimal("0")],
+                    dtype=pandas.ArrowDtype(pyarrow.decimal128(12, 2)),
+                ).iloc[1:],
+                [0],
+                [2],
+            ),
+        ]:
+            cents, scales = money.to_cents(values)
+            self.assertEqual(cents.dtype, numpy.int64)
+            self.assertEqual(cents.tolist(), answer_cents)
+            self.assertEqual(scales.tolist(), answer_scales)
+
+        for values in [
+            [0.5],
+            [None],
+            [Decimal("0.125")],
+            [Decimal("NaN")],
+            [True],
+            [2**62],
+            pandas.Series([1.5, 2.0]),
+            pandas.Series([None], dtype=pandas.ArrowDtype(pyarrow.decimal128(12, 2))),
+        ]:
+            with self.assertRaises(ValueError):
+                money.to_cents(values)
+
+    def test_from_cents(self):
+        cents = numpy.array([150, 200, -50, 0], dtype=numpy.int64)
+        scales = numpy.array([2, 0, 1, 2], dtype=numpy.int8)
+
+        amounts = money.from_cents(cents, scales, object)
+        self.assertEqual(list(map(str, amounts)), ["1.50", "2", "-0.5", "0.00"])
+
+        arrow_dtype = pandas.ArrowDtype(pyarrow.decimal128(12, 2))
+        amounts = money.from_cents(cents, scales, arrow_dtype)
+        self.assertEqual(
+            pandas.Series(amounts).to_csv(index=False), "0\n1.50\n2.00\n-0.50\n0.00\n"
+        )
+
+        integers = money.from_cents(cents[[1]], scales[[1]], numpy.int64)
+        self.assertEqual(integers.tolist(), [2])
+        self.assertEqual(integers.dtype, numpy.int64)
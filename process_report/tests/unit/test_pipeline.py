@@ -0,0 +1,89 @@
+from unittest import TestCase, skipUnless
+import threading
+import tempfile
+import time
+import os
+
+from process_report import pipeline
+
+
+class TestPipeline(TestCase):
+    def test_run_order_and_critical_path(self):
+        finished = list()
+        # Both branches must be running at the same time to pass the barrier
+        barrier = threading.Barrier(2, timeout=5)
+
+        def node(name, wait=0, sync=False):
+            def run():
+                if sync:
+                    barrier.wait()
+                time.sleep(wait)
+                finished.append(name)
+
+            return run
+
+        test_pipeline = pipeline.Pipeline(max_workers=2)
+        test_pipeline.add_node("report", node("report"), ["short", "long"])
+        test_pipeline.add_node("short", node("short", sync=True), ["load"])
+        test_pipeline.add_node("long", node("long", 0.1, sync=True), ["load"])
+        test_pipeline.add_node("load", node("load"))
+        report = test_pipeline.run()
+
+        self.assertEqual(finished, ["load", "short", "long", "report"])
+        self.assertEqual(report.critical_path, ["load", "long", "report"])
+        self.assertEqual(list(report.timings)[0], "load")
+        self.assertLess(report.timings["long"].start, report.timings["short"].end)
+        self.assertGreaterEqual(
+            report.timings["report"].start, report.timings["long"].end
+        )
+
+    @skipUnless(pipeline.can_fork(), "Forked processes are not supported")
+    def test_run_in_processes(self):
+        output_dir = tempfile.TemporaryDirectory()
+
+        def node(name):
+            def run():
+                # Nodes in worker processes pass on their results through files
+                inputs = sorted(os.listdir(output_dir.name))
+                with open(os.path.join(output_dir.name, name), "w") as f:
+                    f.write(",".join(inputs))
+                return inputs
+
+            return run
+
+        test_pipeline = pipeline.Pipeline(max_workers=2, use_processes=True)
+        test_pipeline.add_node("load", node("load"))
+        test_pipeline.add_node("export", node("export"), ["load"])
+        report = test_pipeline.run()
+
+        self.assertEqual(report.critical_path, ["load", "export"])
+        self.assertEqual(report.results, {"load": [], "export": ["load"]})
+        with open(os.path.join(output_dir.name, "export")) as f:
+            self.assertEqual(f.read(), "load")
+
+    def test_failure_stops_dependents(self):
+        finished = list()
+
+        def fail():
+            raise SystemExit("Invoice failed")
+
+        test_pipeline = pipeline.Pipeline(max_workers=1)
+        test_pipeline.add_node("fail", fail)
+        test_pipeline.add_node("after", lambda: finished.append("after"), ["fail"])
+        with self.assertRaises(SystemExit):
+            test_pipeline.run()
+        self.assertEqual(finished, [])
+
+    def test_invalid_graph(self):
+        test_pipeline = pipeline.Pipeline()
+        test_pipeline.add_node("A", lambda: None, ["B"])
+        test_pipeline.add_node("B", lambda: None, ["A"])
+        with self.assertRaisesRegex(ValueError, "cycle: A -> B -> A"):
+            test_pipeline.run()
+
+        test_pipeline = pipeline.Pipeline()
+        test_pipeline.add_node("A", lambda: None, ["C"])
+        with self.assertRaisesRegex(ValueError, "unknown node C"):
+            test_pipeline.run()
+        with self.assertRaisesRegex(ValueError, "already defined"):
+            test_pipeline.add_node("A", lambda: None)
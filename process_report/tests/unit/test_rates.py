@@ -0,0 +1,81 @@
+from unittest import TestCase, mock
+import tempfile
+import os
+
+import requests
+
+from process_report import rates
+
+
+RATES_YAML = b"""
+- name: Limit New PI Credit to MGHPCC Partners
+  type: bool
+  history:
+    - value: "False"
+      from: 2024-01
+      until: 2024-05
+    - value: "True"
+      from: 2024-06
+"""
+
+
+class TestRatesCache(TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.TemporaryDirectory()
+        response = mock.Mock(content=RATES_YAML)
+        self.get = mock.patch("requests.get", return_value=response).start()
+        self.addCleanup(mock.patch.stopall)
+
+    def tearDown(self):
+        self.cache_dir.cleanup()
+
+    def _load(self, ttl=rates.DEFAULT_TTL):
+        return rates.RatesCache(
+            url="https://example.com/rates.yaml", cache_dir=self.cache_dir.name, ttl=ttl
+        ).load()
+
+    def test_rerun_served_from_cache(self):
+        self._load()
+        self._load()
+        self.assertEqual(self.get.call_count, 1)
+        self.assertIn("Limit New PI Credit to MGHPCC Partners", self._load().root)
+
+    def test_expired_cache_fetched_again(self):
+        self._load(ttl=0)
+        self._load(ttl=0)
+        self.assertEqual(self.get.call_count, 2)
+
+    def test_modified_cache_fetched_again(self):
+        self._load()
+        with open(os.path.join(self.cache_dir.name, "rates.yaml"), "ab") as f:
+            f.write(b"\n")
+        self._load()
+        self.assertEqual(self.get.call_count, 2)
+
+    def test_stale_cache_used_offline(self):
+        self._load(ttl=0)
+        self.get.side_effect = requests.ConnectionError
+        self.assertIn("Limit New PI Credit to MGHPCC Partners", self._load(ttl=0).root)
+
+        os.remove(os.path.join(self.cache_dir.name, "rates.yaml"))
+        with self.assertRaises(requests.ConnectionError):
+            self._load(ttl=0)
+
+
+class TestLoadRates(TestCase):
+    def test_rates_file(self):
+        with tempfile.NamedTemporaryFile(suffix=".yaml") as rates_file:
+            rates_file.write(RATES_YAML)
+            rates_file.flush()
+            with mock.patch("requests.get") as get:
+                loaded_rates = rates.load_rates(rates_file.name)
+            get.assert_not_called()
+        self.assertIn("Limit New PI Credit to MGHPCC Partners", loaded_rates.rates.root)
+
+    def test_memoized_values(self):
+        nerc_rates = mock.Mock()
+        nerc_rates.get_value_at.side_effect = lambda name, month: month
+        memoized_rates = rates.MemoizedRates(nerc_rates)
+        for month in ["2024-06", "2024-07", "2024-06"]:
+            self.assertEqual(memoized_rates.get_value_at("Rate", month), month)
+        self.assertEqual(nerc_rates.get_value_at.call_count, 2)
@@ -0,0 +1,164 @@
+from unittest import TestCase
+import tempfile
+import os
+
+from process_report import s3_transfer
+from process_report.tests import util as test_utils
+
+
+class TestS3Downloader(TestCase):
+    def setUp(self):
+        self.bucket_dir = tempfile.TemporaryDirectory()
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.output_dir = tempfile.TemporaryDirectory()
+        self.bucket = test_utils.LocalS3Bucket(self.bucket_dir.name)
+        self.prefix = "Invoices/2024-06/Service Invoices/"
+        self.invoices = {
+            "OpenShift.csv": b"Cost\n1.00\n",
+            "OpenStack.csv": b"Cost\n2.00\n3.00\n",
+            "Storage.csv": b"Cost\n4.00\n",
+        }
+        for name, content in self.invoices.items():
+            self.bucket.put(self.prefix + name, content)
+        self.bucket.put("PIs/PI.csv", b"PI,First Invoice Month\n")
+
+    def tearDown(self):
+        self.bucket_dir.cleanup()
+        self.cache_dir.cleanup()
+        self.output_dir.cleanup()
+
+    def _download_invoices(self):
+        downloader = s3_transfer.S3Downloader(
+            self.bucket, cache_dir=self.cache_dir.name, max_workers=2
+        )
+        s3_objects = downloader.list_prefix(self.prefix)
+        for s3_object in s3_objects:
+            s3_object.local_path = os.path.join(
+                self.output_dir.name, s3_object.local_path
+            )
+        return s3_objects, downloader.download(s3_objects)
+
+    def _downloaded_keys(self):
+        return [call[1] for call in self.bucket.calls if call[0] == "download"]
+
+    def test_download_prefix(self):
+        s3_objects, stats = self._download_invoices()
+
+        self.assertEqual(len(s3_objects), 3)
+        self.assertEqual(stats.fetched_files, 3)
+        self.assertEqual(stats.fetched_bytes, sum(map(len, self.invoices.values())))
+        self.assertEqual(stats.cached_files, 0)
+        for name, content in self.invoices.items():
+            with open(os.path.join(self.output_dir.name, name), "rb") as f:
+                self.assertEqual(f.read(), content)
+
+    def test_rerun_served_from_cache(self):
+        self._download_invoices()
+        self.bucket.calls.clear()
+
+        # Local copies may be modified by the run, the cache must not be
+        with open(os.path.join(self.output_dir.name, "Storage.csv"), "wb") as f:
+            f.write(b"modified")
+
+        _, stats = self._download_invoices()
+        self.assertEqual(self._downloaded_keys(), [])
+        self.assertEqual(stats.fetched_files, 0)
+        self.assertEqual(stats.cached_files, 3)
+        self.assertEqual(stats.cached_bytes, sum(map(len, self.invoices.values())))
+        with open(os.path.join(self.output_dir.name, "Storage.csv"), "rb") as f:
+            self.assertEqual(f.read(), self.invoices["Storage.csv"])
+
+    def test_changed_object_refetched(self):
+        self._download_invoices()
+        self.bucket.calls.clear()
+        self.bucket.put(self.prefix + "OpenStack.csv", b"Cost\n5.00\n")
+
+        _, stats = self._download_invoices()
+        self.assertEqual(self._downloaded_keys(), [self.prefix + "OpenStack.csv"])
+        self.assertEqual(stats.fetched_files, 1)
+        self.assertEqual(stats.cached_files, 2)
+        with open(os.path.join(self.output_dir.name, "OpenStack.csv"), "rb") as f:
+            self.assertEqual(f.read(), b"Cost\n5.00\n")
+
+    def test_download_single_object(self):
+        downloader = s3_transfer.S3Downloader(
+            self.bucket, cache_dir=self.cache_dir.name
+        )
+        local_path = os.path.join(self.output_dir.name, "PI.csv")
+        s3_object = downloader.head("PIs/PI.csv", local_path)
+        downloader.download([s3_object])
+        stats = downloader.download([s3_object])
+
+        self.assertEqual(self._downloaded_keys(), ["PIs/PI.csv"])
+        self.assertEqual(stats.cached_files, 1)
+        with open(local_path, "rb") as f:
+            self.assertEqual(f.read(), b"PI,First Invoice Month\n")
+
+
+class TestS3Uploader(TestCase):
+    def setUp(self):
+        self.bucket_dir = tempfile.TemporaryDirectory()
+        self.local_dir = tempfile.TemporaryDirectory()
+        self.bucket = test_utils.LocalS3Bucket(self.bucket_dir.name)
+        self.s3_uploads = list()
+        for name, content in [("A.csv", b"Cost\n1.00\n"), ("B.csv", b"Cost\n2.00\n")]:
+            local_path = os.path.join(self.local_dir.name, name)
+            with open(local_path, "wb") as f:
+                f.write(content)
+            self.s3_uploads.append(
+                s3_transfer.S3Upload(
+                    local_path, f"Invoices/{name}", f"Invoices/Archive/{name}"
+                )
+            )
+        self.s3_uploads.append(
+            s3_transfer.S3Upload(self.s3_uploads[0].local_path, "PIs/PI.csv")
+        )
+
+    def tearDown(self):
+        self.bucket_dir.cleanup()
+        self.local_dir.cleanup()
+
+    def test_upload_and_archive(self):
+        uploader = s3_transfer.S3Uploader(self.bucket, max_workers=2, backoff=0)
+        stats = uploader.upload(self.s3_uploads)
+
+        self.assertEqual(
+            self.bucket.keys(),
+            [
+                "Invoices/A.csv",
+                "Invoices/Archive/A.csv",
+                "Invoices/Archive/B.csv",
+                "Invoices/B.csv",
+                "PIs/PI.csv",
+            ],
+        )
+        self.assertEqual(self.bucket.get("Invoices/Archive/B.csv"), b"Cost\n2.00\n")
+        # Every file is transferred once, archives are copied within S3
+        self.assertEqual(
+            sorted(call for call in self.bucket.calls if call[0] == "upload"),
+            [
+                ("upload", "Invoices/A.csv"),
+                ("upload", "Invoices/B.csv"),
+                ("upload", "PIs/PI.csv"),
+            ],
+        )
+        self.assertIn(
+            ("copy", "Invoices/A.csv", "Invoices/Archive/A.csv"), self.bucket.calls
+        )
+        self.assertEqual(stats.uploaded_files, 3)
+        self.assertEqual(stats.uploaded_bytes, 30)
+        self.assertEqual(stats.archived_files, 2)
+        self.assertEqual(stats.failed, [])
+
+    def test_retry_and_failures(self):
+        self.bucket.failures = {"Invoices/A.csv": 1, "Invoices/Archive/B.csv": 3}
+        uploader = s3_transfer.S3Uploader(self.bucket, max_attempts=3, backoff=0)
+        with self.assertLogs(level="ERROR") as logs:
+            stats = uploader.upload(self.s3_uploads)
+
+        self.assertEqual(stats.retries, 3)
+        self.assertEqual(stats.uploaded_files, 3)
+        self.assertEqual(stats.archived_files, 1)
+        self.assertEqual([key for key, _ in stats.failed], ["Invoices/B.csv"])
+        self.assertIn("1 failed", logs.output[0])
+        self.assertEqual(self.bucket.get("Invoices/Archive/A.csv"), b"Cost\n1.00\n")
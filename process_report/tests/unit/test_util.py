@@ -1,10 +1,13 @@
-from unittest import TestCase
+from unittest import TestCase, mock
 import tempfile
+import numpy
 import pandas
 import os
 from textwrap import dedent
 
-from process_report import process_report, util
+from process_report import process_report, util, ingest
+from process_report.invoices import invoice
+from process_report.tests import util as test_utils
 
 
 class TestMonthUtils(TestCase):
@@ -20,6 +23,44 @@ class TestMonthUtils(TestCase):
         with self.assertRaises(ValueError):
             util.get_month_diff("2024-16", "2025-03")
 
+    def test_get_month_ordinals(self):
+        months = pandas.Series(["2024-12", "2023-01", "2024-12", "2024-6"])
+        self.assertEqual(
+            (
+                util.get_month_ordinals(months) - util.get_month_ordinal("2023-01")
+            ).tolist(),
+            [23, 0, 23, 17],
+        )
+        with self.assertRaises(ValueError):
+            util.get_month_ordinal("2024-16")
+
+    def test_get_month_range(self):
+        self.assertEqual(
+            util.get_month_range("2024-11", "2025-02"),
+            ["2024-11", "2024-12", "2025-01", "2025-02"],
+        )
+        self.assertEqual(util.get_month_range("2024-06", "2024-06"), ["2024-06"])
+        self.assertEqual(util.get_month_range("2024-06", "2024-05"), [])
+
+    def test_vectorized_month_helpers(self):
+        months_1 = pandas.Series(["2024-12", "2024-12", "2024-11", "2024-12"])
+        months_2 = numpy.array(["2024-03", "2023-03", "2024-12", "2025-03"])
+        self.assertEqual(
+            util.get_month_diffs(months_1, months_2).tolist(), [9, 21, -1, -3]
+        )
+        self.assertEqual(
+            util.get_month_diffs(months_2, "2024-03").tolist(), [0, -12, 9, 12]
+        )
+        self.assertEqual(
+            util.compare_invoice_months("2024-11", months_1).tolist(),
+            [False, False, False, False],
+        )
+        self.assertEqual(
+            util.compare_invoice_months(months_1, months_2).tolist(),
+            [True, True, False, False],
+        )
+        self.assertIsInstance(util.get_month_ordinals(months_2), numpy.ndarray)
+
 
 class TestMergeCSV(TestCase):
     def setUp(self):
@@ -58,6 +99,111 @@ class TestMergeCSV(TestCase):
         # Assert that the headers in the merged DataFrame match the expected headers
         self.assertListEqual(merged_dataframe.columns.tolist(), self.header)
 
+    def test_merge_csv_arrow(self):
+        csv_filenames = [csv_file.name for csv_file in self.csv_files]
+        merged_dataframe = process_report.merge_csv(csv_filenames, "arrow")
+        answer_dataframe = process_report.merge_csv(csv_filenames)
+
+        self.assertTrue(merged_dataframe.equals(answer_dataframe))
+
+
+class TestMergeInvoiceCSV(TestCase):
+    def setUp(self):
+        self.csv_data = [
+            dedent(
+                """\
+            Invoice Month,Project - Allocation,Manager (PI),SU Hours (GBhr or SUhr),SU Type,Rate,Cost
+            2024-01,ProjectA,PI1,10.5,OpenShift CPU,0.013,1.25
+            2024-01,ProjectB,,4,OpenShift CPU,0.013,0.40
+            """
+            ),
+            dedent(
+                """\
+            Invoice Month,Project - Allocation,Manager (PI),SU Hours (GBhr or SUhr),SU Type,Rate,Cost
+            2024-01,ProjectC,PI2,1,OpenStack GPUA100SXM4,2.078,2078.00
+            """
+            ),
+        ]
+        self.csv_files = []
+        for csv_data in self.csv_data:
+            csv_file = tempfile.NamedTemporaryFile(
+                delete=False, mode="w", suffix=".csv"
+            )
+            csv_file.write(csv_data)
+            csv_file.close()
+            self.csv_files.append(csv_file.name)
+
+    def tearDown(self):
+        for csv_file in self.csv_files:
+            os.remove(csv_file)
+
+    def test_merge_engines_match(self):
+        answer_dataframe = process_report.merge_csv(self.csv_files)
+        merged_dataframe = process_report.merge_csv(self.csv_files, "arrow")
+
+        self.assertTrue(merged_dataframe.equals(answer_dataframe))
+        self.assertEqual(merged_dataframe["Cost"].dtype, answer_dataframe["Cost"].dtype)
+        self.assertEqual(merged_dataframe["Rate"].tolist(), ["0.013", "0.013", "2.078"])
+        self.assertTrue(pandas.isna(merged_dataframe["Manager (PI)"][1]))
+
+    def test_merge_categorical_identifiers(self):
+        answer_dataframe = process_report.merge_csv(self.csv_files)
+        for engine in ["pandas", "arrow"]:
+            merged_dataframe = process_report.merge_csv(
+                self.csv_files, engine, categorical_identifiers=True
+            )
+            self.assertIsInstance(
+                merged_dataframe["Manager (PI)"].dtype, pandas.CategoricalDtype
+            )
+            self.assertEqual(
+                merged_dataframe["Project - Allocation"].cat.categories.tolist(),
+                ["ProjectA", "ProjectB", "ProjectC"],
+            )
+            self.assertTrue(
+                ingest.decode_identifiers(merged_dataframe).equals(answer_dataframe)
+            )
+
+    def test_unknown_engine(self):
+        with self.assertRaises(ValueError):
+            process_report.merge_csv(self.csv_files, "spark")
+
+    def test_engines_export_identical(self):
+        """Whole SU hours and missing institutions are written the same way
+        by both engines, once processed and exported"""
+        with tempfile.NamedTemporaryFile(mode="w", suffix=".csv") as csv_file:
+            csv_file.write(
+                dedent(
+                    """\
+                Invoice Month,Project - Allocation,Manager (PI),Institution,SU Hours (GBhr or SUhr),SU Type,Rate,Cost
+                2024-01,ProjectD,PI3@bu.edu,,8,OpenShift GPUA100SXM4,2.078,16.62
+                2024-01,ProjectE,,,3,OpenStack GPUA100SXM4,2.078,6.23
+                """
+                )
+            )
+            csv_file.flush()
+
+            exports = list()
+            for engine in ["pandas", "arrow"]:
+                data = process_report.merge_csv([csv_file.name], engine)
+                for new_processor in [
+                    test_utils.new_add_institution_processor,
+                    test_utils.new_lenovo_processor,
+                ]:
+                    processor = new_processor(data=data)
+                    processor.process()
+                    data = processor.data
+
+                export_path = os.path.join(
+                    tempfile.gettempdir(), f"{os.getpid()}-{engine}.csv"
+                )
+                self.addCleanup(os.remove, export_path)
+                invoice.write_dataframe(data, export_path)
+                with open(export_path, "rb") as f:
+                    exports.append(f.read())
+
+        self.assertEqual(exports[0], exports[1])
+        self.assertIn(b",8,", exports[1])
+
 
 class TestGetInvoiceDate(TestCase):
     def test_get_invoice_date(self):
@@ -104,3 +250,179 @@ class TestTimedProjects(TestCase):
 
         expected_projects = ["ProjectB", "ProjectC", "ProjectD"]
         self.assertEqual(excluded_projects, expected_projects)
+
+
+class TestLimitNewPICreditToPartners(TestCase):
+    def test_rate_values(self):
+        for value, answer in [("True", True), ("False", False)]:
+            rates_info = mock.Mock()
+            rates_info.get_value_at.return_value = value
+            limit = process_report.get_limit_new_pi_credit_to_partners(
+                rates_info, "2024-06"
+            )
+            # A bool, not a one element tuple, which is always truthy
+            self.assertIs(limit, answer)
+            rates_info.get_value_at.assert_called_once_with(
+                "Limit New PI Credit to MGHPCC Partners", "2024-06"
+            )
+
+
+class TestGetStageInputs(TestCase):
+    def _get_stage_inputs(self, institute_list):
+        return process_report.get_stage_inputs(
+            invoice_month="2024-06",
+            csv_files=[],
+            ingest_engine="pandas",
+            categorical_identifiers=False,
+            alias_dict={},
+            institute_list=institute_list,
+            nonbillable_pis=[],
+            nonbillable_projects=[],
+            timed_projects=[],
+            old_pi_digest="old_pi",
+            limit_new_pi_credit_to_partners=False,
+            bu_subsidy_amount=100,
+            prepay_digests=[],
+        )
+
+    def test_institute_list_inputs(self):
+        institute_list = [{"display_name": "Boston University", "domains": ["bu.edu"]}]
+        stage_inputs = self._get_stage_inputs(institute_list)
+        # Only the partnership date changes, not the institution of any PI
+        changed_stage_inputs = self._get_stage_inputs(
+            [{**institute_list[0], "mghpcc_partnership_start_date": "2024-02"}]
+        )
+        changed_stages = [
+            stage
+            for stage in process_report.PROCESSING_STAGES
+            if stage_inputs[stage] != changed_stage_inputs[stage]
+        ]
+        self.assertEqual(
+            changed_stages, ["add_institution", "new_pi_credit", "prepayment"]
+        )
+
+
+class TestArguments(TestCase):
+    def test_choices(self):
+        # Duplicated so that parsing the arguments does not import them
+        self.assertEqual(process_report.INGEST_ENGINES, ingest.INGEST_ENGINES)
+        self.assertEqual(process_report.PANDAS_ENGINE, ingest.PANDAS_ENGINE)
+        self.assertEqual(process_report.OUTPUT_FORMATS, invoice.OUTPUT_FORMATS)
+        self.assertEqual(process_report.CSV_FORMAT, invoice.CSV_FORMAT)
+
+
+class TestInstitutionResolver(TestCase):
+    def setUp(self):
+        self.institute_list = [
+            {
+                "display_name": "Harvard University",
+                "domains": ["harvard.edu", "chemistry.harvard.edu"],
+                "mghpcc_partnership_start_date": "2013-06",
+            },
+            {
+                "display_name": "Boston University",
+                "domains": ["bu.edu"],
+                "mghpcc_partnership_start_date": "2024-02",
+            },
+            {"display_name": "McLean Hospital", "domains": ["mclean.harvard.edu"]},
+            {"display_name": "Red Hat", "domains": ["redhat.com"]},
+        ]
+        self.resolver = util.InstitutionResolver(self.institute_list)
+
+    def test_lookup_matches_institute_mapping(self):
+        institute_map = util.get_institute_mapping(self.institute_list)
+        for pi_uname in [
+            "q@bu.edu",
+            "c@mclean.harvard.edu",
+            "c@a.mclean.harvard.edu",
+            "b@chemistry.harvard.edu",
+            "h@a.b.c.harvard.edu",
+            "e@edu",
+            "e@dfci.harvard",
+            "e@harvard.edu.au",
+            "rudolph",
+            "a@b@redhat.com",
+            "a@x..redhat.com",
+        ]:
+            self.assertEqual(
+                self.resolver.lookup(pi_uname),
+                util.match_institution_from_pi(institute_map, pi_uname),
+            )
+
+    def test_resolve_series(self):
+        pi_series = pandas.Series(
+            ["q@bu.edu", None, "c@mclean.harvard.edu", "q@bu.edu", "x@mit.edu"],
+            index=[10, 11, 12, 13, 14],
+        )
+        answer_series = pandas.Series(
+            ["Boston University", None, "McLean Hospital", "Boston University", ""],
+            index=[10, 11, 12, 13, 14],
+        )
+
+        self.assertTrue(self.resolver.resolve_series(pi_series).equals(answer_series))
+        self.assertEqual(self.resolver.lookup.cache_info().misses, 3)
+
+    def test_active_partnerships(self):
+        self.assertEqual(
+            self.resolver.active_partnerships("2024-01"), ["Harvard University"]
+        )
+        self.assertEqual(
+            self.resolver.active_partnerships("2024-02"),
+            ["Harvard University", "Boston University"],
+        )
+
+    def test_shared_resolver(self):
+        institute_list = util.load_institute_list()
+        self.assertIs(institute_list, util.load_institute_list())
+        self.assertIs(util.get_institution_resolver(), util.get_institution_resolver())
+        self.assertEqual(
+            util.get_institution_resolver().lookup("foo@bu.edu"), "Boston University"
+        )
+
+
+class TestMapIdentifiers(TestCase):
+    def test_map_identifiers(self):
+        pis = pandas.Series(["PI1", "alias1", None, "PI2", "PI1"], name="PI")
+
+        def replace_alias(series):
+            return series.replace("alias1", "PI1")
+
+        answer = replace_alias(pis)
+        mapped = util.map_identifiers(pis.astype("category"), replace_alias)
+
+        self.assertEqual(mapped.cat.categories.tolist(), ["PI1", "PI2"])
+        self.assertEqual(mapped.name, "PI")
+        self.assertTrue(mapped.astype(object).equals(answer))
+        self.assertTrue(util.map_identifiers(pis, replace_alias).equals(answer))
+
+
+class TestCopyDataframe(TestCase):
+    def setUp(self):
+        size = 100000
+        self.dataframe = pandas.DataFrame(
+            {f"C{i}": numpy.arange(size, dtype=float) for i in range(10)}
+        )
+        self.data_bytes = self.dataframe.memory_usage(index=False).sum()
+
+    def test_copy(self):
+        peak, copy = test_utils.peak_memory(lambda: util.copy_dataframe(self.dataframe))
+        self.assertGreaterEqual(peak, self.data_bytes)
+        copy["C0"] = 0.0
+        self.assertEqual(self.dataframe["C0"].iat[1], 1)
+
+    def test_copy_on_write(self):
+        with pandas.option_context("mode.copy_on_write", True):
+
+            def copy_and_modify():
+                copy = util.copy_dataframe(self.dataframe)
+                copy.loc[copy.index[:10], "C0"] = 0.0
+                copy["C11"] = 1.0
+                return copy
+
+            peak, copy = test_utils.peak_memory(copy_and_modify)
+
+        # Only the modified and added columns are allocated
+        self.assertLess(peak, self.data_bytes * 0.25)
+        self.assertEqual(copy["C0"].iat[1], 0)
+        self.assertEqual(self.dataframe["C0"].iat[1], 1)
+        self.assertNotIn("C11", self.dataframe)
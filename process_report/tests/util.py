@@ -1,3 +1,10 @@
+import os
+import types
+import shutil
+import hashlib
+import tracemalloc
+
+import botocore.exceptions
 import pandas
 
 from process_report.invoices import (
@@ -8,6 +15,7 @@ from process_report.invoices import (
 
 from process_report.processors import (
     add_institution_processor,
+    discount_processor,
     validate_pi_alias_processor,
     lenovo_processor,
     validate_billable_pi_processor,
@@ -21,10 +29,11 @@ def new_base_invoice(
     name="",
     invoice_month="0000-00",
     data=None,
+    output_format=invoice.CSV_FORMAT,
 ):
     if data is None:
         data = pandas.DataFrame()
-    return invoice.Invoice(name, invoice_month, data)
+    return invoice.Invoice(name, invoice_month, data, output_format=output_format)
 
 
 def new_billable_invoice(
@@ -87,6 +96,12 @@ def new_validate_pi_alias_processor(
     )
 
 
+def new_discount_processor(name="", invoice_month="0000-00", data=None):
+    if data is None:
+        data = pandas.DataFrame()
+    return discount_processor.DiscountProcessor(name, invoice_month, data)
+
+
 def new_lenovo_processor(name="", invoice_month="0000-00", data=None):
     if data is None:
         data = pandas.DataFrame()
@@ -99,6 +114,7 @@ def new_validate_billable_pi_processor(
     data=None,
     nonbillable_pis=None,
     nonbillable_projects=None,
+    nonbillable_matcher=None,
 ):
     if data is None:
         data = pandas.DataFrame()
@@ -113,6 +129,7 @@ def new_validate_billable_pi_processor(
         data,
         nonbillable_pis,
         nonbillable_projects,
+        nonbillable_matcher,
     )
 
 
@@ -169,3 +186,94 @@ def new_prepayment_processor(
         prepay_debits_filepath,
         upload_to_s3,
     )
+
+
+def peak_memory(func):
+    """Returns the peak memory traced by tracemalloc while running `func`,
+    along with its result"""
+    tracemalloc.start()
+    try:
+        result = func()
+        return tracemalloc.get_traced_memory()[1], result
+    finally:
+        tracemalloc.stop()
+
+
+class LocalS3Bucket:
+    """Stand-in for a boto3 S3 bucket, backed by a local directory
+
+    Implements the subset of the bucket resource and client API used to
+    transfer invoices. Every call is recorded in `calls`. Transfers of the
+    keys in `failures` fail as many times as their count.
+    """
+
+    def __init__(self, root_dir, name="test-bucket"):
+        self.root_dir = root_dir
+        self.name = name
+        self.calls = list()
+        self.failures = dict()
+        self.objects = types.SimpleNamespace(filter=self._filter)
+        self.meta = types.SimpleNamespace(client=self)
+
+    def _path(self, key):
+        return os.path.join(self.root_dir, key)
+
+    def _etag(self, key):
+        with open(self._path(key), "rb") as f:
+            return f'"{hashlib.md5(f.read()).hexdigest()}"'
+
+    def put(self, key, content: bytes):
+        os.makedirs(os.path.dirname(self._path(key)), exist_ok=True)
+        with open(self._path(key), "wb") as f:
+            f.write(content)
+
+    def get(self, key) -> bytes:
+        with open(self._path(key), "rb") as f:
+            return f.read()
+
+    def keys(self):
+        return sorted(
+            os.path.relpath(os.path.join(dirpath, filename), self.root_dir)
+            for dirpath, _, filenames in os.walk(self.root_dir)
+            for filename in filenames
+        )
+
+    def _filter(self, Prefix=""):
+        self.calls.append(("list", Prefix))
+        return [
+            types.SimpleNamespace(
+                key=key, e_tag=self._etag(key), size=os.path.getsize(self._path(key))
+            )
+            for key in self.keys()
+            if key.startswith(Prefix)
+        ]
+
+    def head_object(self, Bucket, Key):
+        self.calls.append(("head", Key))
+        return {
+            "ETag": self._etag(Key),
+            "ContentLength": os.path.getsize(self._path(Key)),
+        }
+
+    def download_file(self, Bucket, Key, Filename, **kwargs):
+        self.calls.append(("download", Key))
+        shutil.copyfile(self._path(Key), Filename)
+
+    def _maybe_fail(self, key):
+        if self.failures.get(key, 0) > 0:
+            self.failures[key] -= 1
+            raise botocore.exceptions.EndpointConnectionError(
+                endpoint_url=f"s3://{self.name}/{key}"
+            )
+
+    def upload_file(self, Filename, Bucket, Key, **kwargs):
+        self.calls.append(("upload", Key))
+        self._maybe_fail(Key)
+        os.makedirs(os.path.dirname(self._path(Key)), exist_ok=True)
+        shutil.copyfile(Filename, self._path(Key))
+
+    def copy(self, CopySource, Bucket, Key, **kwargs):
+        self.calls.append(("copy", CopySource["Key"], Key))
+        self._maybe_fail(Key)
+        os.makedirs(os.path.dirname(self._path(Key)), exist_ok=True)
+        shutil.copyfile(self._path(CopySource["Key"]), self._path(Key))
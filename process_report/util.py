@@ -1,10 +1,14 @@
 import os
+import sys
 import datetime
 import yaml
 import logging
 import functools
 
-import boto3
+import numpy
+import pandas
+
+from process_report import s3_transfer, pipeline, instrumentation
 
 
 logger = logging.getLogger(__name__)
@@ -13,6 +17,8 @@ logging.basicConfig(level=logging.INFO)
 
 @functools.lru_cache
 def get_invoice_bucket():
+    import boto3
+
     try:
         s3_resource = boto3.resource(
             service_name="s3",
@@ -29,8 +35,14 @@ def get_invoice_bucket():
     return s3_resource.Bucket(os.environ.get("S3_BUCKET_NAME", "nerc-invoicing"))
 
 
+INSTITUTE_LIST_PATH = os.path.join(os.path.dirname(__file__), "institute_list.yaml")
+
+
+@functools.lru_cache
 def load_institute_list():
-    with open("process_report/institute_list.yaml", "r") as f:
+    """Parses `institute_list.yaml` once. The returned list is shared and
+    must not be modified."""
+    with open(INSTITUTE_LIST_PATH, "r") as f:
         institute_list = yaml.safe_load(f)
 
     return institute_list
@@ -45,48 +57,328 @@ def get_institute_mapping(institute_list: list):
     return institute_map
 
 
-def get_institution_from_pi(institute_map, pi_uname):
+def match_institution_from_pi(institute_map, pi_uname):
+    """Returns the institution name matching the PI's email domain, or an
+    empty string if there is no match"""
     institution_domain = pi_uname.split("@")[-1]
     for i in range(institution_domain.count(".") + 1):
         if institution_name := institute_map.get(institution_domain, ""):
             break
         institution_domain = institution_domain[institution_domain.find(".") + 1 :]
 
+    return institution_name
+
+
+def get_institution_from_pi(institute_map, pi_uname):
+    institution_name = match_institution_from_pi(institute_map, pi_uname)
     if institution_name == "":
         print(f"Warning: PI name {pi_uname} does not match any institution!")
 
     return institution_name
 
 
+class InstitutionResolver:
+    """Resolves PI usernames to institution names
+
+    The domains in the institute list are compiled into a trie of their
+    labels, from the top level domain down, so an email domain is matched
+    in a single walk. As with `get_institution_from_pi`, the longest
+    matching domain suffix wins, and PIs without a match resolve to an
+    empty string. Lookups are memoized.
+    """
+
+    def __init__(self, institute_list: list):
+        self.institute_list = institute_list
+        self._domain_trie = dict()
+        for institute_info in institute_list:
+            for domain in institute_info.get("domains", []):
+                node = self._domain_trie
+                for label in reversed(domain.split(".")):
+                    node = node.setdefault(label, dict())
+                # Labels are never None, so it marks the end of a domain
+                node[None] = institute_info["display_name"]
+
+        self.lookup = functools.lru_cache(maxsize=None)(self._lookup)
+
+        self._partnership_start_ordinals = [
+            (
+                institute_info["display_name"],
+                get_month_ordinal(institute_info["mghpcc_partnership_start_date"]),
+            )
+            for institute_info in institute_list
+            if institute_info.get("mghpcc_partnership_start_date")
+        ]
+
+    def _lookup(self, pi_uname) -> str:
+        institution_name = ""
+        node = self._domain_trie
+        for label in reversed(pi_uname.split("@")[-1].split(".")):
+            if (node := node.get(label)) is None:
+                break
+            institution_name = node.get(None, institution_name)
+
+        return institution_name
+
+    def resolve_series(self, pi_series: pandas.Series) -> pandas.Series:
+        """Resolves every PI in the series, looking up each distinct PI once.
+        Missing PIs stay missing."""
+        has_pi = pi_series.notna()
+        institutions = {
+            pi_uname: self.lookup(pi_uname) for pi_uname in pi_series[has_pi].unique()
+        }
+        return pi_series.map(institutions, na_action="ignore")
+
+    def active_partnerships(self, invoice_month) -> list[str]:
+        """Returns the institutions whose MGHPCC partnership has started by
+        `invoice_month`"""
+        month_ordinal = get_month_ordinal(invoice_month)
+        return [
+            institution
+            for institution, start_ordinal in self._partnership_start_ordinals
+            if month_ordinal >= start_ordinal
+        ]
+
+
+_institution_resolver = (None, None)
+
+
+def get_institution_resolver() -> InstitutionResolver:
+    """Returns a resolver for the current institute list, shared by all
+    processors"""
+    global _institution_resolver
+    institute_list = load_institute_list()
+    cached_list, resolver = _institution_resolver
+    if cached_list is not institute_list:
+        resolver = InstitutionResolver(institute_list)
+        _institution_resolver = (institute_list, resolver)
+
+    return resolver
+
+
+def get_alias_index(alias_map: dict) -> dict:
+    """Returns the PI of each alias in `alias_map`, which lists the aliases
+    of each PI. An alias of a PI that is itself an alias is resolved to the
+    last PI of the chain, i.e to PI2 for PI1_1 if PI1 is an alias of PI2
+
+    Raises ValueError if an alias belongs to more than one PI, or if aliases
+    form a cycle
+    """
+    direct_index = dict()
+    for pi, pi_aliases in alias_map.items():
+        for alias in pi_aliases:
+            if not alias or alias == pi:
+                continue
+            if direct_index.setdefault(alias, pi) != pi:
+                raise ValueError(
+                    f"PI alias {alias} is listed for both {direct_index[alias]} and {pi}"
+                )
+
+    alias_index = dict()
+    for alias in direct_index:
+        chain = [alias]
+        while chain[-1] in direct_index and chain[-1] not in alias_index:
+            pi = direct_index[chain[-1]]
+            if pi in chain:
+                raise ValueError(
+                    f"PI aliases form a cycle: {' -> '.join(chain + [pi])}"
+                )
+            chain.append(pi)
+        pi = alias_index.get(chain[-1], chain[-1])
+        for chained_alias in chain[:-1]:
+            alias_index[chained_alias] = pi
+    return alias_index
+
+
+def map_identifiers(series: pandas.Series, func) -> pandas.Series:
+    """Applies `func`, which maps a series of identifiers to new identifiers
+    value by value, to `series`
+
+    A categorical series only has its categories mapped, and the result
+    stays a categorical sharing the series' codes where possible. Missing
+    identifiers are not passed to `func` and stay missing.
+    """
+    if not isinstance(series.dtype, pandas.CategoricalDtype):
+        return func(series)
+
+    mapped_categories = func(pandas.Series(series.cat.categories, dtype=object))
+    # Distinct categories may map to the same identifier
+    new_codes, new_categories = pandas.factorize(mapped_categories)
+    codes = series.cat.codes.to_numpy()
+    return pandas.Series(
+        pandas.Categorical.from_codes(
+            numpy.where(codes >= 0, new_codes[codes], -1), categories=new_categories
+        ),
+        index=series.index,
+        name=series.name,
+    )
+
+
+def copy_dataframe(dataframe: pandas.DataFrame) -> pandas.DataFrame:
+    """Returns a copy of the dataframe, so that changes to either one do not
+    affect the other. In copy-on-write mode, the copy shares the data of the
+    original until either one is modified, and only the modified columns
+    are then copied"""
+    return dataframe.copy(deep=not pandas.options.mode.copy_on_write)
+
+
 def get_iso8601_time():
     return datetime.datetime.now().strftime("%Y%m%dT%H%M%SZ")
 
 
 def compare_invoice_month(month_1, month_2):
     """Returns True if 1st date is later than 2nd date"""
-    dt1 = datetime.datetime.strptime(month_1, "%Y-%m")
-    dt2 = datetime.datetime.strptime(month_2, "%Y-%m")
-    return dt1 > dt2
+    return get_month_ordinal(month_1) > get_month_ordinal(month_2)
 
 
 def get_month_diff(month_1, month_2):
     """Returns a positive integer if month_1 is ahead in time of month_2"""
-    dt1 = datetime.datetime.strptime(month_1, "%Y-%m")
-    dt2 = datetime.datetime.strptime(month_2, "%Y-%m")
-    return (dt1.year - dt2.year) * 12 + (dt1.month - dt2.month)
+    return get_month_ordinal(month_1) - get_month_ordinal(month_2)
 
 
-def process_and_export_invoices(invoice_list, upload_to_s3):
-    for invoice in invoice_list:
+# Months in YYYY-MM format are compared as "month ordinals", the number of
+# months between January of year 0 and the month, i.e `year * 12 + month - 1`
+MonthOrdinal = int
+
+
+@functools.lru_cache(maxsize=None)
+def get_month_ordinal(month) -> MonthOrdinal:
+    """Returns the ordinal of a month in YYYY-MM format, so that month
+    differences are integer subtractions. Parsed months are memoized"""
+    dt = datetime.datetime.strptime(month, "%Y-%m")
+    return dt.year * 12 + dt.month - 1
+
+
+def get_month_range(first_month, last_month) -> list[str]:
+    """Returns the months from `first_month` to `last_month`, both included,
+    in YYYY-MM format"""
+    return [
+        f"{ordinal // 12:04d}-{ordinal % 12 + 1:02d}"
+        for ordinal in range(
+            get_month_ordinal(first_month), get_month_ordinal(last_month) + 1
+        )
+    ]
+
+
+def get_month_ordinals(months):
+    """Vectorized `get_month_ordinal`, parsing each distinct month once.
+    Returns a Series for a Series of months, and an array otherwise"""
+    if not isinstance(months, pandas.Series):
+        return get_month_ordinals(pandas.Series(months, dtype=object)).to_numpy()
+    return months.map({month: get_month_ordinal(month) for month in months.unique()})
+
+
+def _to_month_ordinals(months):
+    if isinstance(months, str):
+        return get_month_ordinal(months)
+    return get_month_ordinals(months)
+
+
+def get_month_diffs(months_1, months_2):
+    """Vectorized `get_month_diff`. Either argument may be a single month"""
+    return _to_month_ordinals(months_1) - _to_month_ordinals(months_2)
+
+
+def compare_invoice_months(months_1, months_2):
+    """Vectorized `compare_invoice_month`. Either argument may be a single
+    month"""
+    return _to_month_ordinals(months_1) > _to_month_ordinals(months_2)
+
+
+def process_and_export_invoices(
+    invoice_list,
+    upload_to_s3,
+    max_workers=pipeline.DEFAULT_MAX_WORKERS,
+    use_processes=False,
+) -> pipeline.PipelineReport:
+    """Processes and exports the invoices concurrently, each after the
+    invoices it depends on, then uploads all their files to S3 at once
+
+    Invoices run on threads by default. With `use_processes`, they run in
+    forked processes where possible, which is faster for large invoices.
+    The invoice objects of this process are then not updated, i.e their
+    `export_data` is left unset, and only their exported files are. The
+    metrics of their stages are returned to this process's run report"""
+
+    def _process_and_export(invoice):
+        run_report = instrumentation.get_run_report()
+        first_stage = len(run_report.stages)
         invoice.process()
-        invoice.export()
-        if upload_to_s3:
-            bucket = get_invoice_bucket()
-            invoice.export_s3(bucket)
+        invoice.run_stage(invoice.export)
+        return run_report.stages[first_stage:]
+
+    if use_processes and not pipeline.can_fork():
+        logger.warning("Forked processes are not supported, using threads")
+        use_processes = False
+    invoice_pipeline = pipeline.Pipeline(max_workers, use_processes)
+    for invoice in invoice_list:
+        invoice_pipeline.add_node(
+            type(invoice).__name__,
+            functools.partial(_process_and_export, invoice),
+            invoice.depends_on,
+        )
+    report = invoice_pipeline.run()
+    if invoice_pipeline.use_processes:
+        for stages in report.results.values():
+            for metrics in stages:
+                instrumentation.get_run_report().add(metrics)
+
+    if upload_to_s3:
+        s3_uploads = list()
+        for invoice in invoice_list:
+            s3_uploads.extend(invoice.s3_uploads())
+        invoice_month = invoice_list[0].invoice_month if invoice_list else None
+        with instrumentation.measure(
+            "S3Uploader", "upload", invoice_month=invoice_month
+        ):
+            upload_to_s3_bucket(s3_uploads)
+
+    return report
+
+
+def get_s3_downloader():
+    return s3_transfer.S3Downloader(
+        get_invoice_bucket(),
+        cache_dir=os.environ.get("S3_CACHE_DIR", s3_transfer.DEFAULT_CACHE_DIR),
+        max_workers=int(
+            os.environ.get("S3_MAX_WORKERS", s3_transfer.DEFAULT_MAX_WORKERS)
+        ),
+    )
 
 
 def fetch_s3(s3_filepath):
-    local_name = os.path.basename(s3_filepath)
-    invoice_bucket = get_invoice_bucket()
-    invoice_bucket.download_file(s3_filepath, local_name)
-    return local_name
+    s3_downloader = get_s3_downloader()
+    s3_object = s3_downloader.head(s3_filepath)
+    s3_downloader.download([s3_object])
+    return s3_object.local_path
+
+
+def get_s3_uploader(s3_bucket=None):
+    if s3_bucket is None:
+        s3_bucket = get_invoice_bucket()
+    return s3_transfer.S3Uploader(
+        s3_bucket,
+        max_workers=int(
+            os.environ.get("S3_MAX_WORKERS", s3_transfer.DEFAULT_MAX_WORKERS)
+        ),
+        multipart_threshold=int(
+            os.environ.get(
+                "S3_MULTIPART_THRESHOLD", s3_transfer.DEFAULT_MULTIPART_THRESHOLD
+            )
+        ),
+        multipart_chunksize=int(
+            os.environ.get(
+                "S3_MULTIPART_CHUNKSIZE", s3_transfer.DEFAULT_MULTIPART_CHUNKSIZE
+            )
+        ),
+        max_attempts=int(
+            os.environ.get("S3_MAX_ATTEMPTS", s3_transfer.DEFAULT_MAX_ATTEMPTS)
+        ),
+    )
+
+
+def upload_to_s3_bucket(s3_uploads, s3_bucket=None):
+    """Uploads files to S3 concurrently, exiting if any upload failed"""
+    upload_stats = get_s3_uploader(s3_bucket).upload(s3_uploads)
+    if upload_stats.failed:
+        sys.exit(f"Uploading to S3 failed for {len(upload_stats.failed)} files")
+    return upload_stats